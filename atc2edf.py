@@ -2,29 +2,45 @@
 
 import sys
 import os
+import signal
 import subprocess
 import json
 import datetime
 import argparse
+from concurrent import futures
 
 import numpy
-import pyedflib
-
-from pyedflib import highlevel
-import matplotlib.pyplot as plt
 
 CURR_DIR = os.path.dirname(os.path.realpath(__file__))
 
 gDebug = False
 
-def convertAtc2Dict(filename):
+gChannels = ['leadI', 'leadII', 'leadIII', 'aVR', 'aVL', 'aVF']
+
+def listOfIntToString(data):
+  out = ""
+  for i in range(len(data)):
+    if(data[i] and data[i] is not None): out += chr(data[i])
+  return out[:]
+
+# timeout (sec): the go process group is killed and subprocess.TimeoutExpired raised
+def convertAtc2Dict(filename, timeout=None):
   os.environ['GOPATH'] =  CURR_DIR + '/dependencies/atc2json/'
 
   cmdConvertAtc2Json = "go run %s/dependencies/atc2json/main.go < %s" % (CURR_DIR, filename)
 
   if gDebug: print(" - converting ATC to json using: '%s'" % (cmdConvertAtc2Json))
 
-  res = subprocess.check_output(cmdConvertAtc2Json, shell=True)
+  # own process group: 'go run' starts the compiled program as a child of the shell
+  process = subprocess.Popen(cmdConvertAtc2Json, shell=True, stdout=subprocess.PIPE, start_new_session=True)
+  try:
+    res, _ = process.communicate(timeout=timeout)
+  except subprocess.TimeoutExpired:
+    os.killpg(process.pid, signal.SIGKILL)
+    process.communicate()
+    raise
+  if process.returncode != 0:
+    raise subprocess.CalledProcessError(process.returncode, cmdConvertAtc2Json)
   resJson = res.decode('utf-8')
 
   d = json.loads(resJson)
@@ -37,12 +53,6 @@ def convertAtcDict2Edf(edfFilename, atcDict):
   mainsFrequency = atcDict['mainsFrequency']
   gain = atcDict['gain']
 
-  def listOfIntToString(data):
-    out = ""
-    for i in range(len(data)):
-      if(data[i] and data[i] is not None): out += chr(data[i])
-    return out[:]
-
   dateRecorded = listOfIntToString(atcDict['Info']['DateRecorded'])
   dateTimeRecorded = datetime.datetime.strptime(dateRecorded, "%Y-%m-%dT%H:%M:%S%z")
   recordingUUID = listOfIntToString(atcDict['Info']['RecordingUUID'])
@@ -73,12 +83,13 @@ def convertAtcDict2Edf(edfFilename, atcDict):
       out.append(mV)
     return out
 
-  channels = ['leadI', 'leadII', 'leadIII', 'aVR', 'aVL', 'aVF']
+  channels = gChannels
   nbChannelsHere = 0 
   for chan in channels:
     if chan in atcDict['samples']:
       nbChannelsHere += 1 
 
+  import pyedflib # only for the EDF export (importers of this module do not need it)
   f = pyedflib.EdfWriter(edfFilename, nbChannelsHere, file_type=pyedflib.FILETYPE_EDF)
 
   #f.setEquipment(recorderHardware + " " + recorderSoftware + " (" + phoneModel + ")")
@@ -124,11 +135,268 @@ def convertAtcDict2Edf(edfFilename, atcDict):
   print(" - EDF file: '%s'" % (edfFilename))
   return True
 
-def compareEdfs(edfFilename1, edfFilename2, verbose=True):
-  highlevel.compare_edf(edfFilename1, edfFilename2, verbose)
+# Write the ATC int16 samples directly as a WFDB (MIT) record: recordWorkName.hea + recordWorkName.dat
+# (format 16, interleaved samples), what edf2mit would produce from the EDF file.
+def convertAtcDict2Wfdb(recordWorkName, atcDict):
+  recordId = os.path.basename(recordWorkName)
+  datFilename = recordWorkName + '.dat'
+  heaFilename = recordWorkName + '.hea'
+
+  # from: https://developers.kardia.com/#ecg-samples-object
+  # "To convert to millivolts, divide these samples by (1e6 / amplitudeResolution)."
+  gain = float(1e6) / float(atcDict['amplitudeResolution'])
+
+  leads = [chan for chan in gChannels if chan in atcDict['samples'] and atcDict['samples'][chan]]
+  if not leads:
+    print("ERROR: convertAtcDict2Wfdb: no signal in ATC (%s)" % (recordId))
+    return False
+
+  nbSamples = min([len(atcDict['samples'][chan]) for chan in leads])
+  data = numpy.empty((nbSamples, len(leads)), dtype='<i2') # one frame per line: interleaved
+  for i in range(len(leads)):
+    data[:, i] = atcDict['samples'][leads[i]][:nbSamples]
+
+  os.makedirs(os.path.dirname(recordWorkName) or '.', exist_ok=True)
+  data.tofile(datFilename)
+
+  dateRecorded = listOfIntToString(atcDict['Info']['DateRecorded'])
+  dateTimeRecorded = datetime.datetime.strptime(dateRecorded, "%Y-%m-%dT%H:%M:%S%z")
+  checksums = data.sum(axis=0, dtype=numpy.int64)
+
+  with open(heaFilename, mode='w') as f:
+    f.write("%s %d %g %d %s\n" % (recordId, len(leads), atcDict['frequency'], nbSamples, dateTimeRecorded.strftime("%H:%M:%S %d/%m/%Y")))
+    for i in range(len(leads)):
+      # 16-bit signed checksum of all the samples of the signal
+      checksum = (int(checksums[i]) + 32768) % 65536 - 32768
+      f.write("%s.dat 16 %.12g(0)/mV 16 0 %d %d 0 %s\n" % (recordId, gain, int(data[0, i]), checksum, leads[i]))
+
+  print(" - channels %s added" % (', '.join(leads)))
+  print(" - WFDB record: '%s' (.hea, .dat)" % (recordWorkName))
+  return True
+
+# recordName: blah/data/b6 --> curr_dir/blah/data/work/b6 (see calculate.sh)
+def recordWorkName(recordName):
+  return os.path.join(CURR_DIR, os.path.dirname(recordName), 'work', os.path.basename(recordName))
+
+# EdfFile
+# Lazy EDF access: the header is parsed once and the data records are memory-mapped. Channels
+# are decoded only when asked for, by time range, as int16 (digital) or mV (physical) arrays.
+# --------------------------------------------------------------------------------------------
+class EdfFile:
+  def __init__(self, edfFilename):
+    self.filename = edfFilename
+
+    with open(edfFilename, mode='rb') as f:
+      main = f.read(256).decode('ascii', errors='replace')
+      nbSignals = int(main[252:256])
+      fields = f.read(nbSignals * 256).decode('ascii', errors='replace')
+
+    def field(text, start, length): return text[start:start + length].strip()
+
+    headerBytes = int(field(main, 184, 8))
+    self.header = {'version': field(main, 0, 8),
+                   'patient': field(main, 8, 80),
+                   'recording': field(main, 88, 80),
+                   'startdate': self.parseStartDate(field(main, 168, 8), field(main, 176, 8)),
+                   'reserved': field(main, 192, 44)}
+    self.recordDuration = float(field(main, 244, 8)) # sec
+
+    # per signal fields are stored one after the other for all signals: label x ns, transducer x ns, ...
+    sizes = [('label', 16), ('transducer', 80), ('dimension', 8), ('physical_min', 8), ('physical_max', 8),
+             ('digital_min', 8), ('digital_max', 8), ('prefilter', 80), ('samples_per_record', 8), ('reserved', 32)]
+    values = {}
+    offset = 0
+    for name, size in sizes:
+      values[name] = [field(fields, offset + i * size, size) for i in range(nbSignals)]
+      offset += nbSignals * size
+
+    self.signalHeaders = []
+    for i in range(nbSignals):
+      h = {'label': values['label'][i], 'transducer': values['transducer'][i], 'dimension': values['dimension'][i],
+           'physical_min': float(values['physical_min'][i]), 'physical_max': float(values['physical_max'][i]),
+           'digital_min': int(values['digital_min'][i]), 'digital_max': int(values['digital_max'][i]),
+           'prefilter': values['prefilter'][i], 'samples_per_record': int(values['samples_per_record'][i])}
+      h['sample_rate'] = h['samples_per_record'] / self.recordDuration if self.recordDuration else 0.0
+      self.signalHeaders.append(h)
+
+    samplesPerRecord = [h['samples_per_record'] for h in self.signalHeaders]
+    self.offsets = numpy.concatenate(([0], numpy.cumsum(samplesPerRecord))).astype(numpy.int64)
+    recordSize = int(self.offsets[-1])
+
+    # number of data records from the file size (the header value may be -1 or wrong)
+    dataBytes = os.path.getsize(edfFilename) - headerBytes
+    self.nbDataRecords = dataBytes // (2 * recordSize) if recordSize else 0
+
+    self.data = None
+    if self.nbDataRecords:
+      self.data = numpy.memmap(edfFilename, dtype='<i2', mode='r', offset=headerBytes, shape=(self.nbDataRecords, recordSize))
+
+  def parseStartDate(self, date, time):
+    try:
+      d, m, y = [int(v) for v in date.split('.')]
+      hh, mm, ss = [int(v) for v in time.split('.')]
+      return datetime.datetime(2000 + y if y < 85 else 1900 + y, m, d, hh, mm, ss)
+    except ValueError:
+      return None
+
+  def labels(self): return [h['label'] for h in self.signalHeaders]
+
+  def channelIndex(self, channel): # channel: index or label
+    return channel if isinstance(channel, int) else self.labels().index(channel)
+
+  def nbSamples(self, channel):
+    return self.nbDataRecords * self.signalHeaders[self.channelIndex(channel)]['samples_per_record']
+
+  def sampleRate(self, channel):
+    return self.signalHeaders[self.channelIndex(channel)]['sample_rate']
+
+  def duration(self): return self.nbDataRecords * self.recordDuration
+
+  def digital(self, channel, start=0.0, end=None): # int16 samples in [start, end[ (sec)
+    i = self.channelIndex(channel)
+    perRecord = self.signalHeaders[i]['samples_per_record']
+    if self.data is None or perRecord == 0:
+      return numpy.zeros(0, dtype=numpy.int16)
+
+    rate = self.signalHeaders[i]['sample_rate']
+    first = max(0, int(round(start * rate)))
+    last = self.nbSamples(i) if end is None else min(self.nbSamples(i), int(round(end * rate)))
+    if last <= first:
+      return numpy.zeros(0, dtype=numpy.int16)
+
+    # only the data records covering the range are read
+    r0 = first // perRecord
+    r1 = (last - 1) // perRecord + 1
+    samples = self.data[r0:r1, self.offsets[i]:self.offsets[i + 1]].reshape(-1)
+    return numpy.array(samples[first - r0 * perRecord:last - r0 * perRecord], dtype=numpy.int16)
+
+  def physical(self, channel, start=0.0, end=None): # samples in physical units (e.g. mV)
+    h = self.signalHeaders[self.channelIndex(channel)]
+    scale = (h['physical_max'] - h['physical_min']) / (h['digital_max'] - h['digital_min'])
+    return (self.digital(channel, start, end).astype(numpy.float64) - h['digital_min']) * scale + h['physical_min']
+
+  def close(self):
+    self.data = None
+
+# Compare 2 EDF files: headers, then per channel max abs and RMS differences of the physical
+# samples (vectorized) against tolerances.
+# return {'file': ..., 'status': 'ok'|'mismatch'|'missing'|'error', 'issues': [...], 'channels': {label: (maxAbs, rms)}}
+def compareEdfPair(edfFilename1, edfFilename2, maxAbsTolerance=1e-3, rmsTolerance=1e-4, name=None):
+  result = {'file': name or edfFilename1, 'status': 'ok', 'issues': [], 'channels': {}}
+
+  if not os.path.isfile(edfFilename2):
+    result['status'] = 'missing'
+    result['issues'].append("no counterpart (%s)" % (edfFilename2))
+    return result
+
+  try:
+    edf1 = EdfFile(edfFilename1)
+    edf2 = EdfFile(edfFilename2)
+  except (OSError, ValueError) as e:
+    result['status'] = 'error'
+    result['issues'].append("unreadable EDF: %s" % (str(e)))
+    return result
+
+  if edf1.labels() != edf2.labels():
+    result['status'] = 'mismatch'
+    result['issues'].append("signals %s vs %s" % (','.join(edf1.labels()), ','.join(edf2.labels())))
+    return result
+
+  if edf1.header['startdate'] != edf2.header['startdate']:
+    result['issues'].append("startdate %s vs %s" % (str(edf1.header['startdate']), str(edf2.header['startdate'])))
+
+  for i in range(len(edf1.signalHeaders)):
+    h1 = edf1.signalHeaders[i]
+    h2 = edf2.signalHeaders[i]
+    label = h1['label']
+    for key in ['dimension', 'sample_rate', 'physical_min', 'physical_max', 'digital_min', 'digital_max']:
+      if h1[key] != h2[key]:
+        result['issues'].append("%s %s %s vs %s" % (label, key, str(h1[key]), str(h2[key])))
+
+    s1 = edf1.physical(i)
+    s2 = edf2.physical(i)
+    if len(s1) != len(s2):
+      result['issues'].append("%s length %d vs %d" % (label, len(s1), len(s2)))
+      continue
+    if not len(s1):
+      continue
+
+    diff = s1 - s2
+    maxAbs = float(numpy.max(numpy.abs(diff)))
+    rms = float(numpy.sqrt(numpy.mean(diff * diff)))
+    result['channels'][label] = (maxAbs, rms)
+    if maxAbs > maxAbsTolerance or rms > rmsTolerance:
+      result['issues'].append("%s max|d|=%.6g rms=%.6g" % (label, maxAbs, rms))
+
+  if result['issues']:
+    result['status'] = 'mismatch'
+  return result
+
+def compareEdfPairArgs(args): return compareEdfPair(*args)
+
+def compareEdfs(edfFilename1, edfFilename2, verbose=True, maxAbsTolerance=1e-3, rmsTolerance=1e-4): # return True if identical (within tolerances)
+  result = compareEdfPair(edfFilename1, edfFilename2, maxAbsTolerance, rmsTolerance)
+
+  if verbose:
+    for label in result['channels'].keys():
+      maxAbs, rms = result['channels'][label]
+      print("Signal %s: max abs diff: %g - rms diff: %g" % (label, maxAbs, rms))
+    for issue in result['issues']:
+      print("Difference: %s" % (issue))
+
+  return result['status'] == 'ok'
+
+# Compare all the EDF files of 2 trees (e.g. before / after a converter change, or ours vs
+# Alive File Converter's: -s1 .edf -s2 .atc.edf), in parallel.
+# return 0 if no regression
+def compareEdfTrees(directory1, directory2, suffix1='.edf', suffix2='.edf', maxAbsTolerance=1e-3, rmsTolerance=1e-4, maxWorkers=None, reportFilename=None):
+  pairs = []
+  for root, dirs, files in os.walk(directory1):
+    dirs.sort()
+    for file in sorted(files):
+      if not file.endswith(suffix1): continue
+      if suffix1 != suffix2 and file.endswith(suffix2): continue # e.g. x.atc.edf when comparing x.edf
+      path1 = os.path.join(root, file)
+      relpath = os.path.relpath(path1, directory1)
+      path2 = os.path.join(directory2, relpath[:-len(suffix1)] + suffix2)
+      pairs.append((path1, path2, maxAbsTolerance, rmsTolerance, relpath))
+
+  print("Info: comparing %d EDF files ('%s' vs '%s')..." % (len(pairs), directory1, directory2))
+
+  counts = {'ok': 0, 'mismatch': 0, 'missing': 0, 'error': 0}
+  reportFile = open(reportFilename, mode='w') if reportFilename else None
+  if reportFile: print("file;status;issues", file=reportFile)
+
+  with futures.ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+    for result in executor.map(compareEdfPairArgs, pairs, chunksize=16):
+      counts[result['status']] += 1
+      if result['status'] != 'ok':
+        print("%-8s %s: %s" % (result['status'].upper(), result['file'], '; '.join(result['issues'])))
+      if reportFile:
+        print("%s;%s;%s" % (result['file'], result['status'], ' | '.join(result['issues'])), file=reportFile)
+
+  if reportFile: reportFile.close()
+
+  print("Compared: %d - ok: %d - mismatch: %d - missing: %d - error: %d" % (len(pairs), counts['ok'], counts['mismatch'], counts['missing'], counts['error']))
+  return 0 if len(pairs) == counts['ok'] else 1
+
+def mainCompare(argv):
+  ap = argparse.ArgumentParser(prog="atc2edf.py compare", description="compare the EDF files of 2 directory trees")
+  ap.add_argument("directory1", help="reference tree")
+  ap.add_argument("directory2", help="tree to check")
+  ap.add_argument("-s1", "--suffix1", default=".edf", help="suffix of the files in directory1 (default: .edf)")
+  ap.add_argument("-s2", "--suffix2", default=".edf", help="suffix of the files in directory2 (default: .edf, e.g. .atc.edf)")
+  ap.add_argument("-a", "--max-abs", type=float, default=1e-3, help="max abs difference tolerance per channel (physical unit, default: 1e-3)")
+  ap.add_argument("-r", "--rms", type=float, default=1e-4, help="RMS difference tolerance per channel (physical unit, default: 1e-4)")
+  ap.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: cpu count)")
+  ap.add_argument("-o", "--report", default=None, help="write the full report (CSV) to this file")
+  args = vars(ap.parse_args(argv))
+
+  return compareEdfTrees(args['directory1'], args['directory2'], args['suffix1'], args['suffix2'],
+                         args['max_abs'], args['rms'], args['jobs'], args['report'])
 
 def debugEdf(edfFilename):
-  signals, signalHeaders, header = highlevel.read_edf(edfFilename)
+  edf = EdfFile(edfFilename)
 
   print(" -------------------------------------- ")
   print(" DEBUG EDF: '%s'" % (edfFilename))
@@ -136,69 +404,89 @@ def debugEdf(edfFilename):
   print("")
   print("HEADERS:")
   print("--------")
-  print(header)
+  print(edf.header)
   print("")
   print("SIGNAL HEADERS:")
   print("---------------")
-  print(signalHeaders)
+  print(edf.signalHeaders)
   print("")
   print("SIGNALS:")
   print("--------")
   print("")
-  print(signals)
-  """
-  for s in signals:
-    l = len(s)
-    print(" - signal length: %d - signal: %s" % (l, str(s)))
-  """
+  for label in edf.labels():
+    print(" - %s: %d samples - %s" % (label, edf.nbSamples(label), str(edf.physical(label))))
 
-def plotEdfs(edfFilename1, edfFilename2):
+def plotEdfs(edfFilename1, edfFilename2, start=0.0, end=None):
+  import matplotlib.pyplot as plt
 
-  signals1, signalHeaders1, header1 = highlevel.read_edf(edfFilename1)
-  signals2, signalHeaders2, header2 = highlevel.read_edf(edfFilename2)
+  edf1 = EdfFile(edfFilename1)
+  edf2 = EdfFile(edfFilename2)
   
-  plt.plot(signals1[0], color="green")
-  plt.plot(signals2[0], "x", color="blue")
+  plt.plot(edf1.physical(0, start, end), color="green")
+  plt.plot(edf2.physical(0, start, end), "x", color="blue")
   plt.show()
 
-  plt.plot(signals1[1], color="orange")
-  plt.plot(signals2[1], color="red")
+  plt.plot(edf1.physical(1, start, end), color="orange")
+  plt.plot(edf2.physical(1, start, end), color="red")
   plt.show()
 
 def main():
 
-  ap = argparse.ArgumentParser()
+  # ./atc2edf.py compare <directory1> <directory2> [...]
+  if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+    return mainCompare(sys.argv[2:])
+
+  ap = argparse.ArgumentParser(epilog="compare mode: %(prog)s compare -h")
   ap.add_argument("-i", "--atcFilename", required=True, help="atc filename to convert.")
   ap.add_argument("-r", "--recordName", required=True, help="record name") # type=int, default=42, action=
   #ap.add_argument("-c", "--compareWithAlive", action='store_true', help="compare with AliveCore FileConverter's edf file (recordName.atc.edf)")
   ap.add_argument("-f", "--forceOverwriteEDF", action='store_true', help='force overwriting EDF file if already exists.')
+  ap.add_argument("-m", "--mit", action='store_true', help="write the WFDB (MIT format 16) record directly in work/ (calculate.sh then skips edf2mit)")
+  ap.add_argument("-n", "--no-edf", action='store_true', help="do not write the EDF file (with -m)")
   ap.add_argument("-v", "--verbose", action='store_true', help="print verbose")
   args = vars(ap.parse_args())
 
   gDebug = args['verbose']
 
-  print("Converting ATC -> EDF, recordName: ", args['recordName'])
+  writeEdf = not (args['mit'] and args['no_edf'])
+  writeMit = args['mit']
+
+  print("Converting ATC -> %s, recordName: " % ('EDF + MIT' if writeEdf and writeMit else 'MIT' if writeMit else 'EDF'), args['recordName'])
 
   atcFilename = CURR_DIR + "/" + args['atcFilename']
   edfFilename = CURR_DIR + "/" + args['recordName'] + ".edf"
   atcOrigFilename = CURR_DIR + "/" + args['recordName'] + ".atc.edf" # created by GUI ATC 2 EDF tool
+  mitRecordName = recordWorkName(args['recordName'])
 
   if not os.path.isfile(atcFilename):
     print("ERROR: ATC file does not exist (%s)" % (atcFilename))
     return 1
 
-  if os.path.isfile(edfFilename):
+  if writeEdf and os.path.isfile(edfFilename):
     if args['forceOverwriteEDF']:
       print("INFO: EDF file (%s) already exists, overwriting." % (edfFilename))
     else:
       print("INFO: EDF file (%s) already exists, do nothing." % (edfFilename))
-      return 0
+      writeEdf = False
+
+  if writeMit and os.path.isfile(mitRecordName + '.hea') and os.path.isfile(mitRecordName + '.dat'):
+    print("INFO: WFDB record (%s) already exists, do nothing." % (mitRecordName))
+    writeMit = False
+
+  if not writeEdf and not writeMit:
+    return 0
 
   print(" *** convert ATC file to dict... (using atc2json)")
   atcDict = convertAtc2Dict(atcFilename)
 
-  print(" *** convert dict to EDF...")
-  convertAtcDict2Edf(edfFilename, atcDict) 
+  if writeEdf:
+    print(" *** convert dict to EDF...")
+    convertAtcDict2Edf(edfFilename, atcDict) 
+
+  if writeMit:
+    print(" *** convert dict to WFDB (MIT)...")
+    if not convertAtcDict2Wfdb(mitRecordName, atcDict):
+      return 1
 
   """
   if args['compareWithAlive']:
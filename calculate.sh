@@ -1,7 +1,15 @@
 #!/bin/bash
 
+# -c: convert only (edf2mit, wfdbdesc, rdsamp): QRS detection, RR and get_hrv are then done
+#     by process-kardia-records.py for all enabled detectors at once (see qrsdetectors.py)
+CONVERT_ONLY=0
+if [[ "$1" == "-c" ]]; then
+    CONVERT_ONLY=1
+    shift
+    fi
+
 if [[ $# -ne 1 ]]; then
-    echo "Help: $0 <record name>"
+    echo "Help: $0 [-c] <record name>"
     exit 1
     fi
 
@@ -23,7 +31,6 @@ RECORD_FILE_DAT=$RECORD_WORK_FILE.dat
 #EDF_FILE=$RECORD_FILE.atc.edf
 # .edf is generated by me :)
 EDF_FILE=$RECORD_FILE.edf
-if [[ ! -e $EDF_FILE ]]; then echo "Error: edf file ($EDF_FILE) does not exist."; exit 1; fi
 
 # annotation files (contain data stream annotation (eg. where is the QRS)
 ANN_GQRS_LEAD1=gqrs-lead1
@@ -77,7 +84,9 @@ echo " -- " >> $OUTPUT_COMMANDS
 
 
 if [[ -e $RECORD_FILE_HEA &&
-      -e $RECORD_FILE_DAT ]]; then
+      -e $RECORD_FILE_DAT &&
+      -e $WFDB_DESC_FILE &&
+      -e $SAMPLES_FILE ]]; then
     echo "INFO: Record '$RECORD_ID' already calculated, do nothing."
     exit 0 
     fi
@@ -99,12 +108,21 @@ if [[ -e $RECORD_FILE_HEA &&
 #if [[ -e $OUTPUT_FILE ]]; then rm -vf $OUTPUT_FILE; fi 
 
 
-echo ""
-echo " * edf2mit... (Convert EDF to MIT format)"
-echo " ---------------------------------------------------------"
-edf2mit -i $EDF_FILE -r $RECORD_WORK_ID
-echo "edf2mit -i $EDF_FILE -r $RECORD_WORK_ID" >> $OUTPUT_COMMANDS
-if [[ $? -ne 0 ]]; then echo "Error: edf2mit"; exit 1; fi 
+# MIT record written directly from the ATC samples (atc2edf.py -m): no EDF needed
+if [[ -e $RECORD_FILE_HEA &&
+      -e $RECORD_FILE_DAT ]]; then
+    echo ""
+    echo " * MIT record already written by atc2edf.py -m, skipping edf2mit"
+else
+    if [[ ! -e $EDF_FILE ]]; then echo "Error: edf file ($EDF_FILE) does not exist."; exit 1; fi
+
+    echo ""
+    echo " * edf2mit... (Convert EDF to MIT format)"
+    echo " ---------------------------------------------------------"
+    edf2mit -i $EDF_FILE -r $RECORD_WORK_ID
+    if [[ $? -ne 0 ]]; then echo "Error: edf2mit"; exit 1; fi 
+    echo "edf2mit -i $EDF_FILE -r $RECORD_WORK_ID" >> $OUTPUT_COMMANDS
+    fi
 
 echo ""
 echo " * wfdbdesc... (Describe freshly converted WFDB)"
@@ -137,6 +155,12 @@ if [[ $HAS_LEAD2 -eq 1 ]]; then
     echo "Info: leadI and leadII signals are present, process both."
     fi
 
+if [[ $CONVERT_ONLY -eq 1 ]]; then
+    echo ""
+    echo "done (convert only)."
+    exit 0
+    fi
+
 echo ""
 echo " * gqrs..."
 echo " ---------------------------------------------------------"
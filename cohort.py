@@ -0,0 +1,280 @@
+#!/usr/local/bin/python3
+
+import os
+import csv
+import time
+import argparse
+
+import numpy
+
+# Cohort aggregation
+# --------------------------------------------------------------------------------------------
+# Grouped statistics of the output CSV (output.process-kardia.csv), keyed by the fields
+# interpreted from the Kardia comments (GROUP, PATIENT_ID, PRE/POST, DR/PT) and always by
+# QRS_ALGORITHM (one CSV row per record and QRS detector).
+#
+# The CSV is loaded column-wise (numpy arrays), group-bys are done without Python loops on the
+# rows: key columns are encoded once (numpy.unique), combined into one integer code per row,
+# rows sorted by code, and every statistic is a numpy.add.reduceat() over the group boundaries.
+#
+# Summary tables (';' separated, as the output CSV), for each metric: n, mean, std, 95% CI
+# (Student t):
+#  - <prefix>.group.csv              QRS_ALGORITHM, GROUP
+#  - <prefix>.prepost.csv            QRS_ALGORITHM, GROUP, PRE/POST
+#  - <prefix>.drpt.csv               QRS_ALGORITHM, GROUP, DR/PT
+#  - <prefix>.patient-prepost.csv    QRS_ALGORITHM, PATIENT_ID, PRE/POST
+#  - <prefix>.paired-deltas.csv      QRS_ALGORITHM, GROUP, PATIENT_ID: POST mean - PRE mean
+#  - <prefix>.paired.csv             QRS_ALGORITHM, GROUP: statistics of the paired deltas
+# Paired deltas: the PRE and POST means of a patient are matched by (QRS_ALGORITHM, GROUP,
+# PATIENT_ID), patients without an id or without both PRE and POST records are left out.
+
+gMetrics = ['AVNN (msec)', 'SDNN (msec)', 'rMSSD (msec)', 'pNN50 (%)', 'LF/HF (ratio)', 'HEART_RATE (bpm)']
+
+# 95% two-sided Student t quantiles, df 1..30 (above: Cornish-Fisher expansion)
+gT975 = numpy.array([numpy.nan, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+                     2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+                     2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042])
+
+def t975(df): # vectorized, nan for df < 1
+  df = numpy.asarray(df, dtype=numpy.float64)
+  z = 1.959964
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    t = z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2) \
+          + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3)
+  small = df <= 30
+  t[small] = gT975[numpy.clip(df[small], 0, 30).astype(numpy.int64)]
+  t[df < 1] = numpy.nan
+  return t
+
+# loadColumns
+# return {header: numpy array}: metrics as float64 (empty or invalid: nan), others as str
+# --------------------------------------------------------------------------------------------
+def loadColumns(csvFilename, metrics=gMetrics):
+  with open(csvFilename, mode='r', newline='') as f:
+    reader = csv.reader(f, delimiter=';', quotechar='"')
+    headers = next(reader)
+    rows = list(reader)
+
+  columns = {}
+  for i, header in enumerate(headers):
+    column = numpy.array([row[i] if i < len(row) else '' for row in rows])
+    columns[header] = toFloat(column) if header in metrics else column
+  return columns
+
+def toFloat(column): # str array -> float64, nan where not a number
+  try:
+    column = numpy.where(column == '', 'nan', column)
+    return column.astype(numpy.float64)
+  except ValueError:
+    values = numpy.full(len(column), numpy.nan)
+    for i, v in enumerate(column):
+      try: values[i] = float(v)
+      except ValueError: pass
+    return values
+
+def encode(column): # (unique values, index of the value of each row)
+  unique, inverse = numpy.unique(column, return_inverse=True)
+  return unique, inverse.reshape(-1)
+
+class EncodedColumns: # key columns encoded once, shared by all the tables
+  def __init__(self, columns):
+    self.columns = columns
+    self.encoded = {}
+
+  def get(self, header):
+    if header not in self.encoded:
+      self.encoded[header] = encode(self.columns[header])
+    return self.encoded[header]
+
+# groupBy
+# encodedKeys: [(unique, inverse), ...] (see encode())
+# return (keys [unique key array per key column], starts, order): rows of the group g are
+# order[starts[g]:starts[g + 1]]
+# --------------------------------------------------------------------------------------------
+def groupBy(encodedKeys):
+  n = len(encodedKeys[0][1])
+  code = numpy.zeros(n, dtype=numpy.int64)
+  uniques = []
+  for unique, inverse in encodedKeys:
+    code = code * len(unique) + inverse
+    uniques.append(unique)
+
+  order = numpy.argsort(code)
+  sortedCode = code[order]
+  starts = numpy.flatnonzero(numpy.concatenate(([True], sortedCode[1:] != sortedCode[:-1]))) if n else numpy.zeros(0, dtype=numpy.int64)
+
+  # decode the keys of each group
+  groupCode = sortedCode[starts]
+  keys = []
+  for unique in reversed(uniques):
+    keys.insert(0, unique[groupCode % len(unique)])
+    groupCode = groupCode // len(unique)
+  return keys, starts, order
+
+def groupStats(values, starts, order): # {'n', 'mean', 'std', 'ciLow', 'ciHigh'} per group (nan ignored)
+  v = values[order]
+  finite = numpy.isfinite(v)
+  v = numpy.where(finite, v, 0.0)
+  if len(starts) == 0:
+    empty = numpy.zeros(0)
+    return {'n': empty.astype(numpy.int64), 'mean': empty, 'std': empty, 'ciLow': empty, 'ciHigh': empty}
+
+  n = numpy.add.reduceat(finite.astype(numpy.int64), starts)
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    mean = numpy.add.reduceat(v, starts) / n
+    # second pass (deviations from the group mean): no cancellation on large groups
+    sizes = numpy.diff(numpy.append(starts, len(v)))
+    deviations = numpy.where(finite, v - numpy.repeat(mean, sizes), 0.0)
+    std = numpy.sqrt(numpy.add.reduceat(deviations ** 2, starts) / (n - 1))
+    halfWidth = t975(n - 1) * std / numpy.sqrt(n)
+  std[n < 2] = numpy.nan
+  return {'n': n, 'mean': mean, 'std': std, 'ciLow': mean - halfWidth, 'ciHigh': mean + halfWidth}
+
+# aggregateTable
+# return (headers, columns) of the statistics of metrics grouped by keyHeaders
+# --------------------------------------------------------------------------------------------
+def aggregateTable(columns, keyHeaders, metrics, encoded=None):
+  encoded = encoded or EncodedColumns(columns)
+  keys, starts, order = groupBy([encoded.get(h) for h in keyHeaders])
+  headers = list(keyHeaders)
+  table = list(keys)
+  for metric in metrics:
+    stats = groupStats(columns[metric], starts, order)
+    for name in ['n', 'mean', 'std', 'ciLow', 'ciHigh']:
+      headers.append("%s %s" % (metric, name.upper() if name == 'n' else name))
+      table.append(stats[name])
+  return headers, table
+
+# pairedDeltas
+# return (deltaColumns, (headers, table)): per patient POST - PRE means, and their statistics
+# per (QRS_ALGORITHM, GROUP)
+# --------------------------------------------------------------------------------------------
+def pairedDeltas(columns, metrics, encoded=None):
+  encoded = encoded or EncodedColumns(columns)
+  keyHeaders = ['QRS_ALGORITHM', 'GROUP', 'PATIENT_ID']
+  prePost = columns['PRE/POST']
+  patient = columns['PATIENT_ID']
+  selected = (patient != '') & ((prePost == 'PRE') | (prePost == 'POST'))
+  subsetKeys = [(unique, inverse[selected]) for unique, inverse in [encoded.get(h) for h in keyHeaders + ['PRE/POST']]]
+  subset = {metric: columns[metric][selected] for metric in metrics}
+
+  keys, starts, order = groupBy(subsetKeys)
+  means = {metric: groupStats(subset[metric], starts, order)['mean'] for metric in metrics}
+
+  # match PRE / POST groups of a same patient: the patient key code without PRE/POST
+  patientKeys, patientStarts, patientOrder = groupBy([encode(k) for k in keys[:3]]) if len(starts) else ([[], [], []], [], [])
+  patientCode = numpy.zeros(len(starts), dtype=numpy.int64)
+  if len(starts):
+    patientCode[patientOrder] = numpy.repeat(numpy.arange(len(patientStarts)), numpy.diff(numpy.append(patientStarts, len(patientOrder))))
+  isPre = keys[3] == 'PRE' if len(starts) else numpy.zeros(0, dtype=bool)
+  common, preIndexes, postIndexes = numpy.intersect1d(patientCode[isPre], patientCode[~isPre], assume_unique=True, return_indices=True)
+  pre = numpy.flatnonzero(isPre)[preIndexes]
+  post = numpy.flatnonzero(~isPre)[postIndexes]
+
+  deltas = {h: keys[i][pre] for i, h in enumerate(keyHeaders)}
+  for metric in metrics:
+    deltas[metric + ' PRE'] = means[metric][pre]
+    deltas[metric + ' POST'] = means[metric][post]
+    deltas[metric + ' DELTA'] = means[metric][post] - means[metric][pre]
+
+  deltaMetrics = [metric + ' DELTA' for metric in metrics]
+  return deltas, aggregateTable(deltas, ['QRS_ALGORITHM', 'GROUP'], deltaMetrics)
+
+def writeTable(filename, headers, table):
+  with open(filename, mode='w', newline='') as f:
+    writer = csv.writer(f, delimiter=';', quotechar='"', quoting=csv.QUOTE_ALL)
+    writer.writerow(headers)
+    for row in zip(*[formatColumn(column) for column in table]):
+      writer.writerow(row)
+  print("Info: cohort: %d row(s) written to '%s'" % (len(table[0]) if table else 0, filename))
+
+def formatColumn(column):
+  if column.dtype.kind == 'f':
+    return numpy.where(numpy.isfinite(column), numpy.char.mod('%.4f', column), '')
+  return column.astype(str)
+
+# aggregate
+# Write the summary tables of csvFilename (<outputPrefix>.<table>.csv), return True on success
+# --------------------------------------------------------------------------------------------
+gTables = [('group', ['QRS_ALGORITHM', 'GROUP']),
+           ('prepost', ['QRS_ALGORITHM', 'GROUP', 'PRE/POST']),
+           ('drpt', ['QRS_ALGORITHM', 'GROUP', 'DR/PT']),
+           ('patient-prepost', ['QRS_ALGORITHM', 'PATIENT_ID', 'PRE/POST'])]
+
+def aggregate(csvFilename, outputPrefix, metrics=gMetrics):
+  if not os.path.isfile(csvFilename):
+    print("ERROR: cohort: CSV file (%s) does not exist." % (csvFilename))
+    return False
+
+  start = time.perf_counter()
+  columns = loadColumns(csvFilename, metrics)
+  missing = [m for m in metrics if m not in columns]
+  if missing:
+    print("ERROR: cohort: unknown column(s): %s" % (', '.join(missing)))
+    return False
+  print("Info: cohort: %d row(s) loaded in %.2f sec (%s)" % (len(columns['RECORD_NAME']), time.perf_counter() - start, csvFilename))
+
+  writeAggregates(columns, outputPrefix, metrics)
+  print("Info: cohort: done in %.2f sec" % (time.perf_counter() - start))
+  return True
+
+def writeAggregates(columns, outputPrefix, metrics):
+  encoded = EncodedColumns(columns)
+  for name, keyHeaders in gTables:
+    headers, table = aggregateTable(columns, keyHeaders, metrics, encoded)
+    writeTable("%s.%s.csv" % (outputPrefix, name), headers, table)
+
+  deltas, (headers, table) = pairedDeltas(columns, metrics, encoded)
+  deltaHeaders = list(deltas.keys())
+  writeTable("%s.paired-deltas.csv" % (outputPrefix), deltaHeaders, [deltas[h] for h in deltaHeaders])
+  writeTable("%s.paired.csv" % (outputPrefix), headers, table)
+
+# Benchmark
+# --------------------------------------------------------------------------------------------
+def syntheticColumns(nbRows, seed=42):
+  rnd = numpy.random.default_rng(seed)
+  nbPatients = max(1, nbRows // 20)
+  columns = {'RECORD_NAME': numpy.char.mod('r%d', numpy.arange(nbRows)),
+             'QRS_ALGORITHM': rnd.choice(['GQRS', 'ECGPU'], nbRows),
+             'GROUP': rnd.choice(['A', 'B', 'C', ''], nbRows),
+             'PATIENT_ID': numpy.char.mod('%d', rnd.integers(0, nbPatients, nbRows)),
+             'PRE/POST': rnd.choice(['PRE', 'POST', ''], nbRows),
+             'DR/PT': rnd.choice(['DR', 'PT', ''], nbRows)}
+  for metric in gMetrics:
+    columns[metric] = rnd.normal(50, 10, nbRows)
+    columns[metric][rnd.random(nbRows) < 0.01] = numpy.nan
+  return columns
+
+def benchmark(nbRows, outputPrefix):
+  columns = syntheticColumns(nbRows)
+  start = time.perf_counter()
+  encoded = EncodedColumns(columns)
+  for name, keyHeaders in gTables:
+    aggregateTable(columns, keyHeaders, gMetrics, encoded)
+  pairedDeltas(columns, gMetrics, encoded)
+  elapsed = time.perf_counter() - start
+  print("Cohort aggregation: %d rows, %d tables + paired deltas: %.2f sec" % (nbRows, len(gTables), elapsed))
+  if outputPrefix is not None:
+    writeAggregates(columns, outputPrefix, gMetrics)
+  return 0
+
+def main():
+  ap = argparse.ArgumentParser()
+  ap.add_argument("-i", "--input-csv", help="output CSV of process-kardia-records.py")
+  ap.add_argument("-o", "--output-prefix", help="prefix of the summary tables (default: <input without .csv>.cohort)")
+  ap.add_argument("-m", "--metric", action="append", help="column to aggregate (can be repeated, default: %s)" % (', '.join(gMetrics)))
+  ap.add_argument("-b", "--benchmark", type=int, metavar="N", help="benchmark on N synthetic rows")
+  args = vars(ap.parse_args())
+
+  if args['benchmark']:
+    return benchmark(args['benchmark'], args['output_prefix'])
+  if args['input_csv'] is None:
+    print("ERROR: an input CSV (-i) or a benchmark (-b) is required.")
+    return 1
+  outputPrefix = args['output_prefix'] or os.path.splitext(args['input_csv'])[0] + '.cohort'
+  return 0 if aggregate(args['input_csv'], outputPrefix, args['metric'] or gMetrics) else 1
+
+if __name__ == "__main__":
+  ret = main()
+  if not ret: print("done.")
+  exit(ret)
@@ -0,0 +1,169 @@
+#!/usr/local/bin/python3
+
+import re
+import json
+import time
+import random
+import argparse
+
+# Comment rules
+# --------------------------------------------------------------------------------------------
+# Interpretation of the Kardia comments (ZECG.ZCOMMENT) into record fields (prePost, drOrPt,
+# patientId, group, ...). Rules are compiled once, applied in one pass over all the comments
+# of the database, and results are memoized by comment text.
+#
+# Rule types (same format in a rules file, JSON list):
+#  - flag:    {"type": "flag", "field": "prePost", "values": {"PRE": "pre", "POST": "post"}}
+#             each value is a word (or regex) searched as a whole word, case insensitive;
+#             if several values are found, the field is left empty and a warning is reported.
+#  - capture: {"type": "capture", "field": "patientId", "pattern": "\\b([\\d]{3,4})\\b"}
+#             group 1 of the last match in the comment; a later capture rule of the same
+#             field overrides an earlier one when it matches.
+
+gBCCRules = [
+  {'type': 'flag', 'field': 'prePost', 'values': {'PRE': 'pre', 'POST': 'post'}},
+  {'type': 'flag', 'field': 'drOrPt', 'values': {'PT': 'pt', 'DR': 'dr'}},
+  {'type': 'capture', 'field': 'patientId', 'pattern': r'\b([\d]{3,4}-[\d]{2,3})\b'}, # student id
+  {'type': 'capture', 'field': 'patientId', 'pattern': r'\b([\d]{3,4})\b'}, # carpeta id
+]
+
+# CommentRules
+# --------------------------------------------------------------------------------------------
+class CommentRules:
+  def __init__(self, rules=gBCCRules):
+    self.fields = []
+    self.compiled = [] # [(type, field, [(value, regex)]) or (type, field, regex)]
+    self.cache = {} # {comment: (results, warnings)}
+    self.hits = 0
+    self.misses = 0
+
+    for rule in rules:
+      self.addRule(rule)
+
+  def addRule(self, rule):
+    field = rule['field']
+    if field not in self.fields:
+      self.fields.append(field)
+
+    # '.*' prefix (with match()): same semantic as the former findWord(), first line only
+    if rule['type'] == 'flag':
+      values = [(value, re.compile(r".*\b%s\b" % (word), re.I)) for value, word in rule['values'].items()]
+      self.compiled.append(('flag', field, values))
+    elif rule['type'] == 'capture':
+      self.compiled.append(('capture', field, re.compile(r".*" + rule['pattern'], re.I if rule.get('ignoreCase') else 0)))
+    else:
+      raise ValueError("CommentRules: unknown rule type (%s)" % (rule['type']))
+
+    self.cache = {}
+
+  def loadRulesFile(self, filename): # add user defined rules
+    with open(filename, mode='r') as f:
+      for rule in json.load(f):
+        self.addRule(rule)
+
+  def interpret(self, comment): # return (results {field: value}, warnings [...])
+    cached = self.cache.get(comment)
+    if cached is not None:
+      self.hits += 1
+      return cached
+    self.misses += 1
+
+    results = {field: '' for field in self.fields}
+    warnings = []
+
+    if comment is not None:
+      for ruleType, field, rule in self.compiled:
+        if ruleType == 'flag':
+          found = [value for value, regex in rule if regex.match(comment) is not None]
+          if len(found) > 1:
+            warnings.append("both '%s' are specified in comment (%s)" % ("' and '".join(found), comment))
+          elif found:
+            results[field] = found[0]
+        else:
+          m = rule.match(comment)
+          if m is not None:
+            results[field] = m.group(1)
+
+    self.cache[comment] = (results, warnings)
+    return results, warnings
+
+  def interpretAll(self, comments, printWarnings=True): # return {comment: results} (warnings printed once per comment text)
+    interpretations = {}
+    nbWarnings = 0
+    for comment in comments:
+      if comment in interpretations: continue
+      results, warnings = self.interpret(comment)
+      interpretations[comment] = results
+      for warning in warnings:
+        if printWarnings: print("WARNING: tryInterpretComment(): %s" % (warning))
+        nbWarnings += 1
+
+    print("Info: %d distinct comments interpreted (%d warnings)." % (len(interpretations), nbWarnings))
+    return interpretations
+
+# Benchmark
+# --------------------------------------------------------------------------------------------
+def legacyInterpret(comment): # former ToolsBox.tryInterpretCommentForBCC(), without prints
+  def findWord(word, comment):
+    return re.compile(r".*\b%s\b.*" % (word), re.I).match(comment) is not None
+
+  results = {'prePost': '', 'drOrPt': '', 'patientId': ''}
+  hasPre = findWord('pre', comment)
+  hasPost = findWord('post', comment)
+  if hasPre != hasPost: results['prePost'] = 'PRE' if hasPre else 'POST'
+  hasDr = findWord('dr', comment)
+  hasPt = findWord('pt', comment)
+  if hasDr != hasPt: results['drOrPt'] = 'DR' if hasDr else 'PT'
+  m = re.compile(r'.*\b([\d]{3,4}-[\d]{2,3})\b.*').match(comment)
+  if m is not None: results['patientId'] = m.group(1)
+  m = re.compile(r'.*\b([\d]{3,4})\b.*').match(comment)
+  if m is not None: results['patientId'] = m.group(1)
+  return results
+
+def syntheticComments(nbComments, nbDistinct, seed=42):
+  rnd = random.Random(seed)
+  words = ['pre', 'post', 'dr', 'pt', 'control', 'Pre', 'POST', 'seance', 'repos', 'apres', 'avant', 'test']
+  distinct = []
+  for i in range(nbDistinct):
+    parts = rnd.sample(words, rnd.randint(1, 4))
+    if rnd.random() < 0.5: parts.append("%d-%02d" % (rnd.randint(100, 9999), rnd.randint(10, 999)))
+    elif rnd.random() < 0.8: parts.append("%d" % (rnd.randint(100, 9999)))
+    rnd.shuffle(parts)
+    distinct.append(' '.join(parts))
+  return [distinct[rnd.randrange(nbDistinct)] for i in range(nbComments)]
+
+def benchmark(nbComments):
+  comments = syntheticComments(nbComments, max(1, nbComments // 10))
+
+  start = time.time()
+  legacy = [legacyInterpret(c) for c in comments]
+  legacyTime = time.time() - start
+
+  rules = CommentRules()
+  start = time.time()
+  interpretations = rules.interpretAll(comments, False)
+  coldTime = time.time() - start
+
+  start = time.time()
+  rules.interpretAll(comments, False)
+  warmTime = time.time() - start
+
+  identical = all(legacy[i] == interpretations[comments[i]] for i in range(len(comments)))
+
+  print("Comments: %d (%d distinct)" % (len(comments), len(interpretations)))
+  print(" - per call compile (legacy) : %8.1f ms" % (legacyTime * 1000))
+  print(" - rules, one pass (cold)    : %8.1f ms" % (coldTime * 1000))
+  print(" - rules, one pass (memoized): %8.1f ms" % (warmTime * 1000))
+  print(" - identical results         : %s" % (str(identical)))
+  return 0 if identical else 1
+
+def main():
+  ap = argparse.ArgumentParser()
+  ap.add_argument("-b", "--benchmark", type=int, default=100000, metavar="N", help="benchmark on N synthetic comments (default: 100000)")
+  args = vars(ap.parse_args())
+  return benchmark(args['benchmark'])
+
+if __name__ == "__main__":
+  ret = main()
+  if not ret: print("done.")
+  exit(ret)
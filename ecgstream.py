@@ -0,0 +1,479 @@
+#!/usr/local/bin/python3
+
+import os
+import sys
+import json
+import time
+import asyncio
+import resource
+import argparse
+
+import numpy
+
+from qrsdetectors import NumpyQRSDetector
+
+# ECG stream
+# --------------------------------------------------------------------------------------------
+# Live mode: ECG samples are fed continuously (stdin, TCP or Unix socket) and R peaks, heart
+# rate and rolling HRV are emitted as they are detected, instead of files -> calculate.sh -> CSV.
+#
+# Stream: one JSON header line (keys as in the ATC dict), then int16 little endian frames
+# (one sample per lead, interleaved) until the end of the stream:
+#
+#   {"frequency": 300, "amplitudeResolution": 500, "leads": ["leadI", "leadII"]}\n
+#   <int16 leadI><int16 leadII><int16 leadI>...
+#
+# Events: one JSON line per beat on stdout (or -o), messages on stderr:
+#
+#   {"stream": 1, "type": "beat", "sample": 1234, "t": 4.113, "rr": 812.0, "hr": 73.9,
+#    "nn": true, "rmssd": 41.2, "sdnn": 55.0, "nbNN": 71, "latency": 187.3}
+#
+#  - rr / hr: interval with the previous beat (msec) and instantaneous heart rate (bpm),
+#  - nn: the interval is kept by the RR cleaning (range [300, 2000] msec, not ectopic: malik,
+#    20% of the previous interval, see rrtools.py),
+#  - rmssd / sdnn (msec): NN intervals of the last -w seconds (ring buffer, running sums),
+#  - latency (msec): from the arrival of the peak sample to the event.
+#
+# Online QRS detection: the NumpyQRSDetector filters (band-pass, derivative, squaring,
+# integration, see qrsdetectors.py) applied to blocks (-bk msec) with a context of the
+# previous samples; only the samples whose filtered values are final are searched. The
+# threshold is 0.3 x the 99th percentile of the integrated signal of the last 8 sec. A peak is
+# emitted once its 250 ms refractory period is over (a larger peak in it replaces it), so
+# latency <= block + filters half width + refractory period (~0.5 sec at -bk 100).
+#
+# Load generator (-g): synthetic ECG streams (to stdout, or -n connections to -t / -u) at -x
+# times real time (0: as fast as possible). Benchmark (-b): one stream processed in process,
+# sustained samples / sec per core.
+
+gRefractory = 0.25 # sec
+gThresholdSeconds = 8.0
+gContextSeconds = 2.0
+gMaxHeaderLength = 4096
+
+# RingBuffer
+# Fixed capacity float64 buffer (oldest values overwritten), values in arrival order.
+# --------------------------------------------------------------------------------------------
+class RingBuffer:
+  def __init__(self, capacity):
+    self.data = numpy.zeros(max(1, int(capacity)))
+    self.head = 0 # next write position
+    self.count = 0
+
+  def extend(self, values):
+    values = numpy.asarray(values, dtype=numpy.float64)[-len(self.data):]
+    n = len(values)
+    first = min(n, len(self.data) - self.head)
+    self.data[self.head:self.head + first] = values[:first]
+    self.data[:n - first] = values[first:]
+    self.head = (self.head + n) % len(self.data)
+    self.count = min(len(self.data), self.count + n)
+
+  def values(self): # oldest first
+    if self.count < len(self.data):
+      return self.data[:self.count]
+    return numpy.concatenate((self.data[self.head:], self.data[:self.head]))
+
+# StreamingQRSDetector
+# push(block) -> absolute sample indexes of the R peaks confirmed by this block
+# --------------------------------------------------------------------------------------------
+class StreamingQRSDetector:
+  def __init__(self, frequency):
+    self.frequency = frequency
+    self.samples = numpy.zeros(0)
+    self.offset = 0 # absolute index of samples[0]
+    self.searched = 0 # absolute index: the samples before were searched for peaks
+    # filtered values are final this many samples before the end of the buffer (half widths
+    # of the moving averages, + gradient)
+    self.delay = int(numpy.ceil((0.1 + 0.025 + 0.15) / 2 * frequency)) + 2
+    self.context = int(gContextSeconds * frequency)
+    self.refractory = int(gRefractory * frequency)
+    self.integrated = RingBuffer(gThresholdSeconds * frequency)
+    self.candidate = None # (peak, amplitude): not confirmed until its refractory period is over
+    self.nbSamples = 0
+
+  def push(self, block):
+    self.samples = numpy.concatenate((self.samples, numpy.asarray(block, dtype=numpy.float64)))
+    self.nbSamples += len(block)
+    end = self.offset + len(self.samples) - self.delay # final values: [.., end[
+    if self.nbSamples < self.frequency or end <= self.searched:
+      return []
+
+    x = self.samples
+    filtered = x - NumpyQRSDetector.movingAverage(x, 0.1 * self.frequency)
+    filtered = NumpyQRSDetector.movingAverage(filtered, 0.025 * self.frequency)
+    integrated = NumpyQRSDetector.movingAverage(numpy.gradient(filtered) ** 2, 0.15 * self.frequency)
+
+    start = self.searched - self.offset
+    stop = end - self.offset
+    self.integrated.extend(integrated[start:stop])
+    threshold = 0.3 * numpy.percentile(self.integrated.values(), 99)
+
+    # regions above the threshold ended before the final values end
+    above = integrated[start:stop] > threshold
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([False], above, [False])).astype(numpy.int8)))
+    starts, ends = edges[0::2] + start, edges[1::2] + start
+    searched = end
+    if len(ends) and ends[-1] == stop: # region still open: searched again with the next block
+      searched = self.offset + starts[-1]
+      starts, ends = starts[:-1], ends[:-1]
+
+    peaks = []
+    for regionStart, regionEnd in zip(starts, ends):
+      peak = regionStart + int(numpy.argmax(numpy.abs(filtered[regionStart:regionEnd])))
+      amplitude = abs(filtered[peak])
+      peak += self.offset
+      if self.candidate is not None and peak - self.candidate[0] < self.refractory:
+        if amplitude > self.candidate[1]: self.candidate = (peak, amplitude)
+        continue
+      if self.candidate is not None:
+        peaks.append(self.candidate[0])
+      self.candidate = (peak, amplitude)
+    if self.candidate is not None and self.candidate[0] + self.refractory <= searched:
+      peaks.append(self.candidate[0])
+      self.candidate = None
+
+    # keep a context before the samples not searched yet
+    self.searched = searched
+    keep = max(0, self.searched - self.context - self.offset)
+    self.samples = self.samples[keep:]
+    self.offset += keep
+    return peaks
+
+  def flush(self): # end of stream: the last candidate
+    peaks = [self.candidate[0]] if self.candidate is not None else []
+    self.candidate = None
+    return peaks
+
+# RollingHRV
+# NN intervals of the last `window` seconds (ring buffer) with running sums, O(1) per beat.
+# --------------------------------------------------------------------------------------------
+class RollingHRV:
+  def __init__(self, window=60.0, capacity=256, lowRri=300, highRri=2000):
+    self.window = window
+    self.lowRri, self.highRri = lowRri, highRri
+    self.times = numpy.zeros(capacity)
+    self.values = numpy.zeros(capacity)
+    self.squaredDiffs = numpy.full(capacity, numpy.nan) # with the previous NN, if adjacent
+    self.head, self.count = 0, 0 # oldest entry, number of entries
+    self.sum, self.sumSquares, self.sumSquaredDiffs, self.nbDiffs = 0.0, 0.0, 0.0, 0
+    self.lastBeat = None # sec
+    self.lastRR = None # last interval in range (ectopic reference)
+    self.previousNN = False # the previous interval was NN
+
+  def grow(self):
+    order = (self.head + numpy.arange(self.count)) % len(self.times)
+    capacity = 2 * len(self.times)
+    for name in ['times', 'values', 'squaredDiffs']:
+      data = numpy.full(capacity, numpy.nan)
+      data[:self.count] = getattr(self, name)[order]
+      setattr(self, name, data)
+    self.head = 0
+
+  def evict(self, now):
+    while self.count and self.times[self.head] < now - self.window:
+      value, squaredDiff = self.values[self.head], self.squaredDiffs[self.head]
+      self.sum -= value
+      self.sumSquares -= value * value
+      if not numpy.isnan(squaredDiff):
+        self.sumSquaredDiffs -= squaredDiff
+        self.nbDiffs -= 1
+      self.head = (self.head + 1) % len(self.times)
+      self.count -= 1
+
+  def beat(self, t): # return (rr msec or None, nn)
+    if self.lastBeat is None:
+      self.lastBeat = t
+      return None, False
+    rr = 1000.0 * (t - self.lastBeat)
+    self.lastBeat = t
+    inRange = self.lowRri <= rr <= self.highRri
+    ectopic = inRange and self.lastRR is not None and abs(rr - self.lastRR) > 0.2 * self.lastRR
+    if inRange: self.lastRR = rr
+    nn = inRange and not ectopic
+
+    self.evict(t)
+    if nn:
+      if self.count == len(self.times):
+        self.grow()
+      last = (self.head + self.count - 1) % len(self.times)
+      squaredDiff = (rr - self.values[last]) ** 2 if self.previousNN and self.count else numpy.nan
+      i = (self.head + self.count) % len(self.times)
+      self.times[i], self.values[i], self.squaredDiffs[i] = t, rr, squaredDiff
+      self.count += 1
+      self.sum += rr
+      self.sumSquares += rr * rr
+      if not numpy.isnan(squaredDiff):
+        self.sumSquaredDiffs += squaredDiff
+        self.nbDiffs += 1
+    self.previousNN = nn
+    return rr, nn
+
+  def sdnn(self):
+    if self.count < 2: return None
+    return float(numpy.sqrt(max(0.0, (self.sumSquares - self.sum * self.sum / self.count) / (self.count - 1))))
+
+  def rmssd(self):
+    if self.nbDiffs < 1: return None
+    return float(numpy.sqrt(max(0.0, self.sumSquaredDiffs / self.nbDiffs)))
+
+# StreamSession
+# One stream: header, frames -> detector -> HRV -> events
+# --------------------------------------------------------------------------------------------
+class StreamSession:
+  def __init__(self, streamId, header, emit, lead=None, window=60.0, blockMs=100):
+    self.streamId = streamId
+    self.emit = emit # emit(event dict)
+    self.frequency = float(header['frequency'])
+    self.amplitudeResolution = header.get('amplitudeResolution')
+    self.leads = header.get('leads') or ['leadI']
+    self.leadIndex = self.leads.index(lead) if lead in self.leads else 0
+    self.frameSize = 2 * len(self.leads)
+    self.blockSamples = max(1, int(blockMs * self.frequency / 1000))
+    self.detector = StreamingQRSDetector(self.frequency)
+    self.hrv = RollingHRV(window)
+    self.pending = b'' # incomplete frame bytes
+    self.block = [] # arrays of samples not pushed yet
+    self.blockLength = 0
+    self.arrivals = [] # [(absolute index of the first sample of a chunk, arrival time)]
+    self.nbSamples = 0
+    self.nbBeats = 0
+    self.latencies = []
+    self.start = time.perf_counter()
+
+  def feed(self, data): # bytes received
+    now = time.perf_counter()
+    data = self.pending + data
+    size = len(data) - len(data) % self.frameSize
+    self.pending = data[size:]
+    if not size:
+      return
+    samples = numpy.frombuffer(data[:size], dtype='<i2').reshape(-1, len(self.leads))[:, self.leadIndex]
+    self.arrivals.append((self.nbSamples, now))
+    self.nbSamples += len(samples)
+    self.block.append(samples)
+    self.blockLength += len(samples)
+    if self.blockLength >= self.blockSamples:
+      self.process(self.detector.push(numpy.concatenate(self.block)))
+      self.block, self.blockLength = [], 0
+
+  def close(self):
+    peaks = self.detector.push(numpy.concatenate(self.block)) if self.block else []
+    self.process(peaks + self.detector.flush())
+    seconds = time.perf_counter() - self.start
+    self.emit({'stream': self.streamId, 'type': 'end', 'samples': self.nbSamples, 'beats': self.nbBeats,
+               'seconds': round(seconds, 3), 'samplesPerSec': round(self.nbSamples / seconds) if seconds > 0 else None,
+               'maxLatency': round(max(self.latencies), 1) if self.latencies else None})
+
+  def arrival(self, sample): # arrival time of a sample
+    while len(self.arrivals) > 1 and self.arrivals[1][0] <= sample:
+      self.arrivals.pop(0)
+    return self.arrivals[0][1]
+
+  def process(self, peaks):
+    for peak in peaks:
+      t = peak / self.frequency
+      rr, nn = self.hrv.beat(t)
+      latency = 1000.0 * (time.perf_counter() - self.arrival(peak))
+      self.latencies.append(latency)
+      self.nbBeats += 1
+      rmssd, sdnn = self.hrv.rmssd(), self.hrv.sdnn()
+      self.emit({'stream': self.streamId, 'type': 'beat', 'sample': int(peak), 't': round(t, 3),
+                 'rr': round(rr, 1) if rr is not None else None, 'hr': round(60000.0 / rr, 1) if rr else None, 'nn': nn,
+                 'rmssd': round(rmssd, 1) if rmssd is not None else None, 'sdnn': round(sdnn, 1) if sdnn is not None else None,
+                 'nbNN': self.hrv.count, 'latency': round(latency, 1)})
+
+# Server
+# --------------------------------------------------------------------------------------------
+class StreamServer:
+  def __init__(self, output, lead=None, window=60.0, blockMs=100):
+    self.output = output
+    self.lead = lead
+    self.window = window
+    self.blockMs = blockMs
+    self.nbStreams = 0
+    self.nbSamples = 0
+
+  def emit(self, event):
+    self.output.write(json.dumps(event) + '\n')
+    self.output.flush()
+
+  async def handle(self, reader, writer=None):
+    self.nbStreams += 1
+    streamId = self.nbStreams
+    try:
+      line = await reader.readuntil(b'\n')
+      if len(line) > gMaxHeaderLength:
+        raise ValueError("header too long")
+      header = json.loads(line)
+      if 'frequency' not in header:
+        raise ValueError("no frequency in header")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+      print("ERROR: stream %d: invalid header (%s)" % (streamId, str(e)), file=sys.stderr)
+      if writer is not None: writer.close()
+      return
+
+    session = StreamSession(streamId, header, self.emit, self.lead, self.window, self.blockMs)
+    self.emit({'stream': streamId, 'type': 'start', 'frequency': session.frequency, 'amplitudeResolution': session.amplitudeResolution, 'leads': session.leads})
+    while True:
+      data = await reader.read(65536)
+      if not data:
+        break
+      session.feed(data)
+    session.close()
+    self.nbSamples += session.nbSamples
+    if writer is not None: writer.close()
+
+  async def serveStdin(self):
+    reader = asyncio.StreamReader(limit=gMaxHeaderLength)
+    await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+    await self.handle(reader)
+
+  async def serve(self, tcp=None, unixPath=None):
+    if tcp is not None:
+      host, port = tcp.rsplit(':', 1)
+      server = await asyncio.start_server(self.handle, host or '127.0.0.1', int(port), limit=gMaxHeaderLength)
+    else:
+      if os.path.exists(unixPath): os.remove(unixPath)
+      server = await asyncio.start_unix_server(self.handle, unixPath, limit=gMaxHeaderLength)
+    print("Info: listening on %s" % (tcp or unixPath), file=sys.stderr)
+    async with server:
+      await server.serve_forever()
+
+  def printStats(self):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime
+    print("Info: %d stream(s) - %d samples - %.1f CPU sec - %.0f samples/sec per core" %
+          (self.nbStreams, self.nbSamples, cpu, self.nbSamples / cpu if cpu > 0 else 0.0), file=sys.stderr)
+
+# Load generator
+# --------------------------------------------------------------------------------------------
+def syntheticEcg(seconds, frequency=300, nbLeads=2, amplitudeResolution=500, seed=1): # int16 (n, leads), beat samples
+  rnd = numpy.random.default_rng(seed)
+  n = int(seconds * frequency)
+  rr = 0.8 + 0.05 * numpy.sin(numpy.arange(int(seconds / 0.5) + 2) / 5.0) + rnd.normal(0, 0.02, int(seconds / 0.5) + 2)
+  beats = (numpy.cumsum(rr) * frequency).astype(numpy.int64)
+  beats = beats[beats < n - frequency]
+
+  t = numpy.arange(-int(0.05 * frequency), int(0.05 * frequency) + 1)
+  qrs = numpy.exp(-0.5 * (t / (0.012 * frequency)) ** 2) # ~1 mV R wave
+  mv = numpy.zeros(n)
+  for beat in beats:
+    mv[beat + t] += qrs
+  mv += 0.1 * numpy.sin(2 * numpy.pi * 0.3 * numpy.arange(n) / frequency) + rnd.normal(0, 0.02, n) # baseline wander, noise
+  units = mv * 1e6 / amplitudeResolution
+  leads = numpy.stack([units * (1.0 - 0.3 * i) for i in range(nbLeads)], axis=1)
+  return numpy.clip(leads, -32768, 32767).astype('<i2'), beats
+
+def streamHeader(frequency, amplitudeResolution, nbLeads):
+  return (json.dumps({'frequency': frequency, 'amplitudeResolution': amplitudeResolution, 'leads': ['leadI', 'leadII', 'leadIII'][:nbLeads]}) + '\n').encode('utf-8')
+
+async def sendStream(writer, seconds, frequency, speed, seed, chunkMs=50):
+  signals, beats = syntheticEcg(seconds, frequency, seed=seed)
+  writer.write(streamHeader(frequency, 500, signals.shape[1]))
+  chunk = max(1, int(chunkMs * frequency / 1000))
+  start = time.perf_counter()
+  for i in range(0, len(signals), chunk):
+    writer.write(signals[i:i + chunk].tobytes())
+    await writer.drain()
+    if speed > 0: # real time x speed
+      delay = start + (i + chunk) / frequency / speed - time.perf_counter()
+      if delay > 0: await asyncio.sleep(delay)
+  writer.close()
+  return len(signals)
+
+async def generate(seconds, frequency, speed, nbStreams, tcp=None, unixPath=None):
+  async def one(i):
+    if tcp is not None:
+      host, port = tcp.rsplit(':', 1)
+      reader, writer = await asyncio.open_connection(host or '127.0.0.1', int(port))
+    else:
+      reader, writer = await asyncio.open_unix_connection(unixPath)
+    return await sendStream(writer, seconds, frequency, speed, seed=i + 1)
+
+  start = time.perf_counter()
+  nbSamples = sum(await asyncio.gather(*[one(i) for i in range(nbStreams)]))
+  elapsed = time.perf_counter() - start
+  print("Info: sent %d stream(s) - %d samples - %.1f sec - %.0f samples/sec" % (nbStreams, nbSamples, elapsed, nbSamples / elapsed), file=sys.stderr)
+  return 0
+
+def generateToStdout(seconds, frequency, speed):
+  signals, beats = syntheticEcg(seconds, frequency)
+  out = sys.stdout.buffer
+  out.write(streamHeader(frequency, 500, signals.shape[1]))
+  chunk = max(1, int(0.05 * frequency))
+  start = time.perf_counter()
+  for i in range(0, len(signals), chunk):
+    out.write(signals[i:i + chunk].tobytes())
+    if speed > 0:
+      out.flush()
+      delay = start + (i + chunk) / frequency / speed - time.perf_counter()
+      if delay > 0: time.sleep(delay)
+  out.flush()
+  return 0
+
+# benchmark: one synthetic stream processed in process, as fast as possible
+def benchmark(seconds, frequency=300, blockMs=100):
+  signals, beats = syntheticEcg(seconds, frequency)
+  data = streamHeader(frequency, 500, signals.shape[1])
+  events = []
+  session = StreamSession(1, json.loads(data), events.append, blockMs=blockMs)
+  chunk = max(1, int(blockMs * frequency / 1000)) * signals.shape[1] * 2
+  payload = signals.tobytes()
+
+  cpuStart = time.process_time()
+  for i in range(0, len(payload), chunk):
+    session.feed(payload[i:i + chunk])
+  session.close()
+  cpu = time.process_time() - cpuStart
+
+  detected = numpy.array([e['sample'] for e in events if e['type'] == 'beat'])
+  matched = numpy.count_nonzero(numpy.min(numpy.abs(detected[:, None] - beats[None, :]), axis=0) <= 0.05 * frequency) if len(detected) else 0
+  batch = NumpyQRSDetector.findPeaks(signals[:, 0].astype(numpy.float64), frequency)
+  last = [e for e in events if e['type'] == 'beat'][-1] if len(detected) else {}
+  print("Stream: %.0f sec at %d Hz (%d samples), blocks of %d msec" % (seconds, frequency, len(signals), blockMs))
+  print(" - throughput : %10.0f samples/sec per core (%.0fx real time)" % (len(signals) / cpu, len(signals) / cpu / frequency))
+  print(" - beats      : %d detected, %d of %d true beats found (batch npqrs: %d)" % (len(detected), matched, len(beats), len(batch)))
+  print(" - last       : rmssd %s - sdnn %s msec (window: %d NN)" % (last.get('rmssd'), last.get('sdnn'), last.get('nbNN', 0)))
+  return 0
+
+def main():
+  ap = argparse.ArgumentParser()
+  ap.add_argument("-i", "--stdin", action="store_true", help="read one stream from stdin")
+  ap.add_argument("-t", "--tcp", help="listen on (or, with -g, connect to) HOST:PORT")
+  ap.add_argument("-u", "--unix", help="listen on (or, with -g, connect to) this Unix socket")
+  ap.add_argument("-o", "--output", help="events file (default: stdout)")
+  ap.add_argument("-l", "--lead", help="lead of the QRS detection (default: the first one)")
+  ap.add_argument("-w", "--window", type=float, default=60.0, help="rolling HRV window (sec, default: 60)")
+  ap.add_argument("-bk", "--block-ms", type=int, default=100, help="detection block (msec, default: 100)")
+  ap.add_argument("-g", "--generate", type=float, metavar="SECONDS", help="load generator: send synthetic streams of SECONDS (stdout, or -t / -u)")
+  ap.add_argument("-n", "--streams", type=int, default=1, help="load generator: number of concurrent streams (default: 1)")
+  ap.add_argument("-x", "--speed", type=float, default=1.0, help="load generator: times real time (0: as fast as possible, default: 1)")
+  ap.add_argument("-f", "--frequency", type=int, default=300, help="load generator / benchmark: sampling frequency (default: 300)")
+  ap.add_argument("-b", "--benchmark", type=float, metavar="SECONDS", help="benchmark: one synthetic stream of SECONDS processed in process")
+  args = vars(ap.parse_args())
+
+  if args['benchmark']:
+    return benchmark(args['benchmark'], args['frequency'], args['block_ms'])
+  if args['generate']:
+    if args['tcp'] or args['unix']:
+      return asyncio.run(generate(args['generate'], args['frequency'], args['speed'], args['streams'], args['tcp'], args['unix']))
+    return generateToStdout(args['generate'], args['frequency'], args['speed'])
+
+  if not (args['stdin'] or args['tcp'] or args['unix']):
+    print("ERROR: no input (-i, -t or -u).", file=sys.stderr)
+    return 1
+  output = open(args['output'], mode='a') if args['output'] else sys.stdout
+  server = StreamServer(output, args['lead'], args['window'], args['block_ms'])
+  try:
+    asyncio.run(server.serveStdin() if args['stdin'] else server.serve(args['tcp'], args['unix']))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.printStats()
+    if output is not sys.stdout: output.close()
+  return 0
+
+if __name__ == "__main__":
+  ret = main()
+  if not ret: print("done.", file=sys.stderr)
+  exit(ret)
@@ -0,0 +1,332 @@
+#!/usr/local/bin/python3
+
+import os
+import re
+import glob
+import json
+import time
+import shutil
+import tempfile
+import argparse
+
+import numpy
+
+from recordbundle import RecordBundle, parseHeader, parseAnnotationSamples
+
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# ECG tiles
+# --------------------------------------------------------------------------------------------
+# Static HTML viewer of a record (no matplotlib, no server side code): the signals are stored
+# as a min/max pyramid, the page (index.html) fetches only the chunks of the level needed for
+# the current zoom and time range, so that browsing a 24 h recording stays interactive.
+#
+# <workName>.tiles/
+#  - index.json                  {recordId, frequency, nbSamples, leads, gains, baselines,
+#                                 chunkSize, levels: {level: number of entries}, beats}
+#  - <lead>/<level>/<chunk>.bin  int16 (little endian), chunkSize entries per chunk:
+#                                 level 0: the samples, level k: [min, max] of 2^k samples
+#  - beats/<annotator>.bin       int32: sample numbers of the beats (QRS annotations)
+#  - index.html                  the viewer
+#
+# The levels are computed in one pass: level 1 from the samples (all leads at once), each
+# next level from the previous one (pairs of entries), up to the level fitting in one chunk.
+# The page picks the stored level whose 2^k samples are closest below one pixel.
+#
+# The page fetches its files: serve the directory (e.g. python3 -m http.server -d <dir>, and an
+# SSH tunnel to its port), browsers do not allow fetch() on file:// pages.
+
+gChunkSize = 8192
+gMinLevel = 3
+gAnnotatorPattern = re.compile(r'^[a-z0-9_]+-lead[0-9]+$')
+
+def workName(recordName): # record name (data/b6) or work name (data/work/b6) -> work name
+  if os.path.basename(os.path.dirname(recordName)) == 'work':
+    return recordName
+  return os.path.join(CURR_DIR, os.path.dirname(recordName), 'work', os.path.basename(recordName)) # see atc2edf.recordWorkName()
+
+# openRecord
+# return (header, signals: int16 (nbSamples, nbLeads), memory mapped, {annotator: beat samples})
+# --------------------------------------------------------------------------------------------
+def openRecord(workingRname):
+  bundle = RecordBundle.open(workingRname)
+  if bundle is not None:
+    with bundle:
+      header = dict(bundle.index)
+      signals = bundle.digitalSignals()
+      beats = {annotator: bundle.annotationSamples(annotator) for annotator in bundle.index['annotators'] if bundle.has(annotator)}
+    return header, signals, beats
+
+  with open(workingRname + '.hea', mode='r') as f:
+    header = parseHeader(f.read())
+  if any(f != '16' for f in header['formats']):
+    raise ValueError("ecgtiles: only format 16 signals are supported (%s)." % (', '.join(header['formats'])))
+  nbLeads = len(header['leads'])
+  signals = numpy.memmap(workingRname + '.dat', dtype='<i2', mode='r')
+  signals = signals[:len(signals) - len(signals) % nbLeads].reshape(-1, nbLeads)
+
+  beats = {}
+  prefix = workingRname + '.'
+  for path in sorted(glob.glob(glob.escape(prefix) + '*')):
+    annotator = path[len(prefix):]
+    if gAnnotatorPattern.match(annotator):
+      with open(path, mode='rb') as f:
+        beats[annotator] = parseAnnotationSamples(f.read())
+  return header, signals, beats
+
+# pyramid
+# yield (level, entries): level 0: the samples (n, leads), level k >= minLevel: (n / 2^k, leads, 2)
+# min / max (the levels below minLevel are not stored: the page reads at most 2^minLevel samples
+# per pixel, and the pyramid is 1 + 2 / 2^minLevel times the signal)
+# --------------------------------------------------------------------------------------------
+def pyramid(signals, chunkSize=gChunkSize, minLevel=gMinLevel):
+  yield 0, signals
+  low, high = signals, signals
+  level = 0
+  while len(low) > chunkSize:
+    if len(low) % 2: # odd: the last entry is paired with itself
+      low = numpy.concatenate((low, low[-1:]))
+      high = numpy.concatenate((high, high[-1:]))
+    low = numpy.minimum(low[0::2], low[1::2])
+    high = numpy.maximum(high[0::2], high[1::2])
+    level += 1
+    if level >= minLevel:
+      yield level, numpy.stack((low, high), axis=-1)
+
+def writeLevel(directory, leads, level, entries, chunkSize=gChunkSize): # return the number of chunks
+  nbChunks = (len(entries) + chunkSize - 1) // chunkSize
+  for i, lead in enumerate(leads):
+    levelDirectory = os.path.join(directory, lead, str(level))
+    os.makedirs(levelDirectory, exist_ok=True)
+    for chunk in range(nbChunks):
+      data = numpy.ascontiguousarray(entries[chunk * chunkSize:(chunk + 1) * chunkSize, i], dtype='<i2')
+      data.tofile(os.path.join(levelDirectory, "%d.bin" % (chunk)))
+  return nbChunks
+
+# writeTiles
+# return the output directory
+# --------------------------------------------------------------------------------------------
+def writeTiles(workingRname, outputDirectory=None, chunkSize=gChunkSize):
+  outputDirectory = outputDirectory or workingRname + '.tiles'
+  header, signals, beats = openRecord(workingRname)
+  leads = [lead or "lead%d" % (i + 1) for i, lead in enumerate(header['leads'])]
+
+  tmpDirectory = outputDirectory + '.tmp'
+  shutil.rmtree(tmpDirectory, ignore_errors=True)
+  os.makedirs(os.path.join(tmpDirectory, 'beats'))
+
+  levels = {}
+  for level, entries in pyramid(signals, chunkSize):
+    writeLevel(tmpDirectory, leads, level, entries, chunkSize)
+    levels[level] = len(entries)
+
+  for annotator, samples in beats.items():
+    numpy.asarray(samples, dtype='<i4').tofile(os.path.join(tmpDirectory, 'beats', annotator + '.bin'))
+
+  index = {'recordId': os.path.basename(workingRname), 'frequency': header['frequency'], 'nbSamples': len(signals),
+           'leads': leads, 'gains': header['gains'], 'baselines': header['baselines'], 'chunkSize': chunkSize,
+           'levels': levels, 'beats': sorted(beats.keys())}
+  with open(os.path.join(tmpDirectory, 'index.json'), mode='w') as f:
+    json.dump(index, f)
+  with open(os.path.join(tmpDirectory, 'index.html'), mode='w') as f:
+    f.write(gViewerHtml)
+
+  shutil.rmtree(outputDirectory, ignore_errors=True)
+  os.replace(tmpDirectory, outputDirectory)
+  return outputDirectory
+
+# Viewer
+# --------------------------------------------------------------------------------------------
+gViewerHtml = r'''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>ECG</title>
+<style>
+body { font: 12px sans-serif; margin: 0; }
+#bar { padding: 4px 8px; background: #eee; }
+canvas { display: block; width: 100%; height: 160px; border-bottom: 1px solid #ccc; cursor: grab; }
+</style></head>
+<body>
+<div id="bar"><b id="record"></b> - beats: <select id="beats"><option value="">none</option></select>
+ - <span id="range"></span> - drag: pan, wheel: zoom, double click: whole record</div>
+<div id="leads"></div>
+<script>
+"use strict";
+let index = null, view = {start: 0, end: 1}, beats = null, canvases = [], pending = false;
+const cache = new Map(), maxCached = 1024; // {path: Int16Array or null (loading)}
+
+function timeLabel(sec) {
+  const h = Math.floor(sec / 3600), m = Math.floor(sec / 60) % 60, s = sec % 60;
+  return (h ? h + ':' + String(m).padStart(2, '0') : m) + ':' + s.toFixed(sec < 60 ? 2 : 1).padStart(sec < 60 ? 5 : 4, '0');
+}
+
+function chunk(lead, level, c) { // Int16Array, or undefined while loading (draw() again once loaded)
+  const path = lead + '/' + level + '/' + c + '.bin';
+  if (cache.has(path)) return cache.get(path) || undefined;
+  cache.set(path, null);
+  if (cache.size > maxCached) cache.delete(cache.keys().next().value);
+  fetch(path).then(r => r.arrayBuffer()).then(b => { cache.set(path, new Int16Array(b)); redraw(); });
+  return undefined;
+}
+
+function redraw() {
+  if (!pending) { pending = true; requestAnimationFrame(() => { pending = false; draw(); }); }
+}
+
+function drawLead(canvas, l) {
+  const ratio = window.devicePixelRatio || 1, width = canvas.width = canvas.clientWidth * ratio, height = canvas.height = canvas.clientHeight * ratio;
+  const ctx = canvas.getContext('2d'), lead = index.leads[l], size = index.chunkSize;
+  const perPixel = (view.end - view.start) / width;
+  const wanted = Math.floor(Math.log2(Math.max(1, perPixel)));
+  const level = Math.max(...Object.keys(index.levels).map(Number).filter(k => k <= wanted));
+  const factor = 2 ** level, stride = level ? 2 : 1;
+
+  // min / max per pixel column of the entries of the level
+  const low = new Float32Array(width).fill(Infinity), high = new Float32Array(width).fill(-Infinity);
+  const first = Math.max(0, Math.floor(view.start / factor)), last = Math.min(index.levels[level], Math.ceil(view.end / factor));
+  for (let c = Math.floor(first / size); c * size < last; c++) {
+    const data = chunk(lead, level, c);
+    if (!data) continue;
+    const e0 = Math.max(first, c * size), e1 = Math.min(last, c * size + data.length / stride);
+    for (let e = e0; e < e1; e++) {
+      const x = Math.floor((e * factor - view.start) / perPixel), i = (e - c * size) * stride;
+      if (x < 0 || x >= width) continue;
+      low[x] = Math.min(low[x], data[i]);
+      high[x] = Math.max(high[x], data[i + stride - 1]);
+    }
+  }
+  let yMin = Infinity, yMax = -Infinity;
+  for (let x = 0; x < width; x++) if (low[x] <= high[x]) { yMin = Math.min(yMin, low[x]); yMax = Math.max(yMax, high[x]); }
+  if (yMin > yMax) { yMin = -1; yMax = 1; }
+  const margin = 14 * ratio, scale = (height - 2 * margin) / Math.max(1, yMax - yMin);
+  const y = v => height - margin - (v - yMin) * scale;
+
+  ctx.fillStyle = '#fff'; ctx.fillRect(0, 0, width, height);
+  // beats
+  if (beats) {
+    ctx.fillStyle = '#f90';
+    let i = lowerBound(beats, view.start);
+    for (; i < beats.length && beats[i] < view.end; i++) ctx.fillRect(Math.floor((beats[i] - view.start) / perPixel), margin, ratio, height - 2 * margin);
+  }
+  // signal
+  ctx.fillStyle = '#1f4e9c';
+  for (let x = 0; x < width; x++) if (low[x] <= high[x]) ctx.fillRect(x, y(high[x]), ratio, Math.max(ratio, y(low[x]) - y(high[x])));
+  // time ticks, lead, scale
+  ctx.fillStyle = '#000'; ctx.font = (11 * ratio) + 'px sans-serif';
+  const seconds = (view.end - view.start) / index.frequency, step = [0.2, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200].find(s => seconds / s <= 10) || 14400;
+  for (let t = Math.ceil(view.start / index.frequency / step) * step; t * index.frequency < view.end; t += step) {
+    const x = (t * index.frequency - view.start) / perPixel;
+    ctx.fillRect(x, height - margin, ratio, margin / 2);
+    ctx.fillText(timeLabel(t), x + 2 * ratio, height - 2 * ratio);
+  }
+  const gain = index.gains[l], baseline = index.baselines[l];
+  ctx.fillText(lead + '  [' + ((yMin - baseline) / gain).toFixed(2) + ', ' + ((yMax - baseline) / gain).toFixed(2) + '] mV  level ' + level, 4 * ratio, 11 * ratio);
+}
+
+function lowerBound(array, value) {
+  let lo = 0, hi = array.length;
+  while (lo < hi) { const mid = (lo + hi) >> 1; if (array[mid] < value) lo = mid + 1; else hi = mid; }
+  return lo;
+}
+
+function draw() {
+  canvases.forEach(drawLead);
+  document.getElementById('range').textContent = timeLabel(view.start / index.frequency) + ' - ' + timeLabel(view.end / index.frequency);
+}
+
+function setView(start, end) {
+  const span = Math.min(index.nbSamples, Math.max(16, end - start));
+  start = Math.max(0, Math.min(index.nbSamples - span, start));
+  view = {start: start, end: start + span};
+  redraw();
+}
+
+async function main() {
+  index = await (await fetch('index.json')).json();
+  document.getElementById('record').textContent = index.recordId;
+  view = {start: 0, end: index.nbSamples};
+  const select = document.getElementById('beats');
+  for (const annotator of index.beats) select.add(new Option(annotator, annotator));
+  select.onchange = async () => {
+    beats = select.value ? new Int32Array(await (await fetch('beats/' + select.value + '.bin')).arrayBuffer()) : null;
+    redraw();
+  };
+  if (index.beats.length) { select.value = index.beats[0]; select.onchange(); }
+
+  for (let l = 0; l < index.leads.length; l++) {
+    const canvas = document.createElement('canvas');
+    document.getElementById('leads').appendChild(canvas);
+    canvases.push(canvas);
+    let drag = null;
+    canvas.onmousedown = e => { drag = {x: e.clientX, start: view.start}; };
+    window.addEventListener('mouseup', () => { drag = null; });
+    window.addEventListener('mousemove', e => {
+      if (drag) setView(drag.start - (e.clientX - drag.x) * (view.end - view.start) / canvas.clientWidth, drag.start - (e.clientX - drag.x) * (view.end - view.start) / canvas.clientWidth + view.end - view.start);
+    });
+    canvas.onwheel = e => {
+      e.preventDefault();
+      const at = view.start + (view.end - view.start) * e.offsetX / canvas.clientWidth, zoom = e.deltaY > 0 ? 1.25 : 0.8;
+      setView(at - (at - view.start) * zoom, at + (view.end - at) * zoom);
+    };
+    canvas.ondblclick = () => setView(0, index.nbSamples);
+  }
+  window.onresize = redraw;
+  redraw();
+}
+main();
+</script>
+</body></html>
+'''
+
+# Benchmark
+# --------------------------------------------------------------------------------------------
+def benchmark(hours, frequency=300, nbLeads=2, chunkSize=gChunkSize):
+  nbSamples = int(hours * 3600 * frequency)
+  rnd = numpy.random.default_rng(42)
+  signals = (200 * numpy.sin(numpy.arange(nbSamples)[:, None] / 50.0) + rnd.normal(0, 20, (nbSamples, nbLeads))).astype('<i2')
+
+  with tempfile.TemporaryDirectory(prefix='ecgtiles-') as directory:
+    start = time.perf_counter()
+    levels = [(level, len(entries)) for level, entries in pyramid(signals, chunkSize)]
+    pyramidSeconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    nbChunks = sum(writeLevel(directory, ["lead%d" % (i + 1) for i in range(nbLeads)], level, entries, chunkSize) for level, entries in pyramid(signals, chunkSize))
+    writeSeconds = time.perf_counter() - start
+    size = sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(directory) for f in files)
+
+  print("Tiles: %.1f h, %d Hz, %d leads (%d samples)" % (hours, frequency, nbLeads, nbSamples))
+  print(" - levels     : %d (top: %d entries)" % (len(levels), levels[-1][1]))
+  print(" - pyramid    : %8.3f sec" % (pyramidSeconds))
+  print(" - write      : %8.3f sec (%d chunks, %.1f MB, signal: %.1f MB)" % (writeSeconds, nbChunks, size / 1e6, signals.nbytes / 1e6))
+  return 0
+
+def main():
+  ap = argparse.ArgumentParser()
+  ap.add_argument("-r", "--records", nargs='+', help="record names (e.g. data/b6) or work names (data/work/b6)")
+  ap.add_argument("-o", "--output", help="output directory (one record only, default: <workName>.tiles)")
+  ap.add_argument("-c", "--chunk-size", type=int, default=gChunkSize, help="entries per chunk (default: %d)" % (gChunkSize))
+  ap.add_argument("-b", "--benchmark", type=float, metavar="HOURS", help="benchmark on a synthetic recording of HOURS hours")
+  args = vars(ap.parse_args())
+
+  if args['benchmark']:
+    return benchmark(args['benchmark'], chunkSize=args['chunk_size'])
+  if not args['records']:
+    print("ERROR: no record (-r).")
+    return 1
+  if args['output'] and len(args['records']) > 1:
+    print("ERROR: -o with one record only.")
+    return 1
+
+  ret = 0
+  for recordName in args['records']:
+    try:
+      directory = writeTiles(workName(recordName), args['output'], args['chunk_size'])
+      print("Info: %s: viewer in '%s' (serve it, e.g.: python3 -m http.server -d %s)" % (recordName, directory, directory))
+    except (OSError, ValueError) as e:
+      print("ERROR: %s: %s" % (recordName, str(e)))
+      ret = 1
+  return ret
+
+if __name__ == "__main__":
+  ret = main()
+  if not ret: print("done.")
+  exit(ret)
@@ -0,0 +1,129 @@
+#!/usr/local/bin/python3
+
+import os
+import json
+import time
+import errno
+import random
+import asyncio
+
+# Record failures
+# --------------------------------------------------------------------------------------------
+# Failures of the conversion / calculation chain of a record, by class (stage of the chain):
+#  - decode:  ATC decoding (atc2json, atc2edf.py)
+#  - convert: MIT record (edf2mit, wfdbdesc, rdsamp)
+#  - detect:  QRS detection (gqrs, ecgpuwave, ...)
+#  - hrv:     RR and HRV (ann2rr, get_hrv)
+#  - render:  ECG image (record-viewer.py)
+#
+# Transient I/O errors (OSError with an errno of gTransientErrnos, e.g. an NFS hiccup or a
+# fork failing under load, and TransientError: e.g. a worker server whose worker died or which
+# dropped the connection) are retried (retry(), exponential backoff with jitter); the other
+# failures and the timeouts are not.
+#
+# Quarantine (output.process-kardia.quarantine.json, one per shard): a record that timed out,
+# or failed in maxFailures runs in a row, is skipped by the next runs (-Q to retry them).
+# A success clears the failures of the record.
+
+gFailureClasses = ['decode', 'convert', 'detect', 'hrv', 'render']
+
+gTransientErrnos = set([errno.EIO, errno.EAGAIN, errno.EBUSY, errno.ETIMEDOUT, errno.ESTALE, errno.EINTR,
+                        errno.ENFILE, errno.EMFILE, errno.ENOMEM])
+
+class TransientError(Exception): pass # a stage failed for a reason worth retrying
+
+def isTransient(exception):
+  if isinstance(exception, TransientError):
+    return True
+  return isinstance(exception, OSError) and exception.errno in gTransientErrnos
+
+# retry
+# await coroutineFunction(), retried on transient errors (at most attempts times)
+# ------------------------------------------------------------------------------------------
+async def retry(coroutineFunction, attempts=3, backoff=0.5, maxBackoff=8.0, onRetry=None):
+  for attempt in range(1, attempts + 1):
+    try:
+      return await coroutineFunction()
+    except Exception as e:
+      if not isTransient(e) or attempt == attempts:
+        raise
+      delay = min(maxBackoff, backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+      if onRetry is not None:
+        onRetry(attempt, delay, e)
+      await asyncio.sleep(delay)
+
+# RecordFailure
+# --------------------------------------------------------------------------------------------
+class RecordFailure(Exception):
+  def __init__(self, failureClass, reason, timeout=False):
+    super().__init__("%s: %s" % (failureClass, reason))
+    self.failureClass = failureClass
+    self.reason = reason
+    self.timeout = timeout
+
+# Quarantine
+# --------------------------------------------------------------------------------------------
+class Quarantine:
+  def __init__(self, filename, maxFailures=2, clear=False):
+    self.filename = filename
+    self.maxFailures = maxFailures
+    self.records = {} # {recordName: {'class', 'reason', 'failures', 'quarantined', 'time'}}
+    if os.path.isfile(filename) and not clear:
+      with open(filename, mode='r') as f:
+        self.records = json.load(f)
+    elif clear and os.path.isfile(filename):
+      print("Info: quarantine cleared (%s)." % (filename))
+
+  def isQuarantined(self, recordName):
+    record = self.records.get(recordName)
+    return record is not None and record['quarantined']
+
+  def quarantined(self): return sorted([name for name, r in self.records.items() if r['quarantined']])
+
+  def failed(self, recordName, failure): # return True if the record is now quarantined
+    record = self.records.setdefault(recordName, {'failures': 0, 'quarantined': False})
+    record['failures'] += 1
+    record['class'] = failure.failureClass
+    record['reason'] = failure.reason
+    record['time'] = time.time()
+    record['quarantined'] = failure.timeout or record['failures'] >= self.maxFailures
+    return record['quarantined']
+
+  def succeeded(self, recordName):
+    self.records.pop(recordName, None)
+
+  def write(self):
+    tmpFilename = self.filename + '.tmp'
+    with open(tmpFilename, mode='w') as f:
+      json.dump(self.records, f, indent=1, sort_keys=True)
+    os.replace(tmpFilename, self.filename)
+
+# FailureReport
+# --------------------------------------------------------------------------------------------
+class FailureReport:
+  def __init__(self):
+    self.ok = []
+    self.failures = {c: [] for c in gFailureClasses} # {class: [(recordName, reason), ...]}
+    self.skipped = [] # quarantined records not processed
+    self.newlyQuarantined = []
+    self.lowQuality = [] # records below the signal quality threshold (QRS detection and HRV skipped)
+
+  def addFailure(self, recordName, failure):
+    self.failures.setdefault(failure.failureClass, []).append((recordName, failure.reason))
+
+  def nbFailed(self): return len(set([name for failures in self.failures.values() for name, reason in failures]))
+
+  def printReport(self):
+    print("Info: records: %d ok - %d failed - %d skipped (quarantined) - %d newly quarantined - %d below the signal quality threshold" % (len(self.ok), self.nbFailed(), len(self.skipped), len(self.newlyQuarantined), len(self.lowQuality)))
+    for failureClass, failures in self.failures.items():
+      if not failures:
+        continue
+      print("Info: failures - %s: %d" % (failureClass, len(failures)))
+      for recordName, reason in failures:
+        print("Info:   %s: %s" % (recordName, reason))
+    for recordName in self.newlyQuarantined:
+      print("WARNING: record quarantined (skipped by the next runs, -Q to retry): %s" % (recordName))
+
+  def write(self, filename):
+    with open(filename, mode='w') as f:
+      json.dump({'ok': len(self.ok), 'failures': self.failures, 'skipped': self.skipped, 'quarantined': self.newlyQuarantined, 'lowQuality': self.lowQuality}, f, indent=1)
@@ -0,0 +1,112 @@
+#!/usr/local/bin/python3
+
+import json
+import time
+import sqlite3
+import hashlib
+import collections
+
+import numpy
+
+# HRV features cache
+# --------------------------------------------------------------------------------------------
+# Two levels: an in-memory LRU and an on-disk SQLite store, both bounded in number of entries
+# (least recently used entries are evicted first; the disk entries are counted once, on open,
+# not on each insert). The key is a hash of the RR series (msec, as given to hrvanalysis), of
+# the feature extraction parameters and of the hrvanalysis version: a rerun on unchanged RR
+# files does not compute any feature.
+
+def hrvAnalysisVersion():
+  try:
+    from importlib import metadata
+    return metadata.version('hrv-analysis')
+  except Exception:
+    return 'unknown'
+
+class HRVFeatureCache:
+  def __init__(self, filename=None, maxMemoryEntries=4096, maxDiskEntries=200000):
+    self.filename = filename
+    self.maxMemoryEntries = maxMemoryEntries
+    self.maxDiskEntries = maxDiskEntries
+    self.memory = collections.OrderedDict() # {key: features}
+    self.version = hrvAnalysisVersion()
+    self.stats = {'memoryHits': 0, 'diskHits': 0, 'misses': 0, 'evictions': 0}
+
+    self.conn = None
+    if filename is not None:
+      self.conn = sqlite3.connect(filename)
+      self.conn.execute("create table if not exists features (key text primary key, features text, lastUsed real)")
+      self.conn.execute("create index if not exists features_lastUsed on features (lastUsed)")
+      self.conn.commit()
+      self.diskEntries = self.conn.execute("select count(*) from features").fetchone()[0] # then kept up to date by put()
+
+  def __del__(self):
+    self.close()
+
+  def close(self):
+    if self.conn is not None:
+      self.conn.commit()
+      self.conn.close()
+      self.conn = None
+
+  def key(self, rrValues, params):
+    h = hashlib.sha256()
+    h.update(numpy.ascontiguousarray(rrValues, dtype=numpy.int64).tobytes())
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    h.update(self.version.encode('utf-8'))
+    return h.hexdigest()
+
+  def remember(self, key, features):
+    self.memory[key] = features
+    self.memory.move_to_end(key)
+    while len(self.memory) > self.maxMemoryEntries:
+      self.memory.popitem(last=False)
+      self.stats['evictions'] += 1
+
+  def get(self, key): # return features or None
+    if key in self.memory:
+      self.memory.move_to_end(key)
+      self.stats['memoryHits'] += 1
+      return self.memory[key]
+
+    if self.conn is not None:
+      row = self.conn.execute("select features from features where key=?", (key,)).fetchone()
+      if row is not None:
+        self.conn.execute("update features set lastUsed=? where key=?", (time.time(), key))
+        features = json.loads(row[0])
+        self.remember(key, features)
+        self.stats['diskHits'] += 1
+        return features
+
+    self.stats['misses'] += 1
+    return None
+
+  def put(self, key, features):
+    self.remember(key, features)
+    if self.conn is None:
+      return
+
+    if self.conn.execute("update features set features=?, lastUsed=? where key=?", (json.dumps(features), time.time(), key)).rowcount == 0:
+      self.conn.execute("insert into features (key, features, lastUsed) values (?, ?, ?)", (key, json.dumps(features), time.time()))
+      self.diskEntries += 1
+    if self.diskEntries > self.maxDiskEntries:
+      excess = self.diskEntries - self.maxDiskEntries
+      evicted = self.conn.execute("delete from features where key in (select key from features order by lastUsed limit ?)", (excess,)).rowcount
+      self.diskEntries -= evicted
+      self.stats['evictions'] += evicted
+    self.conn.commit()
+
+  def getOrCompute(self, rrValues, params, compute): # compute(): return {domain: {feature: value}}
+    key = self.key(rrValues, params)
+    features = self.get(key)
+    if features is None:
+      features = {}
+      for domain, values in compute().items():
+        features[domain] = {k: float(v) for k, v in values.items()}
+      self.put(key, features)
+    return features
+
+  def printStats(self):
+    s = self.stats
+    total = s['memoryHits'] + s['diskHits'] + s['misses']
+    print("Info: HRV features cache: %d lookups - %d memory hits - %d disk hits - %d misses - %d evictions" % (total, s['memoryHits'], s['diskHits'], s['misses'], s['evictions']))
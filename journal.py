@@ -0,0 +1,115 @@
+#!/usr/local/bin/python3
+
+import os
+import json
+import time
+
+# Run journal
+# --------------------------------------------------------------------------------------------
+# Append-only JSON-lines file of the progress of a batch run (output.process-kardia.journal.jsonl,
+# one per shard), so that an interrupted or crashed run can be resumed (-r):
+#
+#   {"t": 1700000000.0, "record": "data/b6", "stage": "convert"}
+#   {"t": ..., "record": "data/b6", "stage": "wfdb"}
+#   {"t": ..., "record": "data/b6", "stage": "render"}
+#   {"t": ..., "record": "data/b6", "stage": "done", "results": {...}}    (or "failed")
+#
+# A stage line is written once the stage succeeded. On resume, records 'done' are skipped,
+# the other ones restart after their last completed stages ('failed' records are retried).
+#
+# Lines are flushed at once and fsync'ed in batches (every syncEvery lines or syncInterval
+# seconds, and on close): a crash loses at most the last batch, i.e. some records are
+# processed again. A truncated last line (crash while writing) is ignored.
+
+gDoneStages = ['done', 'failed']
+
+class Journal:
+  def __init__(self, filename, resume=False, syncEvery=32, syncInterval=5.0):
+    self.filename = filename
+    self.syncEvery = syncEvery
+    self.syncInterval = syncInterval
+    self.records = {} # {recordName: {'stages': set(), 'status': None / 'done' / 'failed', 'results': ...}}
+    self.unsynced = 0
+    self.lastSync = time.time()
+
+    if resume and os.path.isfile(filename):
+      self.load()
+      print("Info: journal: resuming (%s): %d record(s) done, %d failed, %d in progress" % (filename, self.count('done'), self.count('failed'), self.count(None)))
+    elif os.path.isfile(filename):
+      print("Info: journal: previous journal (%s) replaced (use -r to resume)." % (filename))
+    self.file = open(filename, mode='a' if resume else 'w')
+    if resume and self.file.tell() > 0:
+      with open(filename, mode='rb') as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+          self.file.write('\n') # end the truncated line
+
+  def __enter__(self): return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+    return False
+
+  def load(self):
+    with open(self.filename, mode='r') as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue # truncated line
+        self.apply(entry)
+
+  def apply(self, entry):
+    record = self.records.setdefault(entry['record'], {'stages': set(), 'status': None, 'results': None})
+    if entry['stage'] in gDoneStages:
+      record['status'] = entry['stage']
+      record['results'] = entry.get('results')
+    else:
+      record['stages'].add(entry['stage'])
+
+  def count(self, status): return len([r for r in self.records.values() if r['status'] == status])
+
+  # readers
+  # ------------------------------------------------------------------------------------------
+  def isDone(self, recordName): return self.status(recordName) == 'done'
+
+  def status(self, recordName):
+    record = self.records.get(recordName)
+    return record['status'] if record is not None else None
+
+  def hasStage(self, recordName, stage):
+    record = self.records.get(recordName)
+    return record is not None and stage in record['stages']
+
+  def finishedRecords(self): return [name for name, r in self.records.items() if r['status'] in gDoneStages]
+
+  # writers
+  # ------------------------------------------------------------------------------------------
+  def append(self, recordName, stage, **fields):
+    entry = {'t': round(time.time(), 3), 'record': recordName, 'stage': stage}
+    entry.update(fields)
+    self.apply(entry)
+    self.file.write(json.dumps(entry) + '\n')
+    self.file.flush()
+    self.unsynced += 1
+    if self.unsynced >= self.syncEvery or time.time() - self.lastSync >= self.syncInterval:
+      self.sync()
+
+  def stageDone(self, recordName, stage): self.append(recordName, stage)
+
+  def recordDone(self, recordName, results=None): self.append(recordName, 'done', results=results)
+
+  def recordFailed(self, recordName, results=None): self.append(recordName, 'failed', results=results)
+
+  def sync(self):
+    if self.file is not None and self.unsynced:
+      self.file.flush()
+      os.fsync(self.file.fileno())
+    self.unsynced = 0
+    self.lastSync = time.time()
+
+  def close(self):
+    if self.file is not None:
+      self.sync()
+      self.file.close()
+      self.file = None
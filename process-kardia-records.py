@@ -4,23 +4,44 @@ import sys
 import os
 import subprocess
 import signal
+import socket
 import argparse
 import csv
+import json
+import hashlib
 import datetime
 import re
+import math
 import copy
+import asyncio
 from concurrent import futures
-import multiprocessing
 
 import sqlite3
 
+from qrsdetectors import RecordSignal, getQRSDetector, getQRSDetectorNames
+from wfdbexec import WfdbExecutor
+from scheduler import ResourceScheduler, recordSamples
+from sharedsignals import SharedSignal, leadsFromAtcDict, cleanupStaleSharedSignals
+from workerserver import WorkerClient, gDefaultSocket
+from commentrules import CommentRules
+from hrvcache import HRVFeatureCache
+from recordbundle import RecordBundle
+from rrtools import cleanRR, filtNN, timeDomain, nonlinear
+from shards import parseShard, shardFilename, manifestFilename, selectShard, Manifest, mergeShards
+from journal import Journal
+import cohort
+from failures import RecordFailure, TransientError, Quarantine, FailureReport, isTransient, retry
+from recordlog import LogPipeline
+from resultsdb import ResultsDB
+from signalquality import recordQuality, readWorkSignals, writeQuality, readQuality, gSqiExtension, gDefaultThreshold
+
 # https://github.com/Aura-healthcare/hrv-analysis
 from hrvanalysis import remove_outliers, remove_ectopic_beats, interpolate_nan_values, get_time_domain_features, get_frequency_domain_features, get_poincare_plot_features, plot_poincare
 
 CURR_DIR = os.path.dirname(os.path.realpath(__file__))
 
 gDebug = False
-gMaxWorkers = multiprocessing.cpu_count() * 2
+gCommentRules = CommentRules()
 
 # Finder
 # --------------------------------------------------------------------------------------------
@@ -47,17 +68,6 @@ class Finder:
 
     return d
 
-class QRSAlgorithms:
-  NONE = 0x00
-  GQRS = 0x01
-  ECGPU = 0x10
-
-  def hasGQRS(flags): return True if flags & QRSAlgorithms.GQRS else False
-  def hasECGPU(flags): return True if flags & QRSAlgorithms.ECGPU else False
-
-  def setGQRS(flags): return flags | QRSAlgorithms.GQRS
-  def setECGPU(flags): return flags | QRSAlgorithms.ECGPU
-
 class ToolsBox:
 
   def __init__(self): pass 
@@ -97,53 +107,12 @@ class ToolsBox:
     print("ERROR: filenameToRecordName: Unable to convert filename (%s)" % (filename))
     return None
 
-  # Comments relative to BCC studentId and patientId notations
-  def tryInterpretCommentForBCC(self, comment):
+  # Comments relative to BCC studentId and patientId notations (see commentrules.py)
+  def tryInterpretCommentForBCC(self, comment, commentRules=None):
     #print("DEBUG: interpreting comment: '%s'" % (comment))
-
-    def findWord(word, comment):
-
-      try: m = re.compile(r".*\b%s\b.*" % (word), re.I).match(comment)
-      except:
-        print("ERROR: Exception while compile() and match() comment: '%s'" % (comment))
-        return False
-
-      if m is None: return False
-      else: return True
-
-    results = {'prePost': '', 'drOrPt': '', 'patientId': ''}
-
-    if comment is None: return results
-
-    # check pre/post
-    hasPre = findWord('pre', comment)
-    hasPost = findWord('post', comment)
-    if hasPre and hasPost:
-      print("WARNING: tryInterpretComment(): both 'pre' and 'post' are specified in comment (%s)" % (comment))
-    else:
-      if hasPre or hasPost:
-        if hasPre: results['prePost'] = 'PRE'
-        if hasPost: results['prePost'] = 'POST'
-
-    # check dr/pt
-    hasDr = findWord('dr', comment)
-    hasPt = findWord('pt', comment)
-    if hasPt and hasDr:
-      print("WARNING: tryInterpretComment(): both 'dr' and 'pt' are specified in comment (%s)" % (comment))
-    else:
-      if hasPt or hasDr:
-        if hasPt: results['drOrPt'] = 'PT'
-        if hasDr: results['drOrPt'] = 'DR'
-
-    # check patientId
-    hasStudentId = re.compile(r'.*\b([\d]{3,4}-[\d]{2,3})\b.*').match(comment)
-    if hasStudentId is not None:
-      results['patientId'] = hasStudentId.group(1)
-
-    hasCarpetaId = re.compile(r'.*\b([\d]{3,4})\b.*').match(comment)
-    if hasCarpetaId is not None:
-      results['patientId'] = hasCarpetaId.group(1)
-
+    results, warnings = (commentRules or gCommentRules).interpret(comment)
+    for warning in warnings:
+      print("WARNING: tryInterpretComment(): %s" % (warning))
     return results
 
 toolsBox = ToolsBox()
@@ -151,8 +120,27 @@ toolsBox = ToolsBox()
 # HRVAnalysis
 # --------------------------------------------------------------------------------------------
 class HRVAnalysis:
-  def __init__(self):
-    pass
+  # feature extraction parameters (part of the cache key)
+  frequencyDomainParams = {'method': 'welch', 'sampling_frequency': 4, 'interpolation_method': 'linear'}
+  # RR cleaning before the features (see rrtools.py)
+  cleaningParams = {'lowRri': 300, 'highRri': 2000, 'ectopicMethod': 'malik'}
+  # filtnn windowed filter (as get_hrv -f "0.2 20 -x 0.4 2.0"), on the raw RR (see rrtools.py)
+  filtnnParams = {'filt': 0.2, 'hwin': 20, 'low': 0.4, 'high': 2.0}
+  # sample / approximate entropy (templates of m intervals, tolerance r x SD) and DFA alpha1 /
+  # alpha2, on the NN series (see rrtools.py)
+  nonlinearParams = {'m': 2, 'r': 0.2}
+
+  def __init__(self, cache=None, cleanRR=True):
+    self.cache = cache # HRVFeatureCache or None
+    self.cleanRR = cleanRR
+
+  def featuresParams(self):
+    params = {'features': ['time_domain', 'freq_domain', 'poincare_plot'], 'freq_domain': HRVAnalysis.frequencyDomainParams}
+    if self.cleanRR:
+      params['cleaning'] = HRVAnalysis.cleaningParams
+    params['filtnn'] = HRVAnalysis.filtnnParams
+    params['nonlinear'] = HRVAnalysis.nonlinearParams
+    return params
   
   def readKubiosRR(self, rrKubiosCsvFile): # ([time1, time2, ...], [value1, value2, ...])
     rrTimes = []
@@ -228,40 +216,59 @@ class HRVAnalysis:
 
     rrValuesMsec = listSecToMsec(rrValues)
 
-    results = {}
-    results['time_domain'] = get_time_domain_features(rrValuesMsec)
-    results['freq_domain'] = get_frequency_domain_features(rrValuesMsec)
-    results['poincare_plot'] = get_poincare_plot_features(rrValuesMsec)
-
-    return results
+    def compute():
+      results = {}
+      nnValuesMsec = rrValuesMsec
+      if self.cleanRR:
+        nnValuesMsec, results['cleaning'] = cleanRR(rrValuesMsec, **HRVAnalysis.cleaningParams)
+        nnValuesMsec = list(nnValuesMsec)
+      results['time_domain'] = get_time_domain_features(nnValuesMsec)
+      results['freq_domain'] = get_frequency_domain_features(nnValuesMsec, **HRVAnalysis.frequencyDomainParams)
+      results['poincare_plot'] = get_poincare_plot_features(nnValuesMsec)
+      results['nonlinear'] = nonlinear(nnValuesMsec, **HRVAnalysis.nonlinearParams)
+
+      # filtered series, side by side with the unfiltered one
+      kept = filtNN(rrValues, **HRVAnalysis.filtnnParams)
+      results['filtnn'] = timeDomain(rrValuesMsec, kept)
+      filteredMsec = [v for v, k in zip(rrValuesMsec, kept) if k]
+      results['filtnn_freq_domain'] = get_frequency_domain_features(filteredMsec, **HRVAnalysis.frequencyDomainParams) if len(filteredMsec) > 1 else {}
+      return results
+
+    if self.cache is None:
+      return compute()
+    return self.cache.getOrCompute(rrValuesMsec, self.featuresParams(), compute)
 
   def calculateHrv(self, qrsAlgo, recordName):
-    samplesCsvFile = toolsBox.getRecordWorkFilename(recordName, ".output.samples.txt")
+    # bundled record (see recordbundle.py): RR read from the bundle
+    bundle = RecordBundle.open(toolsBox.getRecordWorkFilename(recordName, ""))
+    if bundle is not None:
+      with bundle:
+        annotator = '%s-lead1' % (qrsAlgo)
+        if not bundle.hasAnnotator(annotator):
+          print("ERROR: record bundle has no rr-kubios-%s (%s)." % (qrsAlgo, bundle.filename))
+          return None
+        timesLead1, valuesLead1 = bundle.rr(annotator)
+      return self.hrvAnalysis(None, None, list(timesLead1), list(valuesLead1))
+
     rrKubiosLead1File = toolsBox.getRecordWorkFilename(recordName, ".%s-lead1.rr.kubios.txt" % (qrsAlgo))
 
-    if not os.path.isfile(samplesCsvFile):
-      print("ERROR: record samples file does not exists (%s)." % (samplesCsvFile))
-      return None
     if not os.path.isfile(rrKubiosLead1File):
       print("ERROR: record rr-kubios-%s file does not exists (%s)." % (qrsAlgo, rrKubiosLead1File))
       return None
 
-    times, samples = self.readSamples(samplesCsvFile)
+    # the samples are not needed by hrvAnalysis() (and not written in shared memory mode)
     timesLead1, valuesLead1 = self.readKubiosRR(rrKubiosLead1File)
 
-    return self.hrvAnalysis(times, samples['leadI'], timesLead1, valuesLead1)
+    return self.hrvAnalysis(None, None, timesLead1, valuesLead1)
 
   def updateRecordFromHrvAnalysis(self, qrsAlgo, recordName, rec):
 
-    hrv = None
-    if qrsAlgo == 'gqrs':
-      hrv = self.calculateHrv('gqrs', recordName)
-    elif qrsAlgo == 'ecgpu':
-      hrv = self.calculateHrv('ecgpu', recordName)
-    else:
+    if qrsAlgo not in getQRSDetectorNames():
       print("ERROR: updateRecordFromHrvAnalysis(): Unsupported QRS algo (%s)" % (qrsAlgo))
       return None
 
+    hrv = self.calculateHrv(qrsAlgo, recordName)
+
     if hrv is None:
       return None
 
@@ -285,6 +292,16 @@ class HRVAnalysis:
     rec.hrv.sd2 = float(format(hrv['poincare_plot']['sd2'], '.4f'))
     rec.hrv.sd2sd1Ratio = float(format(hrv['poincare_plot']['ratio_sd2_sd1'], '.4f'))
 
+    if 'cleaning' in hrv:
+      rec.hrv.nnRr = float(format(hrv['cleaning']['nnRr'], '.4f'))
+      rec.hrv.nnRrHrvAnalysis = rec.hrv.nnRr
+
+    if 'filtnn' in hrv:
+      rec.hrv.setFiltered(hrv['filtnn'], hrv['filtnn_freq_domain'])
+
+    if 'nonlinear' in hrv:
+      rec.hrv.setNonlinear(hrv['nonlinear'])
+
     return rec
 
 # Kardia Record
@@ -308,6 +325,22 @@ class Record:
                'POINCARE sd1 [HRVANALYSIS]',
                'POINCARE sd2 [HRVANALYSIS]',
                'POINCARE sd2/sd1 (ratio) [HRVANALYSIS]',
+               'NN/RR (ratio) [HRVANALYSIS]', # intervals kept by the RR cleaning (range filter + ectopic beats, see rrtools.py)
+               # same as get_hrv -f "0.2 20 -x 0.4 2.0": filtnn windowed filter (see rrtools.py)
+               'NN/RR (ratio) [FILTNN]',
+               'AVNN (msec) [FILTNN]',
+               'SDNN (msec) [FILTNN]',
+               'rMSSD (msec) [FILTNN]',
+               'pNN50 (%) [FILTNN]',
+               'TOTAL spectral power (msec2) [FILTNN]',
+               'LF spectral power (msec2) [FILTNN]',
+               'HF spectral power (msec2) [FILTNN]',
+               'LF/HF (ratio) [FILTNN]',
+               # nonlinear, on the NN series (see rrtools.py), 0.0: series too short
+               'SAMPEN [HRVANALYSIS]', # (Sample entropy, m=2, r=0.2 x SDNN)
+               'APEN [HRVANALYSIS]', # (Approximate entropy, m=2, r=0.2 x SDNN)
+               'DFA alpha1 [HRVANALYSIS]', # (Detrended fluctuation analysis, short term: 4-16 beats)
+               'DFA alpha2 [HRVANALYSIS]', # (Detrended fluctuation analysis, long term: 16-64 beats)
                ]
     def __init__(self):
       self.nnRr = 0.0
@@ -325,6 +358,38 @@ class Record:
       self.sd1 = 0.0
       self.sd2 = 0.0
       self.sd2sd1Ratio = 0.0
+      self.nnRrHrvAnalysis = 0.0
+      self.nnRrFiltered = 0.0
+      self.avnnFiltered = 0.0
+      self.sdnnFiltered = 0.0
+      self.rmssdFiltered = 0.0
+      self.pnn50Filtered = 0.0
+      self.totalPwrFiltered = 0.0
+      self.lfPwrFiltered = 0.0
+      self.hfPwrFiltered = 0.0
+      self.lfhfRatioFiltered = 0.0
+      self.sampEn = 0.0
+      self.apEn = 0.0
+      self.dfaAlpha1 = 0.0
+      self.dfaAlpha2 = 0.0
+    def setFiltered(self, timeDomain, freqDomain): # from rrtools.timeDomain() + hrvanalysis
+      self.nnRrFiltered = float(format(timeDomain['nnRr'], '.4f'))
+      self.avnnFiltered = float(format(timeDomain['avnn'], '.3f'))
+      self.sdnnFiltered = float(format(timeDomain['sdnn'], '.4f'))
+      self.rmssdFiltered = float(format(timeDomain['rmssd'], '.4f'))
+      self.pnn50Filtered = float(format(timeDomain['pnn50'], '.4f'))
+      if freqDomain: # empty: not enough intervals kept
+        self.totalPwrFiltered = float(format(freqDomain['total_power'], '.2f'))
+        self.lfPwrFiltered = float(format(freqDomain['lf'], '.2f'))
+        self.hfPwrFiltered = float(format(freqDomain['hf'], '.2f'))
+        self.lfhfRatioFiltered = float(format(freqDomain['lf_hf_ratio'], '.6f'))
+    def setNonlinear(self, features): # from rrtools.nonlinear(), nan (undefined) kept as 0.0
+      def value(name, decimals):
+        return float(format(features[name], decimals)) if math.isfinite(features[name]) else 0.0
+      self.sampEn = value('sampen', '.4f')
+      self.apEn = value('apen', '.4f')
+      self.dfaAlpha1 = value('dfa_alpha1', '.4f')
+      self.dfaAlpha2 = value('dfa_alpha2', '.4f')
     def asList(self):
       return [self.nnRr,
               self.avnn,
@@ -340,7 +405,21 @@ class Record:
               self.meanHeartRate,
               self.sd1,
               self.sd2,
-              self.sd2sd1Ratio
+              self.sd2sd1Ratio,
+              self.nnRrHrvAnalysis,
+              self.nnRrFiltered,
+              self.avnnFiltered,
+              self.sdnnFiltered,
+              self.rmssdFiltered,
+              self.pnn50Filtered,
+              self.totalPwrFiltered,
+              self.lfPwrFiltered,
+              self.hfPwrFiltered,
+              self.lfhfRatioFiltered,
+              self.sampEn,
+              self.apEn,
+              self.dfaAlpha1,
+              self.dfaAlpha2
               ]
 
   headers = ['RECORD_NAME',
@@ -354,7 +433,14 @@ class Record:
              'COMMENT',
              'ATC_FILENAME',
              'QRS_ALGORITHM',
-             'HRV_CALCULATOR'] + HRV.headers
+             'HRV_CALCULATOR'] + HRV.headers + [
+             # signal quality of leadI, computed after the ATC decode (see signalquality.py)
+             'SQI', # (0 - 1: lowest score, below the threshold (-sq) the QRS detection and HRV are skipped)
+             'SQI flat (ratio)', # (0.5 sec windows with a peak to peak < 0.02 mV)
+             'SQI saturation (ratio)', # (samples at the lead min / max)
+             'SQI HF noise (ratio)', # (power above 40 Hz / power above 1 Hz)
+             'SQI kurtosis', # (1 - 40 Hz band)
+             'SQI periodicity'] # (autocorrelation peak at one beat)
   def __init__(self):
     self.recordName = ''
     self.patientId = ''
@@ -369,6 +455,20 @@ class Record:
     self.hrvQrsAlgo = ''
     self.hrvCalculator = ''
     self.hrv = Record.HRV()
+    self.sqi = 0.0
+    self.sqiFlat = 0.0
+    self.sqiSaturation = 0.0
+    self.sqiHfNoise = 0.0
+    self.sqiKurtosis = 0.0
+    self.sqiPeriodicity = 0.0
+  def setQuality(self, quality): # from signalquality.recordQuality()
+    lead = quality['leads'].get(quality['lead'], {})
+    self.sqi = quality['sqi']
+    self.sqiFlat = lead.get('flat', 0.0)
+    self.sqiSaturation = lead.get('saturation', 0.0)
+    self.sqiHfNoise = lead.get('hfNoise', 0.0)
+    self.sqiKurtosis = lead.get('kurtosis', 0.0)
+    self.sqiPeriodicity = lead.get('periodicity', 0.0)
   def asList(self): 
     return [self.recordName,
             self.patientId,
@@ -381,7 +481,13 @@ class Record:
             self.comment,
             self.atcFilename,
             self.hrvQrsAlgo,
-            self.hrvCalculator] + self.hrv.asList()
+            self.hrvCalculator] + self.hrv.asList() + [
+            self.sqi,
+            self.sqiFlat,
+            self.sqiSaturation,
+            self.sqiHfNoise,
+            self.sqiKurtosis,
+            self.sqiPeriodicity]
 
 # KardiaRecords
 # All Kardia Records
@@ -429,6 +535,10 @@ class AliveECGDB:
   def __del__(self):
     self.conn.close()
 
+  def getComments(self): # return all ZECG comments (distinct)
+    cursor = self.conn.execute("select distinct ZCOMMENT from ZECG")
+    return [row[0] for row in cursor]
+
   def updateRecord(self, atcFilename, record): # return the updated record
     # IMPORTANT NOTE: Kardia store ZDATERECORDED starting from 2001-01-01 --> we add this constant to get it from now (constant found in Kardia SQLite database too)
     # NOTE: adding 978307200 seams the way ios itself is recording dates.
@@ -481,12 +591,15 @@ class AliveECGDB:
 class RecordsLoader:
   WorkingDirectory = 'work'
 
-  def __init__(self, recordNamesDict, aliveEcgDb=None, tryInterpretComments=False, qrsAlgoFlags=QRSAlgorithms.NONE):
+  def __init__(self, recordNamesDict, aliveEcgDb=None, tryInterpretComments=False, qrsDetectors=[], commentRules=None, hrvCache=None, cleanRR=True):
     self.recordNamesDict = recordNamesDict # {recordName: (atcFilename, atcFilepath), ..}
     self.aliveEcgDb = aliveEcgDb 
     self.tryInterpretComments = tryInterpretComments
-    self.qrsAlgoFlags = qrsAlgoFlags
-    self.hrvAnalysis = HRVAnalysis()
+    self.commentRules = commentRules or gCommentRules
+    self.commentInterpretations = {} # {comment: {field: value}}
+    self.qrsDetectors = qrsDetectors # [QRSDetector(), ...]
+    self.hrvAnalysis = HRVAnalysis(hrvCache, cleanRR)
+    self.interrupted = False # set on SIGINT: stop loading, the records loaded are kept
 
   def updateRecordFromAliveDb(self, atcFilename, rec): # return the update rec: Record()
     if self.aliveEcgDb is None:
@@ -497,36 +610,48 @@ class RecordsLoader:
 
   def updateRecordFromGetHrvFile(self, qrsAlgo, hrvCalculator, filename, rec): # return the updated rec: Record()
     with open(filename, mode='r',) as f:
-      line = f.readline()
-      gethrvRe = re.compile(r'^([\w/]+) : ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+) : ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+)')
-      m = gethrvRe.match(line)
-
-      if m is None:
-        print("Error: get_hrv GQRS one line does _not_ match the regular expression.")
-        return None
-
-      #rec.recordName = m.group(1).split('/')[-1:][0] # record_name
-      rec.hrvQrsAlgo = qrsAlgo
-      rec.hrvCalculator = hrvCalculator
-      rec.hrv.nnRr = m.group(2) # nn_rr
-      rec.hrv.avnn = m.group(3) # avnn
-      rec.hrv.sdnn = m.group(4) # sdnn
-      rec.hrv.rmssd = m.group(7) # rmssd
-      rec.hrv.pnn50 = m.group(8) # pnn50
-      rec.hrv.totalPwr = m.group(9) # tot_pwr
-      rec.hrv.ulfPwr = m.group(10) # ulf_pwr
-      rec.hrv.vlfPwr = m.group(11) # vlf_pwr
-      rec.hrv.lfPwr = m.group(12) # lf_pwr
-      rec.hrv.hfPwr = m.group(13) # hf_pwr
-      rec.hrv.lfhfRatio = m.group(14) # lf_hf_ratio
+      return self.updateRecordFromGetHrvLine(qrsAlgo, hrvCalculator, f.readline(), rec)
 
-      return rec
+  def updateRecordFromGetHrvLine(self, qrsAlgo, hrvCalculator, line, rec): # return the updated rec: Record()
+    gethrvRe = re.compile(r'^([\w/]+) : ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+) : ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+)')
+    m = gethrvRe.match(line)
+
+    if m is None:
+      print("Error: get_hrv GQRS one line does _not_ match the regular expression.")
+      return None
+
+    #rec.recordName = m.group(1).split('/')[-1:][0] # record_name
+    rec.hrvQrsAlgo = qrsAlgo
+    rec.hrvCalculator = hrvCalculator
+    rec.hrv.nnRr = m.group(2) # nn_rr
+    rec.hrv.avnn = m.group(3) # avnn
+    rec.hrv.sdnn = m.group(4) # sdnn
+    rec.hrv.rmssd = m.group(7) # rmssd
+    rec.hrv.pnn50 = m.group(8) # pnn50
+    rec.hrv.totalPwr = m.group(9) # tot_pwr
+    rec.hrv.ulfPwr = m.group(10) # ulf_pwr
+    rec.hrv.vlfPwr = m.group(11) # vlf_pwr
+    rec.hrv.lfPwr = m.group(12) # lf_pwr
+    rec.hrv.hfPwr = m.group(13) # hf_pwr
+    rec.hrv.lfhfRatio = m.group(14) # lf_hf_ratio
+
+    return rec
 
-  def loadRecords(self): # return [Record(), ...]
+  # onRecordLoaded(recordName, [Record(), ...]): called once each record is loaded
+  def loadRecords(self, onRecordLoaded=None): # return [Record(), ...]
     records = []
 
+    # interpret all comments of the database at once (one pass, memoized by comment text)
+    if self.aliveEcgDb is not None and self.tryInterpretComments:
+      print("Info: interpreting Kardia database comments...")
+      self.commentInterpretations = self.commentRules.interpretAll(self.aliveEcgDb.getComments())
+
     for recordName in self.recordNamesDict.keys():
+      if self.interrupted:
+        print("WARNING: loading interrupted, %d record(s) loaded." % (len(records)))
+        break
       print("Info: Loading record: '%s'" % (recordName))
+      recordStart = len(records)
       (atcFilename, atcFilepath) = self.recordNamesDict[recordName] 
       #print("Debug:   atcFilename: %s - atcFilepath: %s" % (atcFilename, atcFilepath))
 
@@ -547,71 +672,95 @@ class RecordsLoader:
           # Try interpret comments
           if self.tryInterpretComments:
             print("Info:                 [interpret comment]")
-            results = toolsBox.tryInterpretCommentForBCC(rec.comment)
-            rec.prePost = results['prePost']
-            rec.drOrPt = results['drOrPt']
-            rec.patientId = results['patientId']
-
-      # GET_HRV - GQRS
-      if QRSAlgorithms.hasGQRS(self.qrsAlgoFlags):
-        print("Info:                 [from get_hrv with GQRS RR]")
-        copyRec = copy.deepcopy(rec)
-        gqrsGetHrvLead1Filename = toolsBox.getRecordWorkFilename(recordName, '.output.gethrv-gqrs-lead1.txt')
-
-        if os.path.isfile(gqrsGetHrvLead1Filename):
-          recordGetHrv = self.updateRecordFromGetHrvFile('GQRS', 'PHYSIONET-GET_HRV + HRV-ANALYSIS', gqrsGetHrvLead1Filename, copyRec)
-
-          print("Info:                 [from hrvanalysis with GQRS RR]")
+            results = self.commentInterpretations.get(rec.comment)
+            if results is None:
+              results = toolsBox.tryInterpretCommentForBCC(rec.comment, self.commentRules)
+            rec.prePost = results.get('prePost', '')
+            rec.drOrPt = results.get('drOrPt', '')
+            rec.patientId = results.get('patientId', '')
+            rec.group = results.get('group', '')
+
+      # GET_HRV + HRV-ANALYSIS - one record per QRS detector
+      bundle = RecordBundle.open(toolsBox.getRecordWorkFilename(recordName, ""))
+      quality = readQuality(toolsBox.getRecordWorkFilename(recordName, ""), bundle)
+      if quality is not None:
+        rec.setQuality(quality)
+      for detector in self.qrsDetectors:
+        label = detector.label()
+        if quality is not None and not quality['usable']:
+          # below the signal quality threshold: no QRS detection nor HRV, row with the SQI only
+          print("Info:                 [signal quality %.2f below the threshold (%.2f), no HRV]" % (quality['sqi'], quality['threshold']))
           copyRec = copy.deepcopy(rec)
-          recordHrvAnalysis = self.hrvAnalysis.updateRecordFromHrvAnalysis('gqrs', recordName, copyRec)
-
-          if recordHrvAnalysis is not None:
-            # merge: keep only poincare's values from HRV Analysis.
-            recordGetHrv.hrv.meanHeartRate = recordHrvAnalysis.hrv.meanHeartRate
-            recordGetHrv.hrv.sd1 = recordHrvAnalysis.hrv.sd1
-            recordGetHrv.hrv.sd2 = recordHrvAnalysis.hrv.sd2
-            recordGetHrv.hrv.sd2sd1Ratio = recordHrvAnalysis.hrv.sd2sd1Ratio
-
-          else:
-            print("ERROR: hrvanalysis GQRS calculation failed (%s)." % (recordName))
-        
-          records.append(recordGetHrv)
-
-        # GetHRV QGRS file not found
+          copyRec.hrvQrsAlgo = label
+          copyRec.hrvCalculator = 'NONE (SQI BELOW THRESHOLD)'
+          records.append(copyRec)
+          continue
+        print("Info:                 [from get_hrv with %s RR]" % (label))
+        copyRec = copy.deepcopy(rec)
+        getHrvLead1Extension = '.output.gethrv-%s-lead1.txt' % (detector.name)
+        getHrvLead1Filename = toolsBox.getRecordWorkFilename(recordName, getHrvLead1Extension)
+
+        if bundle is not None and bundle.has(getHrvLead1Extension[1:]):
+          line = bundle.readText(getHrvLead1Extension[1:]).split('\n')[0]
+          recordGetHrv = self.updateRecordFromGetHrvLine(label, 'PHYSIONET-GET_HRV + HRV-ANALYSIS', line, copyRec)
+        elif not os.path.isfile(getHrvLead1Filename):
+          print("ERROR: get_hrv %s one line file not found (%s)" % (label, getHrvLead1Filename))
+          continue
         else:
-          print("ERROR: get_hrv GQRS one line file not found (%s)" % (gqrsGetHrvLead1Filename))
+          recordGetHrv = self.updateRecordFromGetHrvFile(label, 'PHYSIONET-GET_HRV + HRV-ANALYSIS', getHrvLead1Filename, copyRec)
+        if recordGetHrv is None:
+          continue
 
-      # GET_HRV - ECGPU
-      if QRSAlgorithms.hasECGPU(self.qrsAlgoFlags):
-        print("Info:                 [from get_hrv with ECGPU RR]")
+        print("Info:                 [from hrvanalysis with %s RR]" % (label))
         copyRec = copy.deepcopy(rec)
-        ecgpuGetHrvLead1Filename = toolsBox.getRecordWorkFilename(recordName, '.output.gethrv-ecgpu-lead1.txt')
+        recordHrvAnalysis = self.hrvAnalysis.updateRecordFromHrvAnalysis(detector.name, recordName, copyRec)
+
+        if recordHrvAnalysis is not None:
+          # merge: keep only poincare's values from HRV Analysis.
+          recordGetHrv.hrv.meanHeartRate = recordHrvAnalysis.hrv.meanHeartRate
+          recordGetHrv.hrv.sd1 = recordHrvAnalysis.hrv.sd1
+          recordGetHrv.hrv.sd2 = recordHrvAnalysis.hrv.sd2
+          recordGetHrv.hrv.sd2sd1Ratio = recordHrvAnalysis.hrv.sd2sd1Ratio
+          recordGetHrv.hrv.nnRrHrvAnalysis = recordHrvAnalysis.hrv.nnRrHrvAnalysis
+          recordGetHrv.hrv.sampEn = recordHrvAnalysis.hrv.sampEn
+          recordGetHrv.hrv.apEn = recordHrvAnalysis.hrv.apEn
+          recordGetHrv.hrv.dfaAlpha1 = recordHrvAnalysis.hrv.dfaAlpha1
+          recordGetHrv.hrv.dfaAlpha2 = recordHrvAnalysis.hrv.dfaAlpha2
+          # filtered series (filtnn) next to get_hrv's unfiltered one
+          for name in vars(recordHrvAnalysis.hrv):
+            if name.endswith('Filtered'):
+              setattr(recordGetHrv.hrv, name, getattr(recordHrvAnalysis.hrv, name))
+        else:
+          print("ERROR: hrvanalysis %s calculation failed (%s)." % (label, recordName))
 
-        if os.path.isfile(ecgpuGetHrvLead1Filename):
-          recordGetHrv = self.updateRecordFromGetHrvFile('ECGPU', 'PHYSIONET-GET_HRV + HRV-ANALYSIS', ecgpuGetHrvLead1Filename, copyRec)
+        records.append(recordGetHrv)
 
-          print("Info:                 [from hrvanalysis with ECGPU RR]")
-          copyRec = copy.deepcopy(rec)
-          recordHrvAnalysis = self.hrvAnalysis.updateRecordFromHrvAnalysis('ecgpu', recordName, copyRec)
+      if bundle is not None:
+        bundle.close()
 
-          if ecgpu is not None:
-            # merge: keep only poincare's values from HRV Analysis.
-            recordGetHrv.hrv.meanHeartRate = recordHrvAnalysis.hrv.meanHeartRate
-            recordGetHrv.hrv.sd1 = recordHrvAnalysis.hrv.sd1
-            recordGetHrv.hrv.sd2 = recordHrvAnalysis.hrv.sd2
-            recordGetHrv.hrv.sd2sd1Ratio = recordHrvAnalysis.hrv.sd2sd1Ratio
-
-          else:
-            print("ERROR: hrvanalysis ECGPU calculation failed.")
+      if onRecordLoaded is not None:
+        onRecordLoaded(recordName, records[recordStart:])
 
-          records.append(recordGetHrv)
-
-        # GetHRV ECGPU file not found
-        else:
-          print("ERROR: get_hrv ECGPU one line file not found (%s)" % (gqrsGetHrvLead1Filename))
+    return records
 
+  # inputsKey: hash of the inputs of the rows other than the record outputs (see resultsdb.py:
+  # the rows are loaded again when it changes)
+  def inputsKey(self, aliveDbFilename, commentRulesFilename, sqiThreshold):
+    inputs = {'hrv': self.hrvAnalysis.featuresParams(), 'interpretComments': self.tryInterpretComments,
+              'sqiThreshold': sqiThreshold, 'aliveDb': None, 'commentRules': None}
+    if aliveDbFilename is not None:
+      inputs['aliveDb'] = [os.path.abspath(aliveDbFilename), os.path.getmtime(aliveDbFilename)]
+    if commentRulesFilename is not None:
+      with open(commentRulesFilename, mode='rb') as f:
+        inputs['commentRules'] = hashlib.sha256(f.read()).hexdigest()
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
 
-    return records
+  def recordSourceTime(self, recordName): # last modification time of the record outputs read by loadRecords()
+    filenames = [toolsBox.getRecordWorkFilename(recordName, '.output.gethrv-%s-lead1.txt' % (detector.name)) for detector in self.qrsDetectors]
+    filenames += [toolsBox.getRecordWorkFilename(recordName, '.%s-lead1.rr.kubios.txt' % (detector.name)) for detector in self.qrsDetectors]
+    filenames.append(toolsBox.getRecordWorkFilename(recordName, '.bundle.zip'))
+    filenames.append(toolsBox.getRecordWorkFilename(recordName, gSqiExtension))
+    return max([os.path.getmtime(f) for f in filenames if os.path.isfile(f)] + [0.0])
 
 
 # Processor()
@@ -621,20 +770,27 @@ class RecordsLoader:
 # - find and open sqlight database
 # - open CSV output file
 # - for each record
-#   - convert to edf (atc2edf.py)
+#   - convert to mit [+ edf] (atc2edf.py -m)
 #   - calculate HRV 
 #   - read SQLLight database record + parse comments
 #   - add record to CSV file
 class Processor:
-  def __init__(self):
-    self.csvFilename = CURR_DIR + '/' + 'output.process-kardia.csv'
-    self.logFilename = CURR_DIR + '/' + 'output.process-kardia.log'
+  def __init__(self, shard=None): # shard: (i, N) outputs of one shard (see shards.py)
+    self.shard = shard
+    self.csvFilename = shardFilename(CURR_DIR + '/' + 'output.process-kardia.csv', shard)
+    self.logFilename = shardFilename(CURR_DIR + '/' + 'output.process-kardia.log', shard)
+    self.hrvCacheFilename = shardFilename(CURR_DIR + '/' + 'output.hrv-cache.sqlite', shard)
+    self.journalFilename = shardFilename(CURR_DIR + '/' + 'output.process-kardia.journal.jsonl', shard)
+    self.resultsDbFilename = shardFilename(CURR_DIR + '/' + 'output.process-kardia.sqlite', shard)
+    self.quarantineFilename = shardFilename(CURR_DIR + '/' + 'output.process-kardia.quarantine.json', shard)
+    self.failuresFilename = shardFilename(CURR_DIR + '/' + 'output.process-kardia.failures.json', shard)
+    self.jsonLogFilename = shardFilename(CURR_DIR + '/' + 'output.process-kardia.log.jsonl', shard)
 
     if os.path.isfile(self.logFilename):
       print("Info: erasing previous log file (%s)" % (self.logFilename)) 
       os.remove(self.logFilename)
 
-  def loadAndWriteCSV(self, atcFilesDirectory, qrsAlgoFlags, aliveDbFilename=None, tryInterpretComments=False):
+  def loadAndWriteCSV(self, atcFilesDirectory, qrsDetectors, *, aliveDbFilename=None, tryInterpretComments=False, useSharedMemory=False, workerSocket=None, exportEdf=False, commentRulesFilename=None, useHrvCache=True, maxCpuTasks=None, useBundle=False, cleanRR=True, resume=False, useResultsDb=True, reloadResults=False, retryQuarantined=False, jsonLog=False, memoryBudget=None, traceMemory=False, sqiThreshold=gDefaultThreshold):
 
     aliveDb = None
     if aliveDbFilename is not None:
@@ -662,73 +818,370 @@ class Processor:
 
       recordNamesDict[recordName] = (atcFilename, atcFilepath)
 
-    def convertAndCalculate(atcfilepath, rname, logFilename):
-      error = False
-      with open(logFilename, "a+") as logFile:
+    # record order (CSV rows): by record name, same order with or without shards
+    recordNamesDict = dict(sorted(recordNamesDict.items(), key=lambda item: (toolsBox.getRecordId(item[0]), item[0])))
+
+    manifest = None
+    if self.shard is not None:
+      nbRecords = len(recordNamesDict)
+      recordNamesDict = selectShard(recordNamesDict, atcFilesDirectory, self.shard)
+      print("Info: shard %d/%d: %d of %d record(s)" % (self.shard[0], self.shard[1], len(recordNamesDict), nbRecords))
+      manifest = Manifest(manifestFilename(CURR_DIR + '/' + 'output.process-kardia.csv', self.shard),
+                          self.shard, [os.path.relpath(files[1], atcFilesDirectory) for files in recordNamesDict.values()], self.csvFilename)
+      manifest.write()
+
+    # convertAndCalculate
+    # return True on success; a failure raises RecordFailure (class of the failed stage, see
+    # failures.py), the failures of the detectors / leads are all reported
+    # ------------------------------------------------------------------------------------------
+    async def convertAndCalculate(atcfilepath, rname, qrsDetectors, useSharedMemory, workerSocket, exportEdf, useBundle):
+      failures = [] # [RecordFailure(), ...]
+      errors = {} # {'<detector>-<lead>': error or None}
+      sharedSignal = None
+      workerClient = WorkerClient(workerSocket) if workerSocket is not None else None
+
+      def runOnWorkerServer(logFile, job, **jobArgs): # return 'ok', 'failed' or 'timeout' (TransientError: worth a retry)
+        # the server kills the worker of a job over the stage timeout (convert: the atc2json
+        # process is killed first, by the job itself); the socket timeout is a backstop (the
+        # job may first wait for a free worker)
+        timeout = wfdbExecutor.timeout(job)
+        jobTimeout = timeout
+        if job == 'convert':
+          jobArgs['timeout'] = timeout
+          jobTimeout = timeout + 10
+        try:
+          response = workerClient.request(job, socketTimeout=2 * timeout + 30, jobTimeout=jobTimeout, **jobArgs)
+        except socket.timeout:
+          print("------ - %s - WORKER SERVER %s: no response in %d sec" % (rname, job.upper(), 2 * timeout + 30), file=logFile)
+          return 'timeout'
+        except (ConnectionResetError, BrokenPipeError) as e:
+          raise TransientError("worker server %s: %s" % (job, str(e)))
+        logFile.write(response.get('output', ''))
+        if not response['ok']:
+          print("------ - %s - WORKER SERVER %s: %s" % (rname, job.upper(), response['error']), file=logFile)
+          if response.get('transient'):
+            raise TransientError("worker server %s: %s" % (job, response['error']))
+          return 'timeout' if response.get('timeout') else 'failed'
+        return 'ok'
+
+      def runProcess(logFile, usage, name, cmd): # return 'ok', 'failed' or 'timeout', the process is accounted to the stage
+        # own process group: killed with its children (e.g. 'go run') on timeout; output
+        # captured (pipe) and written to the record log once the process ends
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True, start_new_session=True)
+        usage.watch(process.pid)
+        try:
+          output, _ = process.communicate(timeout=wfdbExecutor.timeout(name))
+          status = 'ok' if process.returncode == 0 else 'failed'
+        except subprocess.TimeoutExpired:
+          os.killpg(process.pid, signal.SIGKILL)
+          output, _ = process.communicate()
+          status = 'timeout'
+        logFile.write(output.decode('utf-8', 'replace'))
+        if status == 'timeout':
+          print("------ - %s - %s: timeout (%d sec), killed" % (rname, name.upper(), wfdbExecutor.timeout(name)), file=logFile)
+        logFile.flush()
+        return status
+
+      def check(failureClass, status, what): # status of a stage -> RecordFailure
+        if status != 'ok':
+          raise RecordFailure(failureClass, "%s %s" % (what, status), status == 'timeout')
+
+      def convert(logFile, usage):
+        nonlocal sharedSignal
+        # atc -> mit (written directly from the int16 samples, edf2mit is skipped) [+ edf]
+        if useSharedMemory:
+          # decode once, in process: int16 leads go to shared memory for the next stages
+          import atc2edf # not needed by the other modes (pyedflib)
+          print("------ - %s - ATC2EDF (in process, shared memory)" % (rname), file=logFile)
+          logFile.flush()
+          try:
+            atcDict = atc2edf.convertAtc2Dict(os.path.join(CURR_DIR, atcfilepath), wfdbExecutor.timeout('convert'))
+          except subprocess.TimeoutExpired:
+            check('decode', 'timeout', 'atc2json')
+          except (subprocess.CalledProcessError, ValueError) as e:
+            print("------ - %s - ATC2EDF: decode: %s" % (rname, str(e)), file=logFile)
+            check('decode', 'failed', 'atc2json')
+          try:
+            sharedSignal = SharedSignal.create(recordId, workingRname, leadsFromAtcDict(atcDict), atcDict['frequency'], atcDict['amplitudeResolution'])
+            if not (os.path.isfile(workingRname + '.hea') and os.path.isfile(workingRname + '.dat')):
+              atc2edf.convertAtcDict2Wfdb(workingRname, atcDict)
+            edfFilename = CURR_DIR + '/' + rname + '.edf'
+            if exportEdf and not os.path.isfile(edfFilename):
+              atc2edf.convertAtcDict2Edf(edfFilename, atcDict)
+          except Exception as e:
+            if isTransient(e): raise
+            print("------ - %s - ATC2EDF: exception: %s" % (rname, str(e)), file=logFile)
+            check('convert', 'failed', 'atc2edf (%s)' % (str(e)))
+        elif workerClient is not None:
+          print("------ - %s - ATC2EDF (worker server)" % (rname), file=logFile)
+          logFile.flush()
+          check('decode', runOnWorkerServer(logFile, 'convert', atcFilepath=atcfilepath, recordName=rname, writeEdf=exportEdf, writeMit=True), 'atc2edf (worker server)')
+        else:
+          cmd = "./atc2edf.py -m -i %s -r %s" % (atcfilepath, rname)
+          if not exportEdf:
+            cmd += " -n"
+          #cmd = "./atc2edf.py -i %s -r %s 1>>%s 2>&1" % (atcfilepath, rname, self.logFile)
+          print("------ - %s - ATC2EDF.PY: %s" % (rname, cmd), file=logFile)
+          logFile.flush()
+          check('decode', runProcess(logFile, usage, 'convert', cmd), 'atc2edf.py')
+
+      def assessQuality(logFile): # signal quality of the decoded samples, written to <work>.sqi.json
+        if sharedSignal is not None:
+          leads = sharedSignal.leadNames()
+          quality = recordQuality(sharedSignal.samples, sharedSignal.frequency, sharedSignal.gain(), sqiThreshold, leads)
+        else:
+          digital, leads, frequency, gain = readWorkSignals(workingRname)
+          quality = recordQuality(digital, frequency, gain, sqiThreshold, leads)
+        writeQuality(workingRname, quality)
+        print("------ - %s - SQI: %.2f (%s): %s" % (rname, quality['sqi'], quality['lead'],
+              ', '.join(["%s %s" % (name, value) for name, value in quality['leads'].get(quality['lead'], {}).items()])), file=logFile)
+        return quality
+
+      def render(logFile, usage):
+        sharedMemoryName = sharedSignal.name() if sharedSignal is not None else None
+        if workerClient is not None:
+          print("------ - %s - RECORD-VIEWER (worker server)" % (rname), file=logFile)
+          logFile.flush()
+          check('render', runOnWorkerServer(logFile, 'render', recordName=workingRname, qrsDetector=qrsDetectors[0].name, sharedMemoryName=sharedMemoryName), 'record-viewer (worker server)')
+          return
+        cmd ="./record-viewer.py -gqrs -q %s -o -r1 %s" % (qrsDetectors[0].name, workingRname)
+        if sharedMemoryName is not None:
+          cmd += " -shm %s" % (sharedMemoryName)
+        print("------ - %s - RECORD-VIEWER.PY: %s" % (rname, cmd), file=logFile)
+        logFile.flush()
+        check('render', runProcess(logFile, usage, 'render', cmd), 'record-viewer.py')
+
+      async def runStage(name, function, *args, passUsage=False): # in a thread, retried on transient I/O errors
+        def onRetry(attempt, delay, e):
+          print("------ - %s - %s: transient error (%s), retry %d in %.1f sec" % (rname, name.upper(), str(e), attempt, delay), file=logFile)
+        async def attempt():
+          async with scheduler.stage(name) as usage:
+            return await scheduler.runInThread(usage, function, *(args + ((usage,) if passUsage else ())))
+        return await retry(attempt, onRetry=onRetry)
+
+      with logPipeline.recordLog(rname) as logFile:
         print("Info: processing ATC (%s) to record (%s)" % (atcfilepath, rname))
         print("------ - %s - ---------------------------------" % (rname), file=logFile)
 
-        # atc -> edf
-        cmd = "./atc2edf.py -i %s -r %s" % (atcfilepath, rname)
-        #cmd = "./atc2edf.py -i %s -r %s 1>>%s 2>&1" % (atcfilepath, rname, self.logFile)
-        print("------ - %s - ATC2EDF.PY: %s" % (rname, cmd), file=logFile)
-        process = subprocess.Popen(cmd, stdout=logFile, stderr=logFile, shell=True)
-        ret = process.wait()
-        if ret != 0:
-          print("ERROR: Unable to convert atc (%s) (recordName: %s)" % (atcfilepath, rname))
-          error = True
-        else:
-
-          # Calculate HRV
-          cmd = "./calculate.sh %s" % (rname)
-          #cmd = "./calculate.sh %s 1>>%s 2>&1" % (rname, self.logFile)
-          print("------ - %s - CALCULATE.SH: %s" % (rname, cmd), file=logFile)
-          process = subprocess.Popen(cmd, stdout=logFile, stderr=logFile, shell=True)
-          ret = process.wait()
-          if ret != 0:
-            print("ERROR: Unable to calculate recordName (%s)" % (rname))
-            error = True
-
+        workingRname = toolsBox.getRecordWorkFilename(rname, "")
+        workDir = os.path.dirname(workingRname)
+        recordId = toolsBox.getRecordId(rname)
+
+        # bundled record: done if all detectors are in the bundle, else its files are restored
+        bundle = RecordBundle.open(workingRname)
+        if bundle is not None:
+          with bundle:
+            if all(bundle.isDetected(detector.annotator('leadI')) for detector in qrsDetectors):
+              print("------ - %s - BUNDLE: already calculated (%s)" % (rname, bundle.filename), file=logFile)
+              journal.recordDone(rname)
+              return True
+            print("------ - %s - BUNDLE: extracting (%s)" % (rname, bundle.filename), file=logFile)
+            bundle.extract(workDir)
+
+        failureClass = 'decode' # class of an unexpected exception
+        try:
+          # resumed record: the stages of the journal are not run again
+          if journal.hasStage(rname, 'convert') and os.path.isfile(workingRname + '.hea'):
+            print("------ - %s - CONVERT: done (journal)" % (rname), file=logFile)
           else:
-
-            # Generate ECG + QRS image
-            workingRname = toolsBox.getRecordWorkFilename(rname, "")
-            cmd ="./record-viewer.py -gqrs -o -r1 %s" % (workingRname)
-            print("------ - %s - RECORD-VIEWER.PY: %s" % (rname, cmd), file=logFile)
-            process = subprocess.Popen(cmd, stdout=logFile, stderr=logFile, shell=True)
-            ret = process.wait()
-            if ret != 0:
-              print("ERROR: Unable to  generate image of record (%s)" % (rname))
-              error = True
-
-      if error:
-        print("ERROR: There were errors converting and/or calculating HRVs.")
-        return False 
-
-    with futures.ProcessPoolExecutor(max_workers=gMaxWorkers) as executor:
-      listFutures = []
-      print("Info: *** Converting ATC -> EDF + calculate HRVs...")
-
+            await runStage('convert', convert, logFile.forStage('convert'), passUsage=True)
+            journal.stageDone(rname, 'convert')
+
+          # signal quality: the records below the threshold skip the QRS detection, HRV and render
+          quality = await runStage('quality', assessQuality, logFile.forStage('quality'))
+          if not quality['usable']:
+            print("------ - %s - SQI: %.2f below the threshold (%.2f): QRS detection, HRV and render skipped" % (rname, quality['sqi'], sqiThreshold), file=logFile)
+            journal.recordDone(rname, {'sqi': quality['sqi'], 'usable': False})
+            quarantine.succeeded(rname)
+            report.lowQuality.append(rname)
+            return True
+
+          # Convert EDF to MIT if needed, then QRS detection + RR + get_hrv: all detectors at
+          # once, on the same loaded signal (WFDB tools run concurrently, see wfdbexec.py)
+          failureClass = 'convert'
+          print("------ - %s - WFDB: %s" % (rname, ', '.join([d.name for d in qrsDetectors])), file=logFile)
+          logFile.flush()
+          def loadSignal():
+            if sharedSignal is not None:
+              return RecordSignal.fromSharedSignal(sharedSignal)
+            return RecordSignal.fromWorkFiles(workDir, recordId)
+          results = await wfdbExecutor.processRecord(workDir, recordId, CURR_DIR + '/' + rname + '.edf', qrsDetectors, loadSignal, logFile, sharedSignal is not None)
+          if results is None:
+            raise RecordFailure('convert', "MIT record (edf2mit / wfdbdesc / rdsamp) failed")
+
+          for detectorName in results.keys():
+            for lead in results[detectorName].keys():
+              result = results[detectorName][lead]
+              errors[detectorName + '-' + lead] = result['error']
+              if result['error'] is not None:
+                failures.append(RecordFailure(result['failureClass'], "%s %s: %s" % (detectorName, lead, result['error']), result['timeout']))
+          if not failures: journal.stageDone(rname, 'wfdb')
+
+          # Generate ECG + QRS image (RR of the first detector)
+          failureClass = 'render'
+          if qrsDetectors and not journal.hasStage(rname, 'render'):
+            try:
+              await runStage('render', render, logFile.forStage('render'), passUsage=True)
+              journal.stageDone(rname, 'render')
+            except RecordFailure as e:
+              failures.append(e)
+
+          # one file per record instead of the work files (see recordbundle.py)
+          failureClass = 'convert'
+          if useBundle and not failures:
+            print("------ - %s - BUNDLE" % (rname), file=logFile)
+            logFile.flush()
+            await runStage('bundle', RecordBundle.write, workDir, recordId, True)
+
+        except RecordFailure as e:
+          failures.append(e)
+        except Exception as e:
+          # isolation: an unexpected error only fails this record
+          print("------ - %s - EXCEPTION: %s: %s" % (rname, type(e).__name__, str(e)), file=logFile)
+          failures.append(RecordFailure(failureClass, "%s: %s" % (type(e).__name__, str(e))))
+
+        finally:
+          # record completed (or failed): release its shared segment
+          if sharedSignal is not None:
+            sharedSignal.release()
+
+        if failures:
+          journal.recordFailed(rname, {'errors': errors})
+          for failure in failures:
+            print("ERROR: %s - %s: %s" % (rname, failure.failureClass, failure.reason))
+            print("------ - %s - FAILED: %s: %s" % (rname, failure.failureClass, failure.reason), file=logFile)
+            report.addFailure(rname, failure)
+          failure = next((f for f in failures if f.timeout), failures[0])
+          if quarantine.failed(rname, failure):
+            report.newlyQuarantined.append(rname)
+          return False
+
+        journal.recordDone(rname, {'errors': errors})
+        quarantine.succeeded(rname)
+        report.ok.append(rname)
+        return True
+
+    if useSharedMemory:
+      cleanupStaleSharedSignals()
+
+    if workerSocket is not None:
+      if not WorkerClient(workerSocket).isAlive():
+        print("ERROR: worker server is not running (%s), start it with ./workerserver.py -s %s" % (workerSocket, workerSocket))
+        return False
+      print("Info: using worker server (%s)" % (workerSocket))
+
+    # records are processed concurrently, their stages are admitted by the scheduler (cpu / io
+    # limits sized from the CPU quota and available memory, see scheduler.py); with a memory
+    # budget, records are admitted while their estimated memory fits in it
+    scheduler = ResourceScheduler(maxCpuTasks=maxCpuTasks, memoryBudget=memoryBudget, traceMemory=traceMemory)
+    # first SIGINT: no new record, the records in progress end and the CSV is written
+    wfdbExecutor = WfdbExecutor(scheduler=scheduler, drainOnInterrupt=True)
+    journal = Journal(self.journalFilename, resume)
+    quarantine = Quarantine(self.quarantineFilename, clear=retryQuarantined)
+    report = FailureReport()
+    print("Info: scheduler: %s" % (scheduler.describe()))
+
+    async def processRecords():
+      nbTasks = scheduler.maxTasks()
+      asyncio.get_running_loop().set_default_executor(futures.ThreadPoolExecutor(max_workers=nbTasks))
+      queue = asyncio.Queue()
       for rname in recordNamesDict.keys():
-        (atcfile, atcfilepath) = recordNamesDict[rname]
-
-        # DO NOT USE FUTURES YET: SUBPROCESS() ISN'T PICKLABLE'
-        convertAndCalculate(atcfilepath[:], rname[:], self.logFilename[:])
-        #
-        #future = executor.submit(convertAndCalculate, atcfilepath[:], rname[:], self.logFilename[:])
-        #listFutures.append(future)
-
-      for f in listFutures: f.result(timeout=None) # wait for everybody :)
+        if journal.isDone(rname):
+          continue
+        if quarantine.isQuarantined(rname):
+          report.skipped.append(rname)
+          continue
+        queue.put_nowait(rname)
+      if report.skipped:
+        print("WARNING: %d quarantined record(s) skipped (-Q to retry them, see %s)" % (len(report.skipped), self.quarantineFilename))
+      if resume:
+        print("Info: resume: %d record(s) to process, %d already done" % (queue.qsize(), len(recordNamesDict) - queue.qsize()))
+
+      async def worker():
+        while not queue.empty() and not wfdbExecutor.draining:
+          rname = queue.get_nowait()
+          (atcfile, atcfilepath) = recordNamesDict[rname]
+          nbSamples = recordSamples(atcfilepath, toolsBox.getRecordWorkFilename(rname, "") + '.hea')
+          async with scheduler.admitRecord(rname, nbSamples):
+            await convertAndCalculate(atcfilepath[:], rname[:], qrsDetectors, useSharedMemory, workerSocket, exportEdf, useBundle)
+
+      await asyncio.gather(*[worker() for i in range(nbTasks)])
+
+    print("Info: *** Converting ATC -> EDF + calculate HRVs...")
+    # one section per record in the log (see recordlog.py)
+    logPipeline = LogPipeline(self.logFilename, self.jsonLogFilename if jsonLog else None)
+    try:
+      wfdbExecutor.run(processRecords())
+    finally:
+      logPipeline.close()
+      journal.close()
+      quarantine.write()
+    wfdbExecutor.printStats()
+    scheduler.printStats()
+    report.printReport()
+    report.write(self.failuresFilename)
+
+    if wfdbExecutor.draining:
+      # interrupted: CSV of the records processed so far (this run and the resumed ones)
+      finished = set(journal.finishedRecords())
+      recordNamesDict = {rname: files for rname, files in recordNamesDict.items() if rname in finished}
+      print("WARNING: interrupted, writing the %d record(s) processed so far (resume with -r)." % (len(recordNamesDict)))
 
     print("Info: *** Loading records...")
-    recordsLoader = RecordsLoader(recordNamesDict, aliveDb, tryInterpretComments, qrsAlgoFlags)
-    records = recordsLoader.loadRecords()
+    commentRules = CommentRules()
+    if commentRulesFilename is not None:
+      commentRules.loadRulesFile(commentRulesFilename)
+
+    hrvCache = HRVFeatureCache(self.hrvCacheFilename) if useHrvCache else None
+
+    recordsLoader = RecordsLoader(recordNamesDict, aliveDb, tryInterpretComments, qrsDetectors, commentRules, hrvCache, cleanRR)
+
+    # results database: only the records whose outputs changed are loaded (and upserted)
+    resultsDb = None
+    onRecordLoaded = None
+    if useResultsDb:
+      resultsDb = ResultsDB(self.resultsDbFilename, Record.headers, recordsLoader.inputsKey(aliveDbFilename, commentRulesFilename, sqiThreshold))
+      labels = [detector.label() for detector in qrsDetectors]
+      sourceTimes = {rname: recordsLoader.recordSourceTime(rname) for rname in recordNamesDict.keys()}
+      if not reloadResults:
+        recordsLoader.recordNamesDict = {rname: files for rname, files in recordNamesDict.items() if not resultsDb.isUpToDate(rname, sourceTimes[rname], labels)}
+      print("Info: results database (%s): %d of %d record(s) to load" % (self.resultsDbFilename, len(recordsLoader.recordNamesDict), len(recordNamesDict)))
+      def onRecordLoaded(rname, recs):
+        resultsDb.upsert(rname, [rec.asList() for rec in recs], sourceTimes[rname])
+
+    def interruptLoading(signalReceived, frame):
+      print("WARNING: SIGINT received, writing the records loaded so far.")
+      recordsLoader.interrupted = True
+    previousHandler = signal.signal(signal.SIGINT, interruptLoading)
+    try:
+      records = recordsLoader.loadRecords(onRecordLoaded)
+    finally:
+      signal.signal(signal.SIGINT, previousHandler)
+
+    if hrvCache is not None:
+      hrvCache.printStats()
+      hrvCache.close()
 
     print("Info: *** Writing CSV output file '%s'..." % (self.csvFilename))
-    csvOutput = CSVOutput(self.csvFilename)
-    csvOutput.write(records)
+    if resultsDb is not None:
+      nbRows = resultsDb.exportCsv(self.csvFilename, recordNamesDict.keys(), labels)
+      print("Info: %d row(s) exported from the results database." % (nbRows))
+      resultsDb.printStats()
+      resultsDb.close()
+    else:
+      csvOutput = CSVOutput(self.csvFilename)
+      csvOutput.write(records)
+
+    interrupted = wfdbExecutor.draining or recordsLoader.interrupted
+    if manifest is not None:
+      if interrupted:
+        # partial outputs: the shard is not completed (-M refuses to merge it)
+        print("WARNING: shard %d/%d interrupted, not completed (%s): resume it with -r -sh %d/%d." % (self.shard[0], self.shard[1], manifest.filename, self.shard[0], self.shard[1]))
+      else:
+        manifest.complete()
+        print("Info: shard %d/%d completed (%s), merge with -M once all shards are done." % (self.shard[0], self.shard[1], manifest.filename))
 
-    return True
+    return not interrupted # False: partial outputs (and shard not completed)
 
 def handlerSIGINT(signalReceived, frame):
   print("WARNING: SIGINT received (eg. CTRL+C), stopping.")
@@ -739,28 +1192,51 @@ def main():
   signal.signal(signal.SIGINT, handlerSIGINT)
 
   ap = argparse.ArgumentParser()
-  ap.add_argument("-d", "--atcFilesDirectory", required=True, help="Source directory with .ATC files in.")
+  ap.add_argument("-d", "--atcFilesDirectory", required=False, help="Source directory with .ATC files in.")
   ap.add_argument("-v", "--verbose", action='store_true', help="print verbose")
   ap.add_argument("-o", "--output-csv-filename", required=False, help="output CSV filename.")
   ap.add_argument("-a", "--alive-ecg-filename", required=False, help="Alive ECG Database filename.")
   ap.add_argument("-P", "--process-atc-files", action="store_true", required=False, help="process ATC files, load records (HRV and SQL) and write CSV output")
+  ap.add_argument("-r", "--resume", action="store_true", help="resume an interrupted run: skip the records (and stages) completed in the journal (output.process-kardia.journal.jsonl)")
+  ap.add_argument("-Q", "--retry-quarantined", action="store_true", help="process again the quarantined records (timed out, or failed in 2 runs in a row, see failures.py)")
+  ap.add_argument("-sq", "--sqi-threshold", type=float, default=gDefaultThreshold, help="signal quality threshold: the records whose SQI (0 - 1, see signalquality.py) is lower skip the QRS detection, HRV and render (default: %.2f: none skipped, 0.2 - 0.3 skips the flat, saturated and noise only strips)" % (gDefaultThreshold))
+  ap.add_argument("-mb", "--memory-budget", type=int, help="memory budget (MB): records are processed at once only while their estimated memory (samples x leads) fits in it (see scheduler.py)")
+  ap.add_argument("-mt", "--trace-memory", action="store_true", help="trace the memory of the Python stages (tracemalloc: peak and largest allocations per stage, slower)")
+  ap.add_argument("-jl", "--json-log", action="store_true", help="also write the log as JSON lines (output.process-kardia.log.jsonl: time, record, stage, level, message)")
+  ap.add_argument("-sh", "--shard", help="process only the shard i/N (0 <= i < N) of the records, into partial outputs (see shards.py)")
+  ap.add_argument("-M", "--merge-shards", action="store_true", help="merge the partial outputs of all shards into the CSV output file")
+  ap.add_argument("-A", "--aggregate", action="store_true", help="write the cohort summary tables (grouped statistics, paired PRE/POST deltas) of the CSV output file (see cohort.py)")
+  ap.add_argument("-E", "--export-edf", action="store_true", help="also write the EDF file of each record (the WFDB record is written directly from the ATC samples)")
+  ap.add_argument("-S", "--shared-memory", action="store_true", help="decode each ATC file once, in process, and share its samples with the next stages through shared memory")
+  ap.add_argument("-W", "--worker-server", nargs='?', const=gDefaultSocket, help="send convert / render jobs to a running worker server (./workerserver.py) instead of launching new interpreters (default socket: %s)" % (gDefaultSocket))
+  ap.add_argument("-B", "--bundle", action="store_true", help="pack the work files of each processed record into one file (work/<record>.bundle.zip, see recordbundle.py)")
   ap.add_argument("-i", "--try-interpret-comments", action="store_true", help="try interpreting comments from Kardia database.")
+  ap.add_argument("-R", "--comment-rules", required=False, help="JSON file of additional comment interpretation rules (see commentrules.py)")
+  ap.add_argument("-nc", "--no-hrv-cache", action="store_true", help="do not use (nor update) the HRV features cache (output.hrv-cache.sqlite)")
+  ap.add_argument("-j", "--cpu-tasks", type=int, help="maximum number of CPU-bound stages (gqrs, ann2rr, get_hrv, ...) running at once (default: from the CPU quota, adjusted at runtime)")
+  ap.add_argument("-nrc", "--no-rr-cleaning", action="store_true", help="compute the hrvanalysis features on the raw RR intervals (no range filter / ectopic beats removal, see rrtools.py)")
+  ap.add_argument("-nr", "--no-results-db", action="store_true", help="do not use the results database (output.process-kardia.sqlite): all records are loaded and the CSV is rewritten")
+  ap.add_argument("-rl", "--reload-results", action="store_true", help="load all records again into the results database (e.g. after changing the comment rules, the Alive database or -nrc)")
   ap.add_argument("-gqrs", "--use-gqrs", action="store_true", help="Use GQRS as QRS detection algorithm")
   ap.add_argument("-ecgpu", "--use-ecgpu", action="store_true", help="Use ECGPU as QRS detection algorithm")
+  ap.add_argument("-qrs", "--qrs-detector", action="append", default=[], choices=getQRSDetectorNames(), help="Use this QRS detector (can be repeated, all detectors run concurrently)")
   #ap.add_argument("-hrv", "--print-hrv-features", action="store_true", help="Show HRV features (by hrv-analysis lib)")
   args = vars(ap.parse_args())
 
   gDebug = args['verbose']
   doProcessATCFiles = args['process_atc_files']
   hasInterpretComments = args['try_interpret_comments']
-  qrsAlgoFlags = QRSAlgorithms.NONE
-  if args['use_gqrs']:
-    print("Info: using GQRS algorithm")
-    qrsAlgoFlags = QRSAlgorithms.setGQRS(qrsAlgoFlags)
-  if args['use_ecgpu']:
-    print("Info: using ECGPU algorihm")
-    qrsAlgoFlags = QRSAlgorithms.setECGPU(qrsAlgoFlags)
-  if args['use_gqrs'] == False and args['use_ecgpu'] == False:
+  qrsDetectorNames = []
+  if args['use_gqrs']: qrsDetectorNames.append('gqrs')
+  if args['use_ecgpu']: qrsDetectorNames.append('ecgpu')
+  for name in args['qrs_detector']:
+    if name not in qrsDetectorNames: qrsDetectorNames.append(name)
+
+  qrsDetectors = []
+  for name in qrsDetectorNames:
+    print("Info: using %s algorithm" % (name.upper()))
+    qrsDetectors.append(getQRSDetector(name))
+  if not qrsDetectors:
     print("Warning: no QRS detection algorithm used!")
 
   # add CURR_DIR + "/"
@@ -777,11 +1253,49 @@ def main():
         print("ERROR: Alive ECG SQLite database '%s' does not exists." % (aliveDbFilename))
         return 1
 
+  shard = None
+  if args['shard'] is not None:
+    try:
+      shard = parseShard(args['shard'])
+    except ValueError as e:
+      print("ERROR: %s" % (str(e)))
+      return 1
+
   r = 0
   if doProcessATCFiles:
+    if atcDirectory is None:
+      print("ERROR: the ATC files directory (-d) is required to process ATC files.")
+      return 1
     print("Info: loading and processing atc files in '%s'" % (atcDirectory))
-    p = Processor()
-    r = p.loadAndWriteCSV(atcDirectory, qrsAlgoFlags, aliveDbFilename, hasInterpretComments)
+    p = Processor(shard)
+    ok = p.loadAndWriteCSV(atcDirectory, qrsDetectors,
+                           aliveDbFilename=aliveDbFilename,
+                           tryInterpretComments=hasInterpretComments,
+                           useSharedMemory=args['shared_memory'],
+                           workerSocket=args['worker_server'],
+                           exportEdf=args['export_edf'],
+                           commentRulesFilename=args['comment_rules'],
+                           useHrvCache=not args['no_hrv_cache'],
+                           maxCpuTasks=args['cpu_tasks'],
+                           useBundle=args['bundle'],
+                           cleanRR=not args['no_rr_cleaning'],
+                           resume=args['resume'],
+                           useResultsDb=not args['no_results_db'],
+                           reloadResults=args['reload_results'],
+                           retryQuarantined=args['retry_quarantined'],
+                           jsonLog=args['json_log'],
+                           memoryBudget=args['memory_budget'] * 1024 * 1024 if args['memory_budget'] is not None else None,
+                           traceMemory=args['trace_memory'],
+                           sqiThreshold=args['sqi_threshold'])
+    r = 0 if ok else 1
+
+  if args['merge_shards']:
+    print("Info: merging shards outputs")
+    r = 0 if mergeShards(CURR_DIR + '/' + 'output.process-kardia.csv') else 1
+
+  if args['aggregate']:
+    print("Info: aggregating the CSV output file")
+    r = 0 if cohort.aggregate(CURR_DIR + '/' + 'output.process-kardia.csv', CURR_DIR + '/' + 'output.process-kardia.cohort') else 1
 
   return r
 
@@ -0,0 +1,240 @@
+#!/usr/local/bin/python3
+
+import os
+import subprocess
+import shutil
+import tempfile
+
+import numpy
+
+# QRS detectors registry
+# --------------------------------------------------------------------------------------------
+# Each QRS detection algorithm is a plugin (QRSDetector) registered by name. For a record
+# already converted to MIT format in work/, all enabled detectors are run concurrently, on the
+# same loaded signal, one job per (detector, lead) (see wfdbexec.py).
+#
+# detect() writes to logFile (a file or a recordlog.RecordLog): subprocess outputs are captured
+# and written to it.
+#
+# Outputs per detector (in work/, <name> is the detector name, N the lead number):
+#  - <recordId>.<name>-leadN                           annotation file (QRS positions)
+#  - <recordId>.<name>-leadN.rr.kubios.txt             RR intervals (ann2rr -V s -i s8)
+#  - <recordId>.output.gethrv-<name>-leadN.txt         get_hrv one line
+#  - <recordId>.output.gethrv-<name>-leadN.verbose.txt get_hrv full output
+
+# WFDB signal name -> lead suffix used in the work files
+gLeads = {'leadI': 'lead1', 'leadII': 'lead2'}
+
+# RecordSignal
+# Samples of a record loaded once (from rdsamp output or shared memory) and shared by all
+# detectors.
+# --------------------------------------------------------------------------------------------
+class RecordSignal:
+  def __init__(self, frequency, leads, gain=1.0):
+    self.frequency = frequency # Hz
+    self.leads = leads # {'leadI': numpy.array, ...} in WFDB signal order
+    self.gain = gain # leads units per mV
+
+  def leadIndex(self, lead):
+    return list(self.leads.keys()).index(lead)
+
+  def readHeaderFrequency(heaFilename):
+    # first line of a WFDB header: "<record> <nsig> <freq> <nsamples> ..."
+    with open(heaFilename, mode='r') as f:
+      fields = f.readline().split()
+    return float(fields[2].split('/')[0])
+
+  def readHeaderSignals(heaFilename): # return signal names (description field of each signal line)
+    with open(heaFilename, mode='r') as f:
+      lines = [line for line in f if line.strip() and not line.startswith('#')]
+    nbSignals = int(lines[0].split()[1])
+    return [line.split(None, 8)[8].strip() if len(line.split(None, 8)) > 8 else '' for line in lines[1:1 + nbSignals]]
+
+  def fromWorkFiles(workDir, recordId):
+    heaFilename = os.path.join(workDir, recordId + '.hea')
+    samplesFilename = os.path.join(workDir, recordId + '.output.samples.txt')
+
+    with open(samplesFilename, mode='r') as f:
+      titles = [t.strip().strip("'") for t in f.readline().split('\t')]
+      f.readline() # units
+      data = numpy.loadtxt(f, delimiter='\t', ndmin=2)
+
+    leads = {}
+    for i in range(1, len(titles)):
+      leads[titles[i]] = data[:, i]
+
+    return RecordSignal(RecordSignal.readHeaderFrequency(heaFilename), leads)
+
+  def fromSharedSignal(sharedSignal): # int16 views on the shared segment (see sharedsignals.py)
+    leads = {}
+    for lead in sharedSignal.leadNames():
+      leads[lead] = sharedSignal.digital(lead)
+    return RecordSignal(sharedSignal.frequency, leads, sharedSignal.gain())
+
+# QRSDetector
+# Common interface of the detectors: detectCommand() / detect() write the annotation file of
+# one lead, then the RR and get_hrv outputs are derived from it (identical for every detector).
+# --------------------------------------------------------------------------------------------
+class QRSDetector:
+  name = None
+
+  def label(self): return self.name.upper()
+
+  def annotator(self, lead): return "%s-%s" % (self.name, gLeads[lead])
+
+  def workFilename(self, workDir, recordId, extension):
+    return os.path.join(workDir, recordId + extension)
+
+  def rrKubiosFilename(self, workDir, recordId, lead):
+    return self.workFilename(workDir, recordId, ".%s.rr.kubios.txt" % (self.annotator(lead)))
+
+  def getHrvFilename(self, workDir, recordId, lead):
+    return self.workFilename(workDir, recordId, ".output.gethrv-%s.txt" % (self.annotator(lead)))
+
+  def getHrvVerboseFilename(self, workDir, recordId, lead):
+    return self.workFilename(workDir, recordId, ".output.gethrv-%s.verbose.txt" % (self.annotator(lead)))
+
+  def isDetected(self, workDir, recordId, lead):
+    return os.path.isfile(self.rrKubiosFilename(workDir, recordId, lead)) and os.path.isfile(self.getHrvFilename(workDir, recordId, lead))
+
+  # argv of an external detector (run by wfdbexec.py like the other WFDB tools), or None if
+  # detection is done by detect() (called in a thread)
+  def detectCommand(self, workDir, recordId, lead, recordSignal):
+    return None
+
+  # timeout (sec): the detector process is killed (detect() runs in a thread that wfdbexec.py
+  # abandons on timeout, the process must not outlive it)
+  def detect(self, workDir, recordId, lead, recordSignal, logFile, timeout=None): # return True on success
+    cmd = self.detectCommand(workDir, recordId, lead, recordSignal)
+    if cmd is None:
+      raise NotImplementedError("%s: detector without detectCommand() must implement detect()" % (type(self).__name__))
+    print(' '.join(cmd), file=logFile, flush=True)
+    return self.runLogged(cmd, logFile, timeout, cwd=workDir) == 0
+
+  def runLogged(self, cmd, logFile, timeout, **kwargs): # return the return code, None on timeout (process killed)
+    try:
+      process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=timeout, **kwargs)
+    except subprocess.TimeoutExpired as e:
+      output = e.stdout.decode('utf-8', 'replace') if isinstance(e.stdout, bytes) else (e.stdout or '')
+      logFile.write(output)
+      print("%s: timeout (%s sec), killed" % (cmd[0], str(timeout)), file=logFile, flush=True)
+      return None
+    logFile.write(process.stdout)
+    logFile.flush()
+    return process.returncode
+
+  # commands deriving the RR and get_hrv outputs from the annotation file, once detected:
+  # [(name, argv, stdoutFilename), ...], independent from each other
+  def postCommands(self, workDir, recordId, lead):
+    annotator = self.annotator(lead)
+    return [('ann2rr', ['ann2rr', '-r', recordId, '-a', annotator, '-V', 's', '-i', 's8'], self.rrKubiosFilename(workDir, recordId, lead)),
+            ('get_hrv', ['get_hrv', '-L', '-m', '-M', '-p', '50', recordId, annotator], self.getHrvFilename(workDir, recordId, lead)),
+            ('get_hrv', ['get_hrv', '-m', '-M', '-p', '50', recordId, annotator], self.getHrvVerboseFilename(workDir, recordId, lead))]
+
+# GQRSDetector
+# --------------------------------------------------------------------------------------------
+class GQRSDetector(QRSDetector):
+  name = 'gqrs'
+
+  def detectCommand(self, workDir, recordId, lead, recordSignal):
+    return ['gqrs', '-r', recordId, '-o', self.annotator(lead), '-s', lead]
+
+# ECGPUDetector
+# ecgpuwave leaves fort.20 / fort.21 in its current directory: every run gets its own
+# directory so that leads and records can be detected concurrently.
+# --------------------------------------------------------------------------------------------
+class ECGPUDetector(QRSDetector):
+  name = 'ecgpu'
+
+  def detect(self, workDir, recordId, lead, recordSignal, logFile, timeout=None):
+    annotator = self.annotator(lead)
+    env = dict(os.environ)
+    env['WFDB'] = ". %s %s" % (os.path.abspath(workDir), env.get('WFDB', ''))
+
+    with tempfile.TemporaryDirectory(prefix='ecgpu-') as runDir:
+      cmd = ['ecgpuwave', '-r', recordId, '-a', annotator, '-s', str(recordSignal.leadIndex(lead))]
+      print(' '.join(cmd), file=logFile, flush=True)
+      if self.runLogged(cmd, logFile, timeout, cwd=runDir, env=env) != 0:
+        return False
+
+      annFilename = recordId + '.' + annotator
+      if os.path.isfile(os.path.join(runDir, annFilename)):
+        shutil.move(os.path.join(runDir, annFilename), os.path.join(workDir, annFilename))
+
+    return os.path.isfile(os.path.join(workDir, annFilename))
+
+# NumpyQRSDetector
+# In-process detector (Pan-Tompkins like: band-pass, derivative, squaring, moving window
+# integration, adaptive threshold, 250 ms refractory period). Annotations are written with
+# wrann so that the RR and get_hrv outputs are produced the same way as for gqrs.
+# --------------------------------------------------------------------------------------------
+class NumpyQRSDetector(QRSDetector):
+  name = 'npqrs'
+
+  def movingAverage(signal, width): # centered, same length as signal
+    width = max(1, int(width))
+    c = numpy.cumsum(numpy.concatenate(([0.0], signal)))
+    avg = (c[width:] - c[:-width]) / width
+    before = (len(signal) - len(avg)) // 2
+    after = len(signal) - len(avg) - before
+    return numpy.concatenate((numpy.full(before, avg[0]), avg, numpy.full(after, avg[-1])))
+
+  def findPeaks(signal, frequency): # return sample indexes of the R peaks
+    x = numpy.asarray(signal, dtype=numpy.float64)
+    if len(x) < frequency:
+      return numpy.zeros(0, dtype=numpy.int64)
+
+    # band-pass (~5-15 Hz): remove baseline then smooth
+    filtered = x - NumpyQRSDetector.movingAverage(x, 0.1 * frequency)
+    filtered = NumpyQRSDetector.movingAverage(filtered, 0.025 * frequency)
+    energy = numpy.gradient(filtered) ** 2
+    integrated = NumpyQRSDetector.movingAverage(energy, 0.15 * frequency)
+
+    threshold = 0.3 * numpy.percentile(integrated, 99)
+    above = numpy.concatenate(([False], integrated > threshold, [False]))
+    edges = numpy.flatnonzero(numpy.diff(above.astype(numpy.int8)))
+    starts, ends = edges[0::2], edges[1::2]
+
+    peaks = []
+    refractory = int(0.25 * frequency)
+    for start, end in zip(starts, ends):
+      peak = start + int(numpy.argmax(numpy.abs(filtered[start:end])))
+      if peaks and peak - peaks[-1] < refractory:
+        if abs(filtered[peak]) > abs(filtered[peaks[-1]]): peaks[-1] = peak
+        continue
+      peaks.append(peak)
+
+    return numpy.array(peaks, dtype=numpy.int64)
+
+  def detect(self, workDir, recordId, lead, recordSignal, logFile, timeout=None):
+    peaks = NumpyQRSDetector.findPeaks(recordSignal.leads[lead], recordSignal.frequency)
+    chan = recordSignal.leadIndex(lead)
+
+    # wrann reads the rdann text format: time, sample, type, sub, chan, num
+    lines = []
+    for peak in peaks:
+      seconds = peak / recordSignal.frequency
+      time = "%d:%06.3f" % (seconds // 60, seconds % 60)
+      lines.append("%12s %9d %5s %4d %4d %4d\n" % (time, peak, 'N', 0, chan, 0))
+
+    cmd = ['wrann', '-r', recordId, '-a', self.annotator(lead)]
+    print("%s (%d beats)" % (' '.join(cmd), len(peaks)), file=logFile, flush=True)
+    return self.runLogged(cmd, logFile, timeout, cwd=workDir, input=''.join(lines)) == 0
+
+# Registry
+# --------------------------------------------------------------------------------------------
+gQRSDetectors = {}
+
+def registerQRSDetector(detectorClass):
+  gQRSDetectors[detectorClass.name] = detectorClass
+  return detectorClass
+
+def getQRSDetector(name): # return a QRSDetector instance or None
+  detectorClass = gQRSDetectors.get(name.lower())
+  return detectorClass() if detectorClass is not None else None
+
+def getQRSDetectorNames(): return list(gQRSDetectors.keys())
+
+registerQRSDetector(GQRSDetector)
+registerQRSDetector(ECGPUDetector)
+registerQRSDetector(NumpyQRSDetector)
@@ -7,6 +7,7 @@ import json
 import argparse
 import csv
 import datetime
+from concurrent import futures
 
 import numpy
 import pyedflib
@@ -14,7 +15,15 @@ import pyedflib
 from pyedflib import highlevel
 import matplotlib.pyplot as plt
 
-from hrvanalysis import remove_outliers, remove_ectopic_beats, interpolate_nan_values, get_time_domain_features, get_frequency_domain_features, get_poincare_plot_features, plot_poincare
+from sharedsignals import SharedSignal
+from recordbundle import RecordBundle, gBundleExtension
+from signalquality import readWorkSignals
+from rrtools import cleanRR, timeDomain
+from scheduler import cpuLimit
+from reportpdf import ReportPdf, compressImage
+from atc2edf import recordWorkName
+
+from hrvanalysis import interpolate_nan_values, get_time_domain_features, get_frequency_domain_features, get_poincare_plot_features, plot_poincare
 
 
 CURR_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -146,6 +155,7 @@ def plotRR(times, sample, rrTimes, rrValues, title, lead, rrLabel, saveInsteadOf
 
   if saveInsteadOfPlot:
     plt.savefig(saveRecordName, bbox_inches='tight', dpi=300)
+    plt.close() # do not accumulate figures (e.g. in a worker server)
   else:
     plt.show()
 
@@ -218,6 +228,223 @@ def plotLeadWithRR(leadTitle, times, samples, rr1Title, rr1Times, rr1Values, rr2
   plt.show()
 
 
+def makeFilename(rname, ext):
+  if rname[0] == '/':
+    output = rname + ext
+  else:
+    output = CURR_DIR + '/' + rname + ext
+  return output
+
+# plot (or save to recordName.output.<qrsDetector>-lead1.png) leadI with the RR of a QRS detector
+# return the output filename if saved
+def plotLeadIWithRR(recordName, qrsDetector, saveInsteadOfPlot=False, sharedMemoryName=None):
+  print(" *** Plotting LeadI wtih RR calculated by %s." % (qrsDetector.upper()))
+
+  outputFilename = makeFilename(recordName, ".output.%s-lead1.png" % (qrsDetector)) if saveInsteadOfPlot else None
+
+  if saveInsteadOfPlot and os.path.isfile(outputFilename):
+    print("Info: output file (%s) already exists, skipping." % (outputFilename))
+    return outputFilename
+
+  times, leadI, timesGqrsLead1, valuesGqrsLead1 = loadLeadIWithRR(recordName, qrsDetector, sharedMemoryName)
+
+  plotRR(times, leadI, timesGqrsLead1, valuesGqrsLead1, "LeadI - " + qrsDetector.upper(), "leadI", qrsDetector, saveInsteadOfPlot, outputFilename)
+  return outputFilename
+
+# return (times, leadI samples, RR times, RR values) of a record: from its bundle, its shared
+# memory segment or its samples file, and the RR of a QRS detector
+def loadLeadIWithRR(recordName, qrsDetector, sharedMemoryName=None):
+  samplesCsvFile = makeFilename(recordName, ".output.samples.txt")
+  rrKubiosGqrsLead1File = makeFilename(recordName, ".%s-lead1.rr.kubios.txt" % (qrsDetector))
+
+  bundle = RecordBundle.open(makeFilename(recordName, ""))
+  if bundle is not None and not bundle.hasAnnotator("%s-lead1" % (qrsDetector)):
+    bundle.close()
+    bundle = None
+
+  if bundle is not None:
+    # bundled record (see recordbundle.py): signals are mapped from the bundle
+    with bundle:
+      times = bundle.times()
+      samples = {'leadI': bundle.physical('leadI')}
+      timesGqrsLead1, valuesGqrsLead1 = bundle.rr("%s-lead1" % (qrsDetector))
+  else:
+    if sharedMemoryName is not None:
+      with SharedSignal.attach(sharedMemoryName) as sharedSignal:
+        times = sharedSignal.times()
+        samples = {lead: sharedSignal.physical(lead) for lead in sharedSignal.leadNames()}
+    elif not os.path.isfile(samplesCsvFile) and os.path.isfile(makeFilename(recordName, ".dat")):
+      # converted in shared memory mode: no samples dump, signals read from the 'dat'
+      digital, leads, frequency, gain = readWorkSignals(makeFilename(recordName, ""))
+      times = numpy.arange(digital.shape[1]) / frequency
+      samples = {lead: digital[i] / gain for i, lead in enumerate(leads)}
+    else:
+      times, samples = readSamples(samplesCsvFile)
+    timesGqrsLead1, valuesGqrsLead1 = readKubiosRR(rrKubiosGqrsLead1File)
+
+  return times, samples['leadI'], timesGqrsLead1, valuesGqrsLead1
+
+# Report
+# --------------------------------------------------------------------------------------------
+# One page per record (ECG strip with the detected beats, tachogram, Poincare plot), rendered
+# by a pool of worker processes (Agg canvas, no pyplot state) and streamed, in record order,
+# into a multi-page PDF (see reportpdf.py). At most 2 pages per worker are in flight, so the
+# memory does not grow with the number of records.
+
+gReportPageSize = (11.69, 8.27) # A4 landscape (inches)
+
+def readRecordList(filename): # record names: one per line, or the RECORD_NAME column of the CSV output (record ids)
+  with open(filename, mode='r', newline='') as f:
+    if filename.endswith('.csv'):
+      reader = csv.reader(f, delimiter=';', quotechar='"')
+      column = next(reader).index('RECORD_NAME')
+      names = [row[column] for row in reader if len(row) > column]
+    else:
+      names = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+  return list(dict.fromkeys(names)) # unique, in order (CSV: one row per QRS detector)
+
+# resolveRecordNames
+# record names (data/b6), work names (data/work/b6) or record ids (b6, RECORD_NAME column of
+# the CSV output) -> work names; ids are looked up in the work directories under directory
+# return ([workName, ...], [error, ...])
+# --------------------------------------------------------------------------------------------
+def resolveRecordNames(names, directory):
+  works = {} # {recordId: [workName, ...]}
+  if any('/' not in name for name in names):
+    for root, dirs, files in os.walk(directory):
+      if os.path.basename(root) != 'work':
+        continue
+      for filename in files:
+        for extension in ['.hea', '.output.samples.txt', gBundleExtension]:
+          if filename.endswith(extension):
+            workName = os.path.join(root, filename[:-len(extension)])
+            recordWorks = works.setdefault(filename[:-len(extension)], [])
+            if workName not in recordWorks: recordWorks.append(workName)
+
+  workNames, errors = [], []
+  for name in names:
+    if '/' in name:
+      workNames.append(name if os.path.basename(os.path.dirname(name)) == 'work' else recordWorkName(name))
+    elif len(works.get(name, [])) == 1:
+      workNames.append(works[name][0])
+    elif name in works:
+      errors.append("record id '%s' is ambiguous: %s" % (name, ', '.join(sorted(works[name]))))
+    else:
+      errors.append("record id '%s' not found in the work directories of '%s'" % (name, directory))
+  return workNames, errors
+
+def reportRecordName(workName): # data/work/b6 -> data/b6 (relative to the script directory)
+  return os.path.relpath(os.path.join(os.path.dirname(os.path.dirname(workName)), os.path.basename(workName)), CURR_DIR)
+
+def drawReportPage(figure, workName, qrsDetector):
+  recordName = reportRecordName(workName)
+  times, leadI, rrTimes, rrValues = loadLeadIWithRR(workName, qrsDetector)
+  leadI = numpy.asarray(leadI)
+  rrTimes = numpy.asarray(rrTimes, dtype=numpy.float64)
+  rrMsec = 1000.0 * numpy.asarray(rrValues, dtype=numpy.float64)
+
+  nn, cleaning = cleanRR(rrMsec, 300, 2000, 'malik')
+  stats = timeDomain(nn, numpy.ones(len(nn), dtype=bool))
+  diffs = numpy.diff(nn)
+  sd1 = numpy.std(diffs, ddof=1) / numpy.sqrt(2.0) if len(diffs) > 1 else 0.0
+  sd2 = numpy.sqrt(max(0.0, 2.0 * stats['sdnn'] ** 2 - sd1 ** 2))
+
+  figure.suptitle("%s - %s - %d beats - NN/RR %.2f - AVNN %.0f ms - SDNN %.1f ms - rMSSD %.1f ms" %
+                  (recordName, qrsDetector.upper(), len(rrMsec) + 1, cleaning['nnRr'], stats['avnn'], stats['sdnn'], stats['rmssd']))
+  grid = figure.add_gridspec(2, 3, height_ratios=[1, 1])
+
+  strip = figure.add_subplot(grid[0, :])
+  strip.plot(times, leadI, linewidth=0.5, label='leadI')
+  if len(leadI):
+    strip.vlines(x=rrTimes, ymin=leadI.min(), ymax=leadI.max(), color="orange", linewidth=0.5, label=qrsDetector)
+  strip.set_xlabel('time (sec)')
+  strip.set_ylabel('mV')
+  strip.legend(loc='upper right')
+
+  tachogram = figure.add_subplot(grid[1, :2])
+  tachogram.plot(rrTimes, rrMsec, 'x-', linewidth=0.5, markersize=3, label='RR')
+  tachogram.plot(rrTimes, nn, linewidth=1, color="green", label='NN (cleaned)')
+  tachogram.set_xlabel('time (sec)')
+  tachogram.set_ylabel('interval (msec)')
+  tachogram.legend(loc='upper right')
+
+  poincare = figure.add_subplot(grid[1, 2])
+  poincare.plot(nn[:-1], nn[1:], '.', markersize=4)
+  poincare.set_xlabel('NN n (msec)')
+  poincare.set_ylabel('NN n+1 (msec)')
+  poincare.set_title("SD1 %.1f - SD2 %.1f" % (sd1, sd2))
+  poincare.set_aspect('equal', adjustable='datalim')
+
+# worker process: return (recordName, width, height, compressed RGB, error or None)
+def renderReportPage(workName, qrsDetector, dpi):
+  from matplotlib.figure import Figure
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+  figure = Figure(figsize=gReportPageSize, dpi=dpi, constrained_layout=True)
+  canvas = FigureCanvasAgg(figure)
+  recordName = reportRecordName(workName)
+  error = None
+  try:
+    drawReportPage(figure, workName, qrsDetector)
+  except Exception as e: # the page says why
+    error = "%s: %s" % (type(e).__name__, str(e))
+    figure.clear()
+    figure.text(0.5, 0.5, "%s\n\n%s" % (recordName, error), ha='center', va='center')
+  canvas.draw()
+  rgba = canvas.buffer_rgba()
+  width, height = canvas.get_width_height()
+  return recordName, width, height, compressImage(rgba), error
+
+def writeReport(recordNames, qrsDetector, outputFilename, dpi=100, maxWorkers=None): # recordNames: work names (see resolveRecordNames())
+  maxWorkers = maxWorkers or max(1, int(cpuLimit()))
+  pageWidth, pageHeight = gReportPageSize[0] * 72, gReportPageSize[1] * 72
+  print("Info: report: %d record(s), %d worker(s) -> '%s'" % (len(recordNames), maxWorkers, outputFilename))
+
+  errors = []
+  with ReportPdf(outputFilename) as pdf, futures.ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+    pending = {} # {index: future}, at most 2 per worker
+    nextIndex = 0
+    for index, recordName in enumerate(recordNames):
+      pending[index] = executor.submit(renderReportPage, recordName, qrsDetector, dpi)
+      while len(pending) >= 2 * maxWorkers or (index == len(recordNames) - 1 and pending):
+        recordName, width, height, compressedRgb, error = pending.pop(nextIndex).result()
+        pdf.addPage(width, height, compressedRgb, recordName, pageWidth, pageHeight)
+        if error is not None:
+          print("WARNING: report: %s: %s" % (recordName, error))
+          errors.append(recordName)
+        nextIndex += 1
+        if nextIndex % 50 == 0:
+          print("Info: report: %d/%d page(s)" % (nextIndex, len(recordNames)))
+
+  print("Info: report: %d page(s) written (%d record(s) failed)" % (len(recordNames), len(errors)))
+  return 0 if not errors else 1
+
+def mainReport(argv):
+  ap = argparse.ArgumentParser(prog="record-viewer.py report", description="multi-page PDF report: ECG strip with beats, tachogram and Poincare plot per record")
+  ap.add_argument("records", help="record names: one per line, or the CSV output (output.process-kardia.csv)")
+  ap.add_argument("-d", "--directory", default=CURR_DIR, help="directory whose work directories are searched for the record ids of the CSV output (default: the script directory)")
+  ap.add_argument("-o", "--output", default="report.pdf", help="PDF file (default: report.pdf)")
+  ap.add_argument("-q", "--qrs-detector", default="gqrs", help="QRS detector whose beats are plotted (default: gqrs)")
+  ap.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: available CPUs)")
+  ap.add_argument("-dpi", "--dpi", type=int, default=100, help="page resolution (default: 100)")
+  args = vars(ap.parse_args(argv))
+
+  recordNames = readRecordList(args['records'])
+  if not recordNames:
+    print("ERROR: no record in '%s'." % (args['records']))
+    return 1
+  recordNames, errors = resolveRecordNames(recordNames, args['directory'])
+  for error in errors:
+    print("ERROR: %s" % (error))
+  if not recordNames:
+    return 1
+  r = writeReport(recordNames, args['qrs_detector'], args['output'], args['dpi'], args['jobs'])
+  if errors:
+    print("ERROR: %d record id(s) not found or ambiguous, missing from the report." % (len(errors)))
+    return 1
+  return r
+
+
 # FUNCTIONS TO IMPLEMENTS:
 """
 X plot normal: 6 signals one below the other
@@ -240,25 +467,15 @@ def hrvAnalysis(times, samples, rrTimes, rrValues):
     return secs
 
   rrValuesMsec = listSecToMsec(rrValues)
- 
-  """
-  # This remove outliers from signal
-  rr_intervals_without_outliers = remove_outliers(rr_intervals=rrValuesMsec,
-                                                  low_rri=300, high_rri=2000)
-
-  # This replace outliers nan values with linear interpolation
-  interpolated_rr_intervals = interpolate_nan_values(rr_intervals=rr_intervals_without_outliers,
-                                                     interpolation_method="linear")
-
-
-  # This remove ectopic beats from signal
-  nn_intervals_list = remove_ectopic_beats(rr_intervals=interpolated_rr_intervals, method="malik")
 
-  # This replace ectopic beats nan values with linear interpolation
-  interpolated_nn_intervals = interpolate_nan_values(rr_intervals=nn_intervals_list)
+  # range filter, ectopic beats (malik) and linear interpolation (see rrtools.py)
+  nnValues, cleaning = cleanRR(rrValuesMsec, 300, 2000, 'malik')
+  rrValuesMsec = list(nnValues)
 
-  time_domain_features = get_time_domain_features(interpolated_nn_intervals)
-  """
+  print("")
+  print("RR CLEANING:")
+  for k in cleaning.keys():
+    print(" %s : %s" % (k, str(cleaning[k])))
 
   time_domain_features = get_time_domain_features(rrValuesMsec)
 
@@ -354,13 +571,19 @@ def plotCompareWithInterpolatedValues(times, samples, rrTimes, rrValues):
 
 def main():
 
-  ap = argparse.ArgumentParser()
+  # ./record-viewer.py report <records> [...]
+  if len(sys.argv) > 1 and sys.argv[1] == 'report':
+    return mainReport(sys.argv[2:])
+
+  ap = argparse.ArgumentParser(epilog="report mode: %(prog)s report -h")
   ap.add_argument("-r1", "--record1Name", required=True, help="record 1 name") # type=int, default=42, action=
   ap.add_argument("-r2", "--record2Name", required=False, help="record 2 name") # type=int, default=42, action=
   ap.add_argument("-v", "--verbose", action='store_true', help="print verbose")
   ap.add_argument("-o", "--output", action='store_true', help="Save figure to file of recordName.output.gqrs-lead1.png")
   ap.add_argument("-6", "--plot-6-signals", action='store_true', help="Plot 6 signals one below the other")
   ap.add_argument("-gqrs", "--plot-leadI-with-rr-gqrs", action="store_true", help="Plot Record 1 leadI and RR calculated by GQRS")
+  ap.add_argument("-shm", "--shared-memory-name", required=False, help="read record 1 samples from this shared memory segment (see sharedsignals.py) instead of its samples file")
+  ap.add_argument("-q", "--qrs-detector", default="gqrs", help="QRS detector whose RR are plotted with -gqrs (default: gqrs)")
   ap.add_argument("-cmpqrs", "--plot-compare-record12-with-rr-gqrs", action="store_true", help="Plot to compare record 1 and record 2 with RR calculated by GQRS")
   ap.add_argument("-cmpinterpolated", "--plot-compare-leadI-with-rr-gqrs-interpolated", action="store_true", help="Plot to compare record1 with QRS interpolated or not.")
   #ap.add_argument("-2rr", "--plot-leadII-with-rr-gqrs-ecgpu", action="store_true", help="Plot leadII with both GQRS and ECGPU")
@@ -373,13 +596,6 @@ def main():
   #doPlotLeadIIWithRRs = args['plot_leadII_with_rr_gqrs_ecgpu']
   doPrintHrvFeatures = args['print_hrv_features']
 
-  def makeFilename(rname, ext):
-    if rname[0] == '/':
-      output = rname + ext
-    else:
-      output = CURR_DIR + '/' + rname + ext
-    return output
-
   if args['plot_6_signals']:
     print(" *** Plotting 6 signals")
     samplesCsvFile = makeFilename(args['record1Name'], ".output.samples.txt")
@@ -389,21 +605,7 @@ def main():
     plotAllSignals(times, samples)
 
   if args['plot_leadI_with_rr_gqrs']:
-    print(" *** Plotting LeadI wtih RR calculated by GQRS.")
-
-    samplesCsvFile = makeFilename(args['record1Name'], ".output.samples.txt")
-    rrKubiosGqrsLead1File = makeFilename(args['record1Name'], ".gqrs-lead1.rr.kubios.txt")
-
-    saveInsteadOfPlot = True if args['output'] else False
-    outputFilename = makeFilename(args['record1Name'], ".output.gqrs-lead1.png") if args['output'] else None
-
-    times, samples = readSamples(samplesCsvFile)
-    timesGqrsLead1, valuesGqrsLead1 = readKubiosRR(rrKubiosGqrsLead1File)
-   
-    if args['output'] and os.path.isfile(outputFilename):
-      print("Info: output file (%s) already exists, skipping." % (outputFilename))
-    else:
-      plotRR(times, samples['leadI'], timesGqrsLead1, valuesGqrsLead1, "LeadI - GQRS", "leadI", "gqrs", saveInsteadOfPlot, outputFilename)
+    plotLeadIWithRR(args['record1Name'], args['qrs_detector'], args['output'], args['shared_memory_name'])
 
   if args['plot_compare_record12_with_rr_gqrs']:
     print(" *** Plotting to compare LeadI from records 1 and 2 with RR calculated by GQRS.")
@@ -0,0 +1,223 @@
+#!/usr/local/bin/python3
+
+import os
+import io
+import json
+import time
+import glob
+import struct
+import zipfile
+
+import numpy
+
+# Record bundle
+# --------------------------------------------------------------------------------------------
+# One file per record (<work>/<recordId>.bundle.zip) instead of the dozen files left in work/
+# by the WFDB tools and record-viewer (.hea, .dat, annotations, .rr.kubios.txt, get_hrv
+# outputs, desc, cmds, png).
+#
+# Zip without compression (ZIP_STORED), so that a member can be memory mapped in place:
+#  - index.json                   {recordId, frequency, nbSamples, leads, gains, baselines,
+#                                   annotators, members, created}
+#  - <ext>                        the work files, named without '<recordId>.' (e.g. 'hea',
+#                                   'dat', 'gqrs-lead1', 'output.gethrv-gqrs-lead1.txt')
+#  - rr/<annotator>.npy           RR series (float64, shape (n, 2): time, interval in sec)
+#
+# The samples text dump (.output.samples.txt) is not kept: signals are read from the 'dat'
+# member (format 16, interleaved frames) as a memory mapped int16 array.
+#
+# extract() restores the work files (e.g. to run a new QRS detector on a bundled record).
+
+gBundleExtension = '.bundle.zip'
+gSkippedExtensions = ['.output.samples.txt', gBundleExtension]
+
+def bundleFilename(workingRname): return workingRname + gBundleExtension
+
+def readKubiosRR(rrKubiosFile): # numpy array (n, 2): time, interval (sec)
+  if os.path.getsize(rrKubiosFile) == 0:
+    return numpy.zeros((0, 2))
+  return numpy.loadtxt(rrKubiosFile, delimiter='\t', usecols=(0, 1), ndmin=2)
+
+def parseHeader(heaText): # return {frequency, nbSamples, leads, gains, baselines, formats}
+  lines = [line for line in heaText.splitlines() if line.strip() and not line.startswith('#')]
+  fields = lines[0].split()
+  header = {'frequency': float(fields[2].split('/')[0]), 'nbSamples': int(fields[3]) if len(fields) > 3 else 0,
+            'leads': [], 'gains': [], 'baselines': [], 'formats': []}
+
+  for line in lines[1:1 + int(fields[1])]:
+    fields = line.split(None, 8)
+    # gain field: "gain(baseline)/units", baseline defaults to the ADC zero
+    gain = fields[2].split('/')[0] if len(fields) > 2 else '200'
+    baseline = int(fields[4]) if len(fields) > 4 else 0
+    if '(' in gain:
+      gain, baseline = gain.rstrip(')').split('(')
+    header['gains'].append(float(gain) if float(gain) != 0 else 200.0) # 0: uncalibrated, WFDB default
+    header['baselines'].append(int(baseline))
+    header['formats'].append(fields[1])
+    header['leads'].append(fields[8].strip() if len(fields) > 8 else '')
+  return header
+
+def parseAnnotationSamples(data): # sample numbers of the annotations of a MIT annotation file (bytes)
+  data = numpy.frombuffer(data, dtype='<u2')
+  samples = []
+  sample = 0
+  i = 0
+  while i < len(data):
+    code, value = int(data[i]) >> 10, int(data[i]) & 0x3ff
+    i += 1
+    if code == 0 and value == 0: # end of file
+      break
+    elif code == 59: # SKIP: 32 bits interval (PDP-11 order)
+      skip = (int(data[i]) << 16) | int(data[i + 1])
+      sample += skip - (1 << 32) if skip >= 1 << 31 else skip
+      i += 2
+    elif code == 63: # AUX: value bytes, padded to a word
+      i += (value + 1) // 2
+    elif code >= 60: # NUM, SUB, CHN
+      continue
+    else:
+      sample += value
+      samples.append(sample)
+  return numpy.array(samples, dtype=numpy.int64)
+
+# RecordBundle
+# --------------------------------------------------------------------------------------------
+class RecordBundle:
+  def __init__(self, filename):
+    self.filename = filename
+    self.zip = zipfile.ZipFile(filename, mode='r')
+    self.index = json.loads(self.zip.read('index.json').decode('utf-8'))
+    self.signals = None
+
+  def __enter__(self): return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+    return False
+
+  def close(self):
+    self.signals = None
+    if self.zip is not None:
+      self.zip.close()
+      self.zip = None
+
+  def open(workingRname): # return a RecordBundle or None
+    filename = bundleFilename(workingRname)
+    return RecordBundle(filename) if os.path.isfile(filename) else None
+
+  # write
+  # Pack the work files of a record, return the bundle filename.
+  # removeFiles: remove the packed work files (and the samples text dump)
+  # ------------------------------------------------------------------------------------------
+  def write(workDir, recordId, removeFiles=False):
+    prefix = os.path.join(workDir, recordId + '.')
+    filename = os.path.join(workDir, recordId + gBundleExtension)
+
+    files = {}
+    for path in sorted(glob.glob(glob.escape(prefix) + '*')):
+      extension = path[len(prefix):]
+      if not os.path.isfile(path) or any(('.' + extension).endswith(skipped) for skipped in gSkippedExtensions):
+        continue
+      files[extension] = path
+
+    # a previous bundle of the record: its members are kept unless replaced by a work file
+    previous = RecordBundle(filename) if os.path.isfile(filename) else None
+    if 'hea' not in files and previous is None:
+      raise ValueError("RecordBundle: no header file (%shea)." % (prefix))
+
+    with open(files['hea'], mode='r') if 'hea' in files else io.StringIO(previous.readText('hea')) as f:
+      header = parseHeader(f.read())
+
+    annotators = set(previous.index['annotators']) if previous is not None else set()
+    tmpFilename = filename + '.tmp'
+    with zipfile.ZipFile(tmpFilename, mode='w', compression=zipfile.ZIP_STORED) as z:
+      for extension, path in files.items():
+        z.write(path, extension)
+        if extension.endswith('.rr.kubios.txt'):
+          annotator = extension[:-len('.rr.kubios.txt')]
+          buffer = io.BytesIO()
+          numpy.save(buffer, readKubiosRR(path))
+          z.writestr('rr/%s.npy' % (annotator), buffer.getvalue())
+          annotators.add(annotator)
+
+      if previous is not None:
+        for name in previous.zip.namelist():
+          if name == 'index.json' or name in files or (name.startswith('rr/') and name[3:-4] + '.rr.kubios.txt' in files):
+            continue
+          z.writestr(previous.zip.getinfo(name), previous.zip.read(name))
+        previous.close()
+
+      index = {'recordId': recordId, 'frequency': header['frequency'], 'nbSamples': header['nbSamples'],
+               'leads': header['leads'], 'gains': header['gains'], 'baselines': header['baselines'],
+               'formats': header['formats'], 'annotators': sorted(annotators), 'created': time.time()}
+      index['members'] = sorted(z.namelist() + ['index.json'])
+      z.writestr('index.json', json.dumps(index, indent=1))
+
+    os.replace(tmpFilename, filename)
+
+    if removeFiles:
+      for path in files.values():
+        os.remove(path)
+      samplesFilename = prefix + 'output.samples.txt'
+      if os.path.isfile(samplesFilename):
+        os.remove(samplesFilename)
+    return filename
+
+  def extract(self, workDir): # restore the work files of the record
+    recordId = self.index['recordId']
+    for name in self.zip.namelist():
+      if name == 'index.json' or name.startswith('rr/'):
+        continue
+      with open(os.path.join(workDir, recordId + '.' + name), mode='wb') as f:
+        f.write(self.zip.read(name))
+
+  # readers
+  # ------------------------------------------------------------------------------------------
+  def has(self, name): return name in self.index['members']
+
+  def hasAnnotator(self, annotator): return annotator in self.index['annotators']
+
+  def isDetected(self, annotator): # RR and get_hrv outputs are in the bundle
+    return self.hasAnnotator(annotator) and self.has('output.gethrv-%s.txt' % (annotator))
+
+  def readText(self, name): return self.zip.read(name).decode('utf-8')
+
+  def memberOffset(self, name): # offset of the (stored) member data in the bundle file
+    info = self.zip.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+      raise ValueError("RecordBundle: member (%s) is compressed, cannot be mapped." % (name))
+    with open(self.filename, mode='rb') as f:
+      f.seek(info.header_offset)
+      localHeader = f.read(30)
+    nameLength, extraLength = struct.unpack('<HH', localHeader[26:30])
+    return info.header_offset + 30 + nameLength + extraLength
+
+  def digitalSignals(self): # int16, shape (nbSamples, nbLeads), memory mapped
+    if self.signals is None:
+      if any(f != '16' for f in self.index['formats']):
+        raise ValueError("RecordBundle: only format 16 signals can be mapped (%s)." % (', '.join(self.index['formats'])))
+      nbLeads = len(self.index['leads'])
+      nbSamples = self.zip.getinfo('dat').file_size // (2 * nbLeads)
+      self.signals = numpy.memmap(self.filename, dtype='<i2', mode='r', offset=self.memberOffset('dat'), shape=(nbSamples, nbLeads))
+    return self.signals
+
+  def leadNames(self): return self.index['leads']
+
+  def frequency(self): return self.index['frequency']
+
+  def digital(self, lead): # int16 view (strided)
+    return self.digitalSignals()[:, self.index['leads'].index(lead)]
+
+  def physical(self, lead): # mV (new array)
+    i = self.index['leads'].index(lead)
+    return (self.digital(lead).astype(numpy.float64) - self.index['baselines'][i]) / self.index['gains'][i]
+
+  def times(self): # sec
+    return numpy.arange(self.digitalSignals().shape[0]) / self.index['frequency']
+
+  def rr(self, annotator): # (times, intervals) in sec
+    rr = numpy.load(io.BytesIO(self.zip.read('rr/%s.npy' % (annotator))))
+    return rr[:, 0], rr[:, 1]
+
+  def annotationSamples(self, annotator): # sample numbers of the annotations (MIT format)
+    return parseAnnotationSamples(self.zip.read(annotator))
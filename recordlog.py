@@ -0,0 +1,139 @@
+#!/usr/local/bin/python3
+
+import json
+import queue
+import logging
+import logging.handlers
+
+# Record log
+# --------------------------------------------------------------------------------------------
+# Log of the records processed concurrently (output.process-kardia.log): every record writes
+# to a RecordLog (file-like: print(..., file=recordLog), recordLog.write()), its lines are
+# tagged with the record and the stage, and go through a logging QueueHandler (a queue put,
+# no file I/O in the workers) to a QueueListener thread which:
+#  - buffers the lines of each record and writes them as one section once the record is
+#    closed (sections in the order the records end, lines in the order they were written),
+#  - optionally writes every line at once to a JSON-lines log ({t, record, stage, level,
+#    message}).
+# Subprocess outputs are captured with pipes by the callers and written to the RecordLog.
+#
+#   logs = LogPipeline(logFilename, jsonFilename)
+#   with logs.recordLog('data/b6') as logFile:
+#     print("...", file=logFile)
+#     print("...", file=logFile.forStage('gqrs'))
+#   logs.close()
+
+gLoggerName = 'kardia.records'
+
+# RecordLog
+# --------------------------------------------------------------------------------------------
+class RecordLog:
+  def __init__(self, logger, record, stage=None, parent=None):
+    self.logger = logger
+    self.record = record
+    self.stage = stage
+    self.parent = parent
+    self.partial = '' # last line not ended yet
+
+  def __enter__(self): return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+    return False
+
+  def forStage(self, stage): # same record, lines tagged with stage
+    return RecordLog(self.logger, self.record, stage, self)
+
+  def write(self, text):
+    lines = (self.partial + text).split('\n')
+    self.partial = lines.pop()
+    for line in lines:
+      self.emit(line)
+    return len(text)
+
+  def emit(self, line, level=logging.INFO):
+    self.logger.log(level, line, extra={'record': self.record, 'stage': self.stage, 'end': False})
+
+  def flush(self):
+    if self.partial:
+      self.emit(self.partial)
+      self.partial = ''
+
+  def close(self): # end of the record section (a stage log only flushes)
+    self.flush()
+    if self.parent is None:
+      self.logger.info('', extra={'record': self.record, 'stage': None, 'end': True})
+
+# SectionHandler
+# Lines of a record buffered until the record ends (runs in the listener thread).
+# --------------------------------------------------------------------------------------------
+class SectionHandler(logging.Handler):
+  def __init__(self, filename):
+    super().__init__()
+    self.file = open(filename, mode='a')
+    self.sections = {} # {record: [line, ...]}
+
+  def emit(self, logRecord):
+    record = getattr(logRecord, 'record', None)
+    if record is None:
+      self.file.write(logRecord.getMessage() + '\n')
+    elif logRecord.end:
+      self.file.write(''.join(self.sections.pop(record, [])))
+      self.file.flush()
+    else:
+      stage = "[%s] " % (logRecord.stage) if logRecord.stage else ""
+      self.sections.setdefault(record, []).append("%s%s\n" % (stage, logRecord.getMessage()))
+
+  def close(self):
+    for lines in self.sections.values(): # records never closed (e.g. interrupted)
+      self.file.write(''.join(lines))
+    self.sections = {}
+    self.file.close()
+    super().close()
+
+# JsonLinesHandler
+# --------------------------------------------------------------------------------------------
+class JsonLinesHandler(logging.Handler):
+  def __init__(self, filename):
+    super().__init__()
+    self.file = open(filename, mode='a')
+
+  def emit(self, logRecord):
+    if getattr(logRecord, 'end', False):
+      return
+    self.file.write(json.dumps({'t': round(logRecord.created, 3), 'record': getattr(logRecord, 'record', None),
+                                'stage': getattr(logRecord, 'stage', None), 'level': logRecord.levelname,
+                                'message': logRecord.getMessage()}) + '\n')
+
+  def close(self):
+    self.file.close()
+    super().close()
+
+# LogPipeline
+# --------------------------------------------------------------------------------------------
+class LogPipeline:
+  def __init__(self, logFilename, jsonFilename=None):
+    self.queue = queue.SimpleQueue()
+    handlers = [SectionHandler(logFilename)]
+    if jsonFilename is not None:
+      handlers.append(JsonLinesHandler(jsonFilename))
+    self.handlers = handlers
+
+    self.logger = logging.getLogger(gLoggerName)
+    self.logger.setLevel(logging.INFO)
+    self.logger.propagate = False
+    self.queueHandler = logging.handlers.QueueHandler(self.queue)
+    self.logger.addHandler(self.queueHandler)
+    self.listener = logging.handlers.QueueListener(self.queue, *handlers)
+    self.listener.start()
+
+  def recordLog(self, record): return RecordLog(self.logger, record)
+
+  def close(self): # write the pending lines, stop the listener thread
+    if self.listener is None:
+      return
+    self.listener.stop()
+    self.listener = None
+    self.logger.removeHandler(self.queueHandler)
+    for handler in self.handlers:
+      handler.close()
@@ -0,0 +1,106 @@
+#!/usr/local/bin/python3
+
+import os
+import zlib
+
+import numpy
+
+# Report PDF
+# --------------------------------------------------------------------------------------------
+# Multi-page PDF written page by page (record-viewer.py report): each page is one RGB image (a
+# figure rendered by Agg in a worker process and compressed there), written to the file as soon
+# as it is added, so that the pages are never all in memory. The page tree, the bookmarks (one
+# per page) and the cross-reference table are written on close().
+#
+#   with ReportPdf('report.pdf') as pdf:
+#     pdf.addPage(width, height, compressImage(rgba), 'data/b6')
+#
+# Objects: 1 catalog, 2 page tree, then per page: image, content stream, page.
+
+def compressImage(rgba): # (height, width, 4) uint8 (Agg buffer) -> zlib compressed RGB
+  rgba = numpy.asarray(rgba)
+  return zlib.compress(numpy.ascontiguousarray(rgba[:, :, :3]).tobytes(), 6)
+
+def pdfString(text): # literal string, non latin-1 characters replaced
+  text = text.encode('latin-1', 'replace').decode('latin-1')
+  return '(' + text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') + ')'
+
+class ReportPdf:
+  def __init__(self, filename):
+    self.filename = filename
+    self.tmpFilename = filename + '.tmp'
+    self.file = open(self.tmpFilename, mode='wb')
+    self.offsets = {} # {object id: offset}
+    self.nextId = 3
+    self.pages = [] # [(page id, title), ...]
+    self.file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+  def __enter__(self): return self
+
+  def __exit__(self, excType, excValue, traceback):
+    if excType is None:
+      self.close()
+    else:
+      self.file.close()
+      os.remove(self.tmpFilename)
+    return False
+
+  def newId(self):
+    self.nextId += 1
+    return self.nextId - 1
+
+  def writeObject(self, objectId, dictionary, stream=None):
+    self.offsets[objectId] = self.file.tell()
+    self.file.write(("%d 0 obj\n%s\n" % (objectId, dictionary)).encode('latin-1'))
+    if stream is not None:
+      self.file.write(b'stream\n')
+      self.file.write(stream)
+      self.file.write(b'\nendstream\n')
+    self.file.write(b'endobj\n')
+
+  # addPage
+  # width, height: image size (pixels); pageWidth, pageHeight: page size (points, default:
+  # 72 dpi image)
+  # ------------------------------------------------------------------------------------------
+  def addPage(self, width, height, compressedRgb, title, pageWidth=None, pageHeight=None):
+    pageWidth = pageWidth if pageWidth is not None else width
+    pageHeight = pageHeight if pageHeight is not None else height
+    imageId, contentId, pageId = self.newId(), self.newId(), self.newId()
+
+    self.writeObject(imageId, "<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode /Length %d >>" %
+                     (width, height, len(compressedRgb)), compressedRgb)
+    content = ("q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q" % (pageWidth, pageHeight)).encode('latin-1')
+    self.writeObject(contentId, "<< /Length %d >>" % (len(content)), content)
+    self.writeObject(pageId, "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] /Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>" %
+                     (pageWidth, pageHeight, imageId, contentId))
+    self.pages.append((pageId, title))
+    self.file.flush()
+
+  def close(self):
+    if self.file is None:
+      return
+    self.writeObject(2, "<< /Type /Pages /Kids [%s] /Count %d >>" % (' '.join(["%d 0 R" % (pageId) for pageId, title in self.pages]), len(self.pages)))
+
+    # bookmarks: one per page
+    outlinesId = self.newId()
+    itemIds = [self.newId() for page in self.pages]
+    for i, (pageId, title) in enumerate(self.pages):
+      links = "/Parent %d 0 R" % (outlinesId)
+      if i > 0: links += " /Prev %d 0 R" % (itemIds[i - 1])
+      if i < len(itemIds) - 1: links += " /Next %d 0 R" % (itemIds[i + 1])
+      self.writeObject(itemIds[i], "<< /Title %s %s /Dest [%d 0 R /Fit] >>" % (pdfString(title), links, pageId))
+    if itemIds:
+      self.writeObject(outlinesId, "<< /Type /Outlines /First %d 0 R /Last %d 0 R /Count %d >>" % (itemIds[0], itemIds[-1], len(itemIds)))
+    else:
+      self.writeObject(outlinesId, "<< /Type /Outlines /Count 0 >>")
+    self.writeObject(1, "<< /Type /Catalog /Pages 2 0 R /Outlines %d 0 R /PageMode /UseOutlines >>" % (outlinesId))
+
+    xref = self.file.tell()
+    self.file.write(("xref\n0 %d\n" % (self.nextId)).encode('latin-1'))
+    self.file.write(b'0000000000 65535 f \n')
+    for objectId in range(1, self.nextId):
+      self.file.write(("%010d 00000 n \n" % (self.offsets[objectId])).encode('latin-1'))
+    self.file.write(("trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.nextId, xref)).encode('latin-1'))
+    self.file.close()
+    self.file = None
+    os.replace(self.tmpFilename, self.filename)
@@ -0,0 +1,177 @@
+#!/usr/local/bin/python3
+
+import os
+import csv
+import json
+import time
+import sqlite3
+import argparse
+
+# Results database
+# --------------------------------------------------------------------------------------------
+# SQLite store of the output rows (output.process-kardia.sqlite, one per shard): one row per
+# (record, QRS algorithm), upserted as each record is loaded. The CSV output file is an export
+# of the store. Records whose work outputs did not change since their rows were stored are not
+# loaded again, so an incremental run only loads the changed records.
+#
+#  - results: recordName (primary key with qrsAlgorithm), recordId, detectorIndex (CSV order),
+#             patientId, dateTime, updated (time stored), sourceTime (mtime of the record
+#             outputs), row (JSON list, Record.headers order)
+#  - meta:    headers (JSON list): a store written with other columns is emptied on open
+#             inputs: hash of the other inputs of the rows (Alive DB path and mtime, comment
+#             rules, RR cleaning / filtnn / SQI parameters, see RecordsLoader.inputsKey()): when
+#             it changes, all the records are loaded again (their rows are kept until then)
+#
+# WAL journal (readers are not blocked by a running batch), synchronous=NORMAL, upserts
+# committed in batches (batchSize upserts or batchInterval seconds, and on close).
+
+class ResultsDB:
+  def __init__(self, filename, headers, inputsKey=None, batchSize=200, batchInterval=5.0):
+    self.filename = filename
+    self.headers = list(headers)
+    self.batchSize = batchSize
+    self.batchInterval = batchInterval
+    self.pending = 0
+    self.lastCommit = time.time()
+    self.stats = {'upserts': 0, 'upToDate': 0}
+
+    self.conn = sqlite3.connect(filename)
+    self.conn.execute("pragma journal_mode=WAL")
+    self.conn.execute("pragma synchronous=NORMAL")
+    self.conn.execute("create table if not exists meta (key text primary key, value text)")
+    self.conn.execute("create table if not exists results (recordName text, qrsAlgorithm text, recordId text, detectorIndex integer, "
+                      "patientId text, dateTime text, updated real, sourceTime real, row text, primary key (recordName, qrsAlgorithm))")
+    self.conn.execute("create index if not exists results_recordId on results (recordId)")
+    self.conn.execute("create index if not exists results_patientId on results (patientId)")
+    self.conn.execute("create index if not exists results_dateTime on results (dateTime)")
+    self.conn.execute("create index if not exists results_qrsAlgorithm on results (qrsAlgorithm)")
+
+    row = self.conn.execute("select value from meta where key='headers'").fetchone()
+    if row is not None and json.loads(row[0]) != self.headers:
+      print("Info: results database (%s): columns changed, all records are loaded again." % (filename))
+      self.conn.execute("delete from results")
+    self.conn.execute("insert or replace into meta (key, value) values ('headers', ?)", (json.dumps(self.headers),))
+
+    if inputsKey is not None:
+      row = self.conn.execute("select value from meta where key='inputs'").fetchone()
+      if row is not None and row[0] != inputsKey:
+        print("Info: results database (%s): inputs changed (Alive DB, comment rules, RR cleaning or SQI parameters), all records are loaded again." % (filename))
+        self.conn.execute("update results set updated=-1") # older than any sourceTime
+      self.conn.execute("insert or replace into meta (key, value) values ('inputs', ?)", (inputsKey,))
+    self.conn.commit()
+
+  def __enter__(self): return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+    return False
+
+  def close(self):
+    if self.conn is not None:
+      self.conn.commit()
+      self.conn.close()
+      self.conn = None
+
+  def column(self, header): return self.headers.index(header)
+
+  # isUpToDate
+  # True if the record has a row for each QRS algorithm, stored after sourceTime
+  # ------------------------------------------------------------------------------------------
+  def isUpToDate(self, recordName, sourceTime, qrsAlgorithms):
+    rows = self.conn.execute("select qrsAlgorithm, updated from results where recordName=?", (recordName,)).fetchall()
+    updated = {qrsAlgorithm: t for qrsAlgorithm, t in rows}
+    upToDate = all(qrsAlgorithm in updated and updated[qrsAlgorithm] >= sourceTime for qrsAlgorithm in qrsAlgorithms)
+    if upToDate: self.stats['upToDate'] += 1
+    return upToDate
+
+  # upsert
+  # rows: [row, ...] (Record.asList()) of one record, in QRS detectors order
+  # ------------------------------------------------------------------------------------------
+  def upsert(self, recordName, rows, sourceTime):
+    now = time.time()
+    qrsColumn, patientColumn, dateColumn = self.column('QRS_ALGORITHM'), self.column('PATIENT_ID'), self.column('DATE_TIME')
+    recordId = recordName.split('/')[-1]
+    for detectorIndex, row in enumerate(rows):
+      self.conn.execute("insert into results (recordName, qrsAlgorithm, recordId, detectorIndex, patientId, dateTime, updated, sourceTime, row) "
+                        "values (?, ?, ?, ?, ?, ?, ?, ?, ?) on conflict (recordName, qrsAlgorithm) do update set "
+                        "recordId=excluded.recordId, detectorIndex=excluded.detectorIndex, patientId=excluded.patientId, dateTime=excluded.dateTime, "
+                        "updated=excluded.updated, sourceTime=excluded.sourceTime, row=excluded.row",
+                        (recordName, str(row[qrsColumn]), recordId, detectorIndex, str(row[patientColumn]), str(row[dateColumn]), now, sourceTime, json.dumps(row)))
+    self.stats['upserts'] += 1
+    self.pending += 1
+    if self.pending >= self.batchSize or now - self.lastCommit >= self.batchInterval:
+      self.commit()
+
+  def commit(self):
+    self.conn.commit()
+    self.pending = 0
+    self.lastCommit = time.time()
+
+  # readers
+  # ------------------------------------------------------------------------------------------
+  def lookup(self, recordId=None, patientId=None, qrsAlgorithm=None): # [row, ...]
+    conditions, values = [], []
+    for name, value in [('recordId', recordId), ('patientId', patientId), ('qrsAlgorithm', qrsAlgorithm)]:
+      if value is not None:
+        conditions.append("%s=?" % (name))
+        values.append(value)
+    where = (" where " + " and ".join(conditions)) if conditions else ""
+    cursor = self.conn.execute("select row from results%s order by recordId, recordName, detectorIndex" % (where), values)
+    return [json.loads(row[0]) for row in cursor]
+
+  # exportCsv
+  # recordNames / qrsAlgorithms: only the rows of these records / algorithms (None: all)
+  # ------------------------------------------------------------------------------------------
+  def exportCsv(self, csvFilename, recordNames=None, qrsAlgorithms=None): # return the number of rows
+    self.commit()
+    recordNames = set(recordNames) if recordNames is not None else None
+    qrsAlgorithms = set(qrsAlgorithms) if qrsAlgorithms is not None else None
+
+    nbRows = 0
+    tmpFilename = csvFilename + '.tmp'
+    with open(tmpFilename, mode='w') as f:
+      writer = csv.writer(f, delimiter=';', quotechar='"', quoting=csv.QUOTE_ALL)
+      writer.writerow(self.headers)
+      cursor = self.conn.execute("select recordName, qrsAlgorithm, row from results order by recordId, recordName, detectorIndex")
+      for recordName, qrsAlgorithm, row in cursor:
+        if recordNames is not None and recordName not in recordNames: continue
+        if qrsAlgorithms is not None and qrsAlgorithm not in qrsAlgorithms: continue
+        writer.writerow(json.loads(row))
+        nbRows += 1
+    os.replace(tmpFilename, csvFilename)
+    return nbRows
+
+  def printStats(self):
+    count = self.conn.execute("select count(*) from results").fetchone()[0]
+    print("Info: results database: %d record(s) upserted - %d up to date - %d row(s) stored" % (self.stats['upserts'], self.stats['upToDate'], count))
+
+def main():
+  ap = argparse.ArgumentParser()
+  ap.add_argument("-d", "--database", default="output.process-kardia.sqlite", help="results database (default: output.process-kardia.sqlite)")
+  ap.add_argument("-r", "--record-id", help="rows of this record id")
+  ap.add_argument("-p", "--patient-id", help="rows of this patient id")
+  ap.add_argument("-q", "--qrs-algorithm", help="rows of this QRS algorithm (e.g. GQRS)")
+  ap.add_argument("-o", "--output-csv", help="export all rows to this CSV file")
+  args = vars(ap.parse_args())
+
+  if not os.path.isfile(args['database']):
+    print("ERROR: results database (%s) does not exist." % (args['database']))
+    return 1
+
+  conn = sqlite3.connect(args['database'])
+  row = conn.execute("select value from meta where key='headers'").fetchone()
+  conn.close()
+  headers = json.loads(row[0]) if row is not None else []
+
+  with ResultsDB(args['database'], headers) as db:
+    if args['output_csv']:
+      print("Info: %d row(s) written to '%s'" % (db.exportCsv(args['output_csv']), args['output_csv']))
+      return 0
+    for row in db.lookup(args['record_id'], args['patient_id'], args['qrs_algorithm']):
+      print('; '.join(["%s: %s" % (h, v) for h, v in zip(headers, row)]))
+  return 0
+
+if __name__ == "__main__":
+  ret = main()
+  if not ret: print("done.")
+  exit(ret)
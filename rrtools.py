@@ -0,0 +1,306 @@
+#!/usr/local/bin/python3
+
+import os
+import time
+import shutil
+import argparse
+import subprocess
+
+import numpy
+from scipy.spatial import cKDTree
+
+# RR tools
+# --------------------------------------------------------------------------------------------
+# Vectorized (numpy) RR interval processing used by HRVAnalysis, instead of the hrvanalysis
+# list based remove_outliers() / remove_ectopic_beats() / interpolate_nan_values().
+#
+# RR cleaning (cleanRR), same sequence as recommended by hrvanalysis:
+#  1. range filter: intervals outside [lowRri, highRri] (msec) are removed (NaN),
+#  2. linear interpolation of the removed intervals,
+#  3. ectopic beats detection, each interval compared to the previous one:
+#     - malik:  |rr[i] - rr[i-1]| > 20% of rr[i-1]
+#     - kamath: rr[i] - rr[i-1] > 32.5% of rr[i-1] or rr[i-1] - rr[i] > 24.5% of rr[i-1]
+#  4. linear interpolation of the ectopic intervals.
+# NN/RR ratio: intervals kept by 1. and 3. / all intervals (as get_hrv's NN/RR).
+#
+# Interpolation: interior values are interpolated, leading / trailing ones take the nearest
+# valid value.
+#
+# filtNN: same filter as PhysioNet's filtnn / get_hrv -f "filt hwin -x low high" (seconds):
+#  1. hard limits: intervals outside [low, high] are excluded (and not part of the windows),
+#  2. for each interval, the mean of the window of hwin intervals on either side, the centre
+#     interval excluded (window sums from a cumulative sum: O(n)); windows are truncated at
+#     the ends of the series,
+#  3. an interval outside filt (fraction) of its window mean is excluded.
+# The windows use all the intervals kept by 1. (excluded outliers are not removed from the
+# windows of their neighbours).
+#
+# Nonlinear features (undefined, e.g. series too short: nan):
+#  - sampleEntropy (Richman & Moorman): -ln(A/B), B / A: pairs of templates of m / m+1
+#    intervals (the same N-m starts) closer than r x SD (Chebyshev distance), self matches
+#    excluded,
+#  - approximateEntropy (Pincus): phi(m) - phi(m+1), phi: mean of ln(Ci/n), Ci: templates
+#    close to the template i, self match included,
+#  - dfa (Peng): alpha, slope of log F(n) / log n, F(n): RMS of the integrated series
+#    detrended (least squares line) in non-overlapping boxes of n intervals; alpha1: n in
+#    [4, 16], alpha2: n in [16, 64] (box sizes with at least 4 boxes).
+# Neighbours are counted with a KD-tree (Chebyshev balls, pairs of tree nodes fully inside or
+# outside the tolerance counted at once) instead of comparing all the pairs (100x faster on
+# 10k intervals, seconds instead of half an hour on 100k, see -n). DFA: the boxes of a size
+# are the rows of a view, detrended at once in closed form (O(n) per box size, no per-box fit),
+# centered per box so that long records do not lose precision.
+
+gEctopicMethods = ['malik', 'kamath']
+
+def rangeMask(rr, lowRri=300, highRri=2000): # True: valid interval
+  rr = numpy.asarray(rr, dtype=numpy.float64)
+  return (rr >= lowRri) & (rr <= highRri)
+
+def ectopicMask(rr, method='malik'): # True: ectopic interval (the first one never is)
+  rr = numpy.asarray(rr, dtype=numpy.float64)
+  mask = numpy.zeros(len(rr), dtype=bool)
+  if len(rr) < 2:
+    return mask
+
+  previous, current = rr[:-1], rr[1:]
+  if method == 'malik':
+    mask[1:] = numpy.abs(current - previous) > 0.2 * previous
+  elif method == 'kamath':
+    mask[1:] = (current - previous > 0.325 * previous) | (previous - current > 0.245 * previous)
+  else:
+    raise ValueError("ectopicMask: unknown method (%s)" % (method))
+  return mask
+
+def interpolateInvalid(rr, valid): # linear interpolation of the invalid intervals (new array)
+  rr = numpy.asarray(rr, dtype=numpy.float64)
+  if valid.all() or not valid.any():
+    return rr.copy()
+  indexes = numpy.arange(len(rr))
+  return numpy.interp(indexes, indexes[valid], rr[valid])
+
+def cleanRR(rr, lowRri=300, highRri=2000, ectopicMethod='malik'): # return (nn, stats)
+  rr = numpy.asarray(rr, dtype=numpy.float64)
+  inRange = rangeMask(rr, lowRri, highRri)
+  interpolated = interpolateInvalid(rr, inRange)
+
+  ectopic = ectopicMask(interpolated, ectopicMethod)
+  nn = interpolateInvalid(interpolated, ~ectopic)
+
+  nbRR = len(rr)
+  nbNN = int(numpy.count_nonzero(inRange & ~ectopic))
+  stats = {'nbRR': nbRR, 'nbOutliers': nbRR - int(numpy.count_nonzero(inRange)),
+           'nbEctopic': int(numpy.count_nonzero(ectopic & inRange)),
+           'nnRr': float(nbNN) / nbRR if nbRR else 0.0}
+  return nn, stats
+
+def filtNN(rr, filt=0.2, hwin=20, low=0.4, high=2.0): # return the mask of the kept intervals
+  rr = numpy.asarray(rr, dtype=numpy.float64)
+  kept = numpy.ones(len(rr), dtype=bool)
+  if low is not None and high is not None:
+    kept = (rr >= low) & (rr <= high)
+
+  indexes = numpy.flatnonzero(kept)
+  x = rr[indexes]
+  n = len(x)
+  if n < 2:
+    return kept
+
+  c = numpy.concatenate(([0.0], numpy.cumsum(x)))
+  i = numpy.arange(n)
+  start = numpy.maximum(i - hwin, 0)
+  end = numpy.minimum(i + hwin + 1, n)
+  windowMean = (c[end] - c[start] - x) / (end - start - 1)
+
+  kept[indexes[numpy.abs(x - windowMean) > filt * windowMean]] = False
+  return kept
+
+def timeDomain(rr, kept): # get_hrv like time domain statistics (msec) of the kept intervals
+  rr = numpy.asarray(rr, dtype=numpy.float64)
+  nn = rr[kept]
+  # successive differences: only between adjacent intervals both kept
+  pairs = kept[1:] & kept[:-1]
+  diffs = numpy.diff(rr)[pairs]
+  return {'nnRr': float(len(nn)) / len(rr) if len(rr) else 0.0,
+          'avnn': float(numpy.mean(nn)) if len(nn) else 0.0,
+          'sdnn': float(numpy.std(nn, ddof=1)) if len(nn) > 1 else 0.0,
+          'rmssd': float(numpy.sqrt(numpy.mean(diffs ** 2))) if len(diffs) else 0.0,
+          'pnn50': float(100.0 * numpy.mean(numpy.abs(diffs) > 50.0)) if len(diffs) else 0.0}
+
+def templates(x, m, count): # [count, m]: the templates of m values starting at 0..count-1
+  return numpy.lib.stride_tricks.sliding_window_view(x, m)[:count]
+
+def countPairs(vectors, tolerance): # pairs (i < j) closer than tolerance (Chebyshev distance)
+  tree = cKDTree(vectors)
+  return (int(tree.count_neighbors(tree, tolerance, p=numpy.inf)) - len(vectors)) // 2
+
+def sampleEntropy(rr, m=2, r=0.2):
+  x = numpy.asarray(rr, dtype=numpy.float64)
+  n = len(x) - m
+  if n < 2:
+    return numpy.nan
+  tolerance = r * numpy.std(x)
+  b = countPairs(templates(x, m, n), tolerance)
+  a = countPairs(templates(x, m + 1, n), tolerance)
+  if a == 0 or b == 0:
+    return numpy.nan
+  return float(-numpy.log(float(a) / b))
+
+def approximateEntropy(rr, m=2, r=0.2):
+  x = numpy.asarray(rr, dtype=numpy.float64)
+  if len(x) < m + 2:
+    return numpy.nan
+  tolerance = r * numpy.std(x)
+
+  def phi(m):
+    vectors = templates(x, m, len(x) - m + 1)
+    counts = cKDTree(vectors).query_ball_point(vectors, tolerance, p=numpy.inf, return_length=True)
+    return numpy.mean(numpy.log(counts / float(len(vectors))))
+  return float(phi(m) - phi(m + 1))
+
+def dfaFluctuations(rr, boxSizes): # F(n) of each box size (nan: less than 4 boxes)
+  x = numpy.asarray(rr, dtype=numpy.float64)
+  f = numpy.full(len(boxSizes), numpy.nan)
+  if len(x) == 0:
+    return f
+  y = numpy.cumsum(x - numpy.mean(x)) # integrated series
+
+  # least squares line of y on t in each box: the boxes of a size are the rows of a view, y
+  # and t centered per box (no sums over the whole series: no cancellation on long records)
+  for i, size in enumerate(boxSizes):
+    nbBoxes = len(y) // size
+    if nbBoxes < 4:
+      continue
+    boxes = y[:nbBoxes * size].reshape(nbBoxes, size)
+    boxes = boxes - boxes.mean(axis=1, keepdims=True)
+    t = numpy.arange(size) - (size - 1) / 2.0
+    stt = numpy.dot(t, t)
+    sty = boxes @ t
+    rss = numpy.maximum(0.0, numpy.einsum('ij,ij->i', boxes, boxes) - sty * sty / stt)
+    f[i] = numpy.sqrt(rss.sum() / (nbBoxes * size))
+  return f
+
+def dfa(rr, low=4, high=16): # alpha on the box sizes low..high
+  boxSizes = numpy.arange(low, high + 1)
+  f = dfaFluctuations(rr, boxSizes)
+  valid = numpy.isfinite(f) & (f > 0)
+  if numpy.count_nonzero(valid) < 2:
+    return numpy.nan
+  return float(numpy.polyfit(numpy.log(boxSizes[valid]), numpy.log(f[valid]), 1)[0])
+
+def nonlinear(rr, m=2, r=0.2): # nonlinear features of a series
+  return {'sampen': sampleEntropy(rr, m, r), 'apen': approximateEntropy(rr, m, r),
+          'dfa_alpha1': dfa(rr, 4, 16), 'dfa_alpha2': dfa(rr, 16, 64)}
+
+# compareFiltnn
+# Run PhysioNet's filtnn on a RR file (ann2rr -V s -i s8 output: time, interval in sec) and
+# compare the intervals it keeps with filtNN().
+# --------------------------------------------------------------------------------------------
+def filtnnKeptTimes(rr, filt, hwin, low, high): # times (sec, rounded to msec) of the intervals kept by PhysioNet's filtnn
+  lines = ''.join(["%.3f %.3f N\n" % (t, v) for t, v in rr])
+  cmd = ['filtnn', str(filt), str(hwin), '-x', str(low), str(high), '-p']
+  output = subprocess.run(cmd, input=lines, text=True, capture_output=True, check=True).stdout
+  return set(round(float(line.split()[0]), 3) for line in output.splitlines() if line.strip() and line.split()[-1] == 'N')
+
+def compareFiltnn(rrFilename, filt, hwin, low, high, expectedFilename=None):
+  if shutil.which('filtnn') is None:
+    print("ERROR: filtnn not found in PATH.")
+    return 1
+
+  rr = numpy.loadtxt(rrFilename, usecols=(0, 1), ndmin=2)
+  theirs = filtnnKeptTimes(rr, filt, hwin, low, high)
+  if expectedFilename is not None: # e.g. tests/fixtures/filtnn.expected.txt
+    with open(expectedFilename, mode='w') as f:
+      f.write("# filtnn %s %d -x %s %s -p on %s: times of the kept intervals\n" % (filt, hwin, low, high, os.path.basename(rrFilename)))
+      f.write(''.join(["%.3f\n" % (t) for t in sorted(theirs)]))
+    print("Info: filtnn output written to %s" % (expectedFilename))
+
+  kept = filtNN(rr[:, 1], filt, hwin, low, high)
+  ours = set(round(float(t), 3) for t in rr[kept, 0])
+
+  print("filtnn: %d kept - filtNN: %d kept - only filtnn: %d - only filtNN: %d" % (len(theirs), len(ours), len(theirs - ours), len(ours - theirs)))
+  return 0 if theirs == ours else 1
+
+# Benchmark
+# --------------------------------------------------------------------------------------------
+def syntheticRR(nbBeats, seed=42): # msec, with outliers and ectopic beats
+  rnd = numpy.random.default_rng(seed)
+  rr = 800 + 50 * numpy.sin(numpy.arange(nbBeats) / 5.0) + rnd.normal(0, 15, nbBeats)
+  ectopic = rnd.random(nbBeats) < 0.03
+  rr[ectopic] *= 0.6
+  outliers = rnd.random(nbBeats) < 0.01
+  rr[outliers] = rnd.choice([150.0, 2500.0], int(outliers.sum()))
+  return rr
+
+def benchmark(nbStrips, beatsPerStrip=40): # 30 sec strip: ~40 beats
+  strips = [syntheticRR(beatsPerStrip, seed) for seed in range(nbStrips)]
+
+  start = time.perf_counter()
+  ratios = [cleanRR(rr)[1]['nnRr'] for rr in strips]
+  elapsed = time.perf_counter() - start
+
+  print("RR cleaning: %d strips of %d beats" % (nbStrips, beatsPerStrip))
+  print(" - per strip  : %8.1f usec" % (elapsed / nbStrips * 1e6))
+  print(" - mean NN/RR : %8.3f" % (numpy.mean(ratios)))
+  return 0
+
+# naive O(n^2) references of the nonlinear features (templates compared by blocks)
+def naivePairs(vectors, tolerance, selfMatches=False): # per template: templates closer than tolerance
+  counts = numpy.zeros(len(vectors), dtype=numpy.int64)
+  for start in range(0, len(vectors), 1024):
+    block = vectors[start:start + 1024]
+    distances = numpy.max(numpy.abs(block[:, None, :] - vectors[None, :, :]), axis=2)
+    counts[start:start + len(block)] = numpy.count_nonzero(distances <= tolerance, axis=1)
+  return counts if selfMatches else counts - 1
+
+def naiveSampleEntropy(rr, m=2, r=0.2):
+  x = numpy.asarray(rr, dtype=numpy.float64)
+  n, tolerance = len(x) - m, r * numpy.std(x)
+  b = naivePairs(templates(x, m, n), tolerance).sum()
+  a = naivePairs(templates(x, m + 1, n), tolerance).sum()
+  return float(-numpy.log(float(a) / b)) if a and b else numpy.nan
+
+def naiveApproximateEntropy(rr, m=2, r=0.2):
+  x = numpy.asarray(rr, dtype=numpy.float64)
+  tolerance = r * numpy.std(x)
+  def phi(m):
+    vectors = templates(x, m, len(x) - m + 1)
+    return numpy.mean(numpy.log(naivePairs(vectors, tolerance, True) / float(len(vectors))))
+  return float(phi(m) - phi(m + 1))
+
+def benchmarkNonlinear(sizes=[100, 10000, 100000], maxNaive=10000):
+  print("Nonlinear features (sec, naive O(n^2) for n <= %d):" % (maxNaive))
+  for nbBeats in sizes:
+    rr = cleanRR(syntheticRR(nbBeats))[0]
+    line = " - %6d beats:" % (nbBeats)
+    for name, function, naive in [('sampen', sampleEntropy, naiveSampleEntropy), ('apen', approximateEntropy, naiveApproximateEntropy),
+                                  ('dfa', lambda x: (dfa(x, 4, 16), dfa(x, 16, 64)), None)]:
+      start = time.perf_counter()
+      value = function(rr)
+      line += " %s %7.3f" % (name, time.perf_counter() - start)
+      if naive is not None and nbBeats <= maxNaive:
+        start = time.perf_counter()
+        reference = naive(rr)
+        line += " (naive %7.3f, %s)" % (time.perf_counter() - start, "same" if numpy.isclose(value, reference, equal_nan=True) else "DIFFERENT")
+    print(line)
+  return 0
+
+def main():
+  ap = argparse.ArgumentParser()
+  ap.add_argument("-b", "--benchmark", type=int, default=10000, metavar="N", help="benchmark on N synthetic 30 sec strips (default: 10000)")
+  ap.add_argument("-n", "--benchmark-nonlinear", action="store_true", help="benchmark the nonlinear features (sample / approximate entropy, DFA) on 100, 10k and 100k beats")
+  ap.add_argument("-f", "--compare-filtnn", metavar="RRFILE", help="compare filtNN() with PhysioNet's filtnn on a .rr.kubios.txt file")
+  ap.add_argument("-e", "--filtnn-expected", metavar="FILE", help="with -f: also write the times of the intervals kept by filtnn to FILE (test fixture)")
+  ap.add_argument("-F", "--filter", default="0.2 20 0.4 2.0", help="filtnn parameters: 'filt hwin low high' (default: '0.2 20 0.4 2.0')")
+  args = vars(ap.parse_args())
+
+  if args['compare_filtnn']:
+    filt, hwin, low, high = args['filter'].split()
+    return compareFiltnn(args['compare_filtnn'], float(filt), int(hwin), float(low), float(high), args['filtnn_expected'])
+  if args['benchmark_nonlinear']:
+    return benchmarkNonlinear()
+  return benchmark(args['benchmark'])
+
+if __name__ == "__main__":
+  ret = main()
+  if not ret: print("done.")
+  exit(ret)
@@ -0,0 +1,473 @@
+#!/usr/local/bin/python3
+
+import os
+import math
+import time
+import asyncio
+import resource
+import threading
+import tracemalloc
+import contextlib
+import contextvars
+
+# Resource scheduler
+# --------------------------------------------------------------------------------------------
+# Concurrency of the record stages, sized from the resources really available to this
+# process (cgroup CPU quota and CPU affinity, available memory) instead of cpu_count(), and
+# adjusted at runtime.
+#
+# Stages are in two classes, each with its own limit:
+#  - 'cpu': detection and HRV (gqrs, ecgpuwave, npqrs, ann2rr, get_hrv, ...)
+#  - 'io':  conversion, database and rendering (atc2edf, edf2mit, rdsamp, record-viewer, ...)
+#
+# Every stage records its wall time, CPU time (its thread and the processes it watches) and
+# peak RSS. Every `interval` seconds, the limits are recomputed:
+#  - CPUs available = CPU limit - CPUs used by other processes of the node,
+#  - cpu limit = CPUs available (never more than the CPU limit),
+#  - io limit = CPUs available / CPU ratio of the io stages (CPU time / wall time),
+#  - both are reduced so that the next tasks fit in the available memory (peak RSS per task
+#    of the class), minus a reserve.
+#
+# Memory accounting (peak per stage, in printStats()):
+#  - subprocesses: high-water RSS (VmHWM) sampled while they run, and ru_maxrss of the
+#    terminated children (getrusage(RUSAGE_CHILDREN): the largest child so far, credited to
+#    the stage if it grew while the stage ran, it catches the processes too short to be sampled
+#    and their own children, e.g. the program started by 'go run'),
+#  - Python stages (runInThread()): RSS growth of this process and, with traceMemory, the
+#    tracemalloc peak (an upper bound when Python stages overlap, the peak is process wide)
+#    and the top allocation sites of the stage at its largest run (snapshot at its end).
+#
+# Memory budget (memoryBudget, bytes): records are admitted (admitRecord()) only while the
+# projected usage (RSS of this process when started + estimates of the admitted records) stays
+# under the budget; one record is always admitted. A record estimate is its number of samples
+# (samples x leads) times the bytes per sample, learned from the peaks of the records done
+# (sum of their stages running at once); the stages of a record are attached to it through a
+# context variable (stages started by its tasks).
+
+gStageClasses = {
+  'convert': 'io', 'edf2mit': 'io', 'wfdbdesc': 'io', 'rdsamp': 'io', 'db': 'io', 'render': 'io',
+  'bundle': 'io',
+  'detect': 'cpu', 'gqrs': 'cpu', 'ecgpuwave': 'cpu', 'npqrs': 'cpu', 'ecgpu': 'cpu', 'wrann': 'cpu',
+  'ann2rr': 'cpu', 'get_hrv': 'cpu', 'hrv': 'cpu',
+}
+
+def stageClass(name): return gStageClasses.get(name, 'cpu')
+
+# Resources
+# --------------------------------------------------------------------------------------------
+def readFirstLine(filename): # return the first line or None
+  try:
+    with open(filename, mode='r') as f:
+      return f.readline().strip()
+  except OSError:
+    return None
+
+def cgroupCpuQuota(): # return the CPU quota (in CPUs) or None if unlimited
+  line = readFirstLine('/sys/fs/cgroup/cpu.max') # cgroup v2: "<quota> <period>" or "max <period>"
+  if line is not None:
+    quota, period = line.split()[:2]
+    return None if quota == 'max' else float(quota) / float(period)
+
+  quota = readFirstLine('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') # cgroup v1
+  period = readFirstLine('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+  if quota is not None and period is not None and int(quota) > 0:
+    return float(quota) / float(period)
+  return None
+
+def cpuLimit(): # CPUs this process can use
+  try:
+    cpus = float(len(os.sched_getaffinity(0)))
+  except AttributeError:
+    cpus = float(os.cpu_count() or 1)
+  quota = cgroupCpuQuota()
+  return min(cpus, quota) if quota is not None else cpus
+
+def availableMemory(): # bytes
+  available = None
+  try:
+    with open('/proc/meminfo', mode='r') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          available = int(line.split()[1]) * 1024
+  except OSError:
+    pass
+
+  for limitFilename, usageFilename in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                       ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+    limit = readFirstLine(limitFilename)
+    usage = readFirstLine(usageFilename)
+    if limit is None or usage is None or limit == 'max':
+      continue
+    cgroupAvailable = max(0, int(limit) - int(usage))
+    if int(limit) < 1 << 60: # v1 reports "no limit" as a huge number
+      available = cgroupAvailable if available is None else min(available, cgroupAvailable)
+    break
+
+  return available if available is not None else 0
+
+def nodeCpuTimes(): # (busy, total) in clock ticks, all CPUs of the node
+  line = readFirstLine('/proc/stat')
+  if line is None or not line.startswith('cpu '):
+    return None
+  values = [int(v) for v in line.split()[1:]]
+  idle = values[3] + (values[4] if len(values) > 4 else 0) # idle + iowait
+  return sum(values) - idle, sum(values)
+
+def processUsage(pid): # return (cpu seconds, rss bytes) of a running process, or None
+  try:
+    with open('/proc/%d/stat' % (pid), mode='r') as f:
+      fields = f.read().rsplit(')', 1)[1].split()
+    # after the command name: state is field 3, utime 14, stime 15, cutime 16, cstime 17,
+    # rss 24 (man proc); cutime / cstime: terminated children (e.g. of a wrapper script)
+    cpu = sum(int(v) for v in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return cpu, rss
+  except (OSError, IndexError, ValueError):
+    return None
+
+def processPeakRss(pid): # return the high-water RSS (bytes) of a running process, or None
+  try:
+    with open('/proc/%d/status' % (pid), mode='r') as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except (OSError, IndexError, ValueError):
+    pass
+  return None
+
+def childrenMaxRss(): # bytes, largest terminated (waited for) child, see getrusage(2)
+  return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+def ownCpuSeconds(): # this process and its terminated children
+  s = resource.getrusage(resource.RUSAGE_SELF)
+  c = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime
+
+# AdaptiveLimit
+# Semaphore of an event loop whose limit can change while tasks are waiting.
+# --------------------------------------------------------------------------------------------
+class AdaptiveLimit:
+  def __init__(self, name, limit, maximum):
+    self.name = name
+    self.maximum = maximum
+    self.limit = min(limit, maximum)
+    self.active = 0
+    self.waiters = []
+
+  async def acquire(self):
+    while self.active >= self.limit:
+      waiter = asyncio.get_running_loop().create_future()
+      self.waiters.append(waiter)
+      try:
+        await waiter
+      except asyncio.CancelledError:
+        if waiter.done() and not waiter.cancelled():
+          self.waiters.remove(waiter)
+          self.wake() # woken but cancelled: give the slot to the next one
+          raise
+        self.waiters.remove(waiter)
+        raise
+      self.waiters.remove(waiter)
+    self.active += 1
+
+  def release(self):
+    self.active -= 1
+    self.wake()
+
+  def setLimit(self, limit):
+    limit = max(1, min(int(limit), self.maximum))
+    if limit != self.limit:
+      print("Info: scheduler: %s limit %d -> %d" % (self.name, self.limit, limit))
+      self.limit = limit
+      self.wake()
+
+  def wake(self):
+    free = self.limit - self.active
+    for waiter in self.waiters:
+      if free <= 0: break
+      if not waiter.done():
+        waiter.set_result(None)
+        free -= 1
+
+# StageUsage
+# --------------------------------------------------------------------------------------------
+class StageUsage:
+  def __init__(self, name, admission=None):
+    self.name = name
+    self.admission = admission # RecordAdmission of the stage record (or None)
+    self.start = time.time()
+    self.seconds = 0.0
+    self.cpuSeconds = 0.0 # stage thread(s), see ResourceScheduler.runInThread()
+    self.pidsCpu = {} # {pid: cpu seconds}, last sample of the watched processes
+    self.rss = 0 # last sample
+    self.maxRss = 0
+    self.startRss = None
+    self.pythonPeak = 0 # tracemalloc peak (bytes), see ResourceScheduler.runInThread()
+    self.startChildrenRss = childrenMaxRss()
+
+  def watch(self, pid): # account this child process to the stage (sampled while it runs)
+    self.pidsCpu[pid] = 0.0
+
+  def sample(self, ownRss):
+    rss = 0
+    for pid in list(self.pidsCpu.keys()):
+      usage = processUsage(pid)
+      if usage is not None:
+        self.pidsCpu[pid] = usage[0]
+        rss += usage[1]
+        self.maxRss = max(self.maxRss, processPeakRss(pid) or usage[1])
+    if self.startRss is None:
+      self.startRss = ownRss
+    self.rss = rss + max(0, ownRss - self.startRss)
+    self.maxRss = max(self.maxRss, ownRss - self.startRss, self.rss)
+
+  def end(self):
+    self.seconds = time.time() - self.start
+    self.cpuSeconds += sum(self.pidsCpu.values())
+    if self.pidsCpu:
+      childrenRss = childrenMaxRss()
+      if childrenRss > self.startChildrenRss:
+        self.maxRss = max(self.maxRss, childrenRss)
+    self.maxRss = max(self.maxRss, self.pythonPeak)
+
+# RecordAdmission
+# A record admitted by ResourceScheduler.admitRecord(): its estimate and measured peak.
+# --------------------------------------------------------------------------------------------
+gRecordAdmission = contextvars.ContextVar('recordAdmission', default=None)
+
+class RecordAdmission:
+  def __init__(self, name, nbSamples, estimate):
+    self.name = name
+    self.nbSamples = nbSamples
+    self.estimate = estimate
+    self.peak = 0
+
+  def update(self, activeUsages): # the stages of the record running at once
+    self.peak = max(self.peak, sum(usage.rss for usage in activeUsages if usage.admission is self))
+
+def recordSamples(atcFilename, heaFilename=None): # number of samples x leads of a record, estimated
+  # from the MIT header if the record was converted, else from the ATC size (int16 samples)
+  if heaFilename is not None:
+    line = readFirstLine(heaFilename)
+    try:
+      fields = line.split()
+      return int(fields[1]) * int(fields[3])
+    except (AttributeError, IndexError, ValueError):
+      pass
+  try:
+    return os.path.getsize(atcFilename) // 2
+  except OSError:
+    return 0
+
+# ResourceScheduler
+# --------------------------------------------------------------------------------------------
+class ResourceScheduler:
+  def __init__(self, interval=1.0, memoryReserve=0.1, ioFactor=2, maxIoFactor=8, maxCpuTasks=None,
+               memoryBudget=None, traceMemory=False, recordBaseBytes=64 << 20, bytesPerSample=512):
+    self.interval = interval
+    self.cpus = cpuLimit()
+    self.memoryReserve = memoryReserve * availableMemory()
+
+    cpuTasks = max(1, int(math.floor(self.cpus)))
+    if maxCpuTasks is not None:
+      cpuTasks = max(1, min(cpuTasks, maxCpuTasks))
+    self.limits = {'cpu': AdaptiveLimit('cpu', cpuTasks, cpuTasks),
+                   'io': AdaptiveLimit('io', ioFactor * cpuTasks, maxIoFactor * cpuTasks)}
+
+    self.active = set()
+    self.stats = {} # {stage: {'count', 'seconds', 'cpuSeconds', 'maxRss'}}
+    self.classCpuRatio = {'cpu': 1.0, 'io': 1.0 / ioFactor} # moving averages
+    self.classRss = {'cpu': 0, 'io': 0} # moving averages of the peak RSS per task
+    self.monitorTask = None
+    self.previousCpu = None
+
+    self.memoryBudget = memoryBudget
+    self.traceMemory = traceMemory
+    self.recordBaseBytes = recordBaseBytes
+    self.bytesPerSample = bytesPerSample # learned, see recordDone()
+    self.admissions = set()
+    self.admissionChanged = None # asyncio.Condition, created in the event loop
+    self.admissionStats = {'records': 0, 'waits': 0, 'maxProjected': 0, 'maxPeak': 0}
+    ownUsage = processUsage(os.getpid())
+    self.baseRss = ownUsage[1] if ownUsage is not None else 0
+    self.pythonStages = 0
+    self.pythonLock = threading.Lock()
+    self.topAllocations = {} # {stage: (pythonPeak, [statistic line, ...])}
+    if traceMemory and not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+  def maxTasks(self): # upper bound of the tasks running at once
+    return sum(limit.maximum for limit in self.limits.values())
+
+  def describe(self):
+    budget = ", memory budget: %d MB" % (self.memoryBudget // (1024 * 1024)) if self.memoryBudget is not None else ""
+    return "%.1f CPUs, %d MB available, cpu limit: %d, io limit: %d%s" % (self.cpus, availableMemory() // (1024 * 1024), self.limits['cpu'].limit, self.limits['io'].limit, budget)
+
+  async def start(self): # in the event loop
+    self.previousCpu = (time.time(), ownCpuSeconds(), nodeCpuTimes())
+    self.monitorTask = asyncio.get_running_loop().create_task(self.monitor())
+
+  async def stop(self):
+    if self.monitorTask is not None:
+      self.monitorTask.cancel()
+      with contextlib.suppress(asyncio.CancelledError):
+        await self.monitorTask
+      self.monitorTask = None
+
+  # stage
+  # async with scheduler.stage('render') as usage: ... (waits for a slot of the stage class)
+  # ------------------------------------------------------------------------------------------
+  @contextlib.asynccontextmanager
+  async def stage(self, name):
+    limit = self.limits[stageClass(name)]
+    await limit.acquire()
+    usage = StageUsage(name, gRecordAdmission.get())
+    self.active.add(usage)
+    try:
+      yield usage
+    finally:
+      self.active.discard(usage)
+      usage.end()
+      if usage.admission is not None:
+        usage.admission.peak = max(usage.admission.peak, usage.maxRss)
+      self.record(usage)
+      limit.release()
+
+  async def runInThread(self, usage, function, *args): # function(*args) in a thread, its CPU time (and memory) accounted to usage
+    def measured():
+      start = time.thread_time()
+      tracedStart = self.startTracing()
+      try:
+        return function(*args)
+      finally:
+        usage.cpuSeconds += time.thread_time() - start
+        self.endTracing(usage, tracedStart)
+    return await asyncio.to_thread(measured)
+
+  def startTracing(self): # return the traced memory when the stage starts
+    if not self.traceMemory:
+      return 0
+    with self.pythonLock:
+      if self.pythonStages == 0:
+        tracemalloc.reset_peak()
+      self.pythonStages += 1
+      return tracemalloc.get_traced_memory()[0]
+
+  def endTracing(self, usage, tracedStart):
+    if not self.traceMemory:
+      return
+    with self.pythonLock:
+      self.pythonStages -= 1
+      usage.pythonPeak = max(usage.pythonPeak, tracemalloc.get_traced_memory()[1] - tracedStart)
+      largest = self.topAllocations.get(usage.name)
+      if largest is not None and largest[0] >= usage.pythonPeak:
+        return
+    # new largest run of the stage: where its memory is (allocations still alive at its end)
+    statistics = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics('lineno')
+    with self.pythonLock:
+      self.topAllocations[usage.name] = (usage.pythonPeak, [str(statistic) for statistic in statistics[:3]])
+
+  # admitRecord
+  # async with scheduler.admitRecord(name, nbSamples): ... (waits while the record does not fit
+  # in the memory budget; the stages started in the block are attached to the record)
+  # ------------------------------------------------------------------------------------------
+  def recordEstimate(self, nbSamples): return int(self.recordBaseBytes + self.bytesPerSample * nbSamples)
+
+  def projectedMemory(self, estimate=0): return self.baseRss + sum(a.estimate for a in self.admissions) + estimate
+
+  @contextlib.asynccontextmanager
+  async def admitRecord(self, name, nbSamples):
+    admission = RecordAdmission(name, nbSamples, self.recordEstimate(nbSamples))
+    if self.memoryBudget is not None:
+      if self.admissionChanged is None:
+        self.admissionChanged = asyncio.Condition()
+      async with self.admissionChanged:
+        if self.admissions and self.projectedMemory(admission.estimate) > self.memoryBudget:
+          self.admissionStats['waits'] += 1
+          await self.admissionChanged.wait_for(lambda: not self.admissions or self.projectedMemory(admission.estimate) <= self.memoryBudget)
+        self.admissions.add(admission)
+        self.admissionStats['maxProjected'] = max(self.admissionStats['maxProjected'], self.projectedMemory())
+    token = gRecordAdmission.set(admission)
+    try:
+      yield admission
+    finally:
+      gRecordAdmission.reset(token)
+      self.recordDone(admission)
+      if self.memoryBudget is not None:
+        async with self.admissionChanged:
+          self.admissions.discard(admission)
+          self.admissionChanged.notify_all()
+
+  def recordDone(self, admission): # learn the bytes per sample (moving maximum, as classRss)
+    self.admissionStats['records'] += 1
+    self.admissionStats['maxPeak'] = max(self.admissionStats['maxPeak'], admission.peak)
+    if admission.nbSamples > 0 and admission.peak > 0:
+      observed = max(0, admission.peak - self.recordBaseBytes) / admission.nbSamples
+      self.bytesPerSample = max(observed, 0.8 * self.bytesPerSample + 0.2 * observed)
+
+  def record(self, usage):
+    s = self.stats.setdefault(usage.name, {'count': 0, 'seconds': 0.0, 'cpuSeconds': 0.0, 'maxRss': 0})
+    s['count'] += 1
+    s['seconds'] += usage.seconds
+    s['cpuSeconds'] += usage.cpuSeconds
+    s['maxRss'] = max(s['maxRss'], usage.maxRss)
+
+    c = stageClass(usage.name)
+    if usage.seconds > 0.05: # too short to be measured
+      ratio = min(1.0, usage.cpuSeconds / usage.seconds)
+      self.classCpuRatio[c] = 0.8 * self.classCpuRatio[c] + 0.2 * ratio
+    self.classRss[c] = max(usage.maxRss, int(0.8 * self.classRss[c] + 0.2 * usage.maxRss))
+
+  # monitor / adjust
+  # ------------------------------------------------------------------------------------------
+  async def monitor(self):
+    while True:
+      await asyncio.sleep(self.interval)
+      ownRss = processUsage(os.getpid())
+      for usage in list(self.active):
+        usage.sample(ownRss[1] if ownRss is not None else 0)
+      for admission in set(usage.admission for usage in self.active if usage.admission is not None):
+        admission.update(self.active)
+      self.adjust()
+
+  def otherProcessesCpus(self): # CPUs used by the rest of the node since the last call
+    now, ownCpu, nodeTimes = time.time(), ownCpuSeconds(), nodeCpuTimes()
+    previousTime, previousOwnCpu, previousNodeTimes = self.previousCpu
+    self.previousCpu = (now, ownCpu, nodeTimes)
+    if nodeTimes is None or previousNodeTimes is None or now <= previousTime:
+      return 0.0
+
+    busy, total = nodeTimes[0] - previousNodeTimes[0], nodeTimes[1] - previousNodeTimes[1]
+    if total <= 0:
+      return 0.0
+    nodeBusyCpus = (os.cpu_count() or 1) * float(busy) / float(total)
+    # watched children are only counted by getrusage() once terminated
+    runningCpu = sum(sum(usage.pidsCpu.values()) for usage in self.active)
+    ownCpus = (ownCpu - previousOwnCpu) / (now - previousTime)
+    return max(0.0, nodeBusyCpus - ownCpus - runningCpu / max(self.interval, now - previousTime))
+
+  def adjust(self):
+    availableCpus = max(1.0, self.cpus - self.otherProcessesCpus())
+    memory = max(0, availableMemory() - self.memoryReserve)
+
+    for c, limit in self.limits.items():
+      tasks = availableCpus / max(self.classCpuRatio[c], 0.1)
+      if self.classRss[c] > 0: # the next tasks must fit in memory
+        tasks = min(tasks, limit.active + memory // self.classRss[c])
+      limit.setLimit(tasks)
+
+  def printStats(self):
+    print("Info: scheduler: %s" % (self.describe()))
+    for name in sorted(self.stats.keys()):
+      s = self.stats[name]
+      print(" - %-10s %-3s %5d runs - %8.1f sec - cpu %4.0f%% - max rss %6.1f MB" %
+            (name, stageClass(name), s['count'], s['seconds'], 100.0 * s['cpuSeconds'] / s['seconds'] if s['seconds'] else 0.0, s['maxRss'] / (1024.0 * 1024.0)))
+    if self.memoryBudget is not None:
+      a = self.admissionStats
+      print("Info: memory budget: %d record(s) - %d waited - max projected %.1f MB - max record peak %.1f MB - %.0f bytes/sample" %
+            (a['records'], a['waits'], a['maxProjected'] / (1024.0 * 1024.0), a['maxPeak'] / (1024.0 * 1024.0), self.bytesPerSample))
+    for name in sorted(self.topAllocations.keys()):
+      peak, lines = self.topAllocations[name]
+      print("Info: python memory - %s: peak %.1f MB, largest allocations at the end of the stage:" % (name, peak / (1024.0 * 1024.0)))
+      for line in lines:
+        print("Info:   %s" % (line))
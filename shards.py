@@ -0,0 +1,135 @@
+#!/usr/local/bin/python3
+
+import os
+import csv
+import json
+import glob
+import time
+import hashlib
+
+# Shards
+# --------------------------------------------------------------------------------------------
+# Several hosts (sharing the filesystem of the ATC files) process disjoint subsets of the
+# records: process-kardia-records.py -P --shard i/N (0 <= i < N) on each host, then
+# process-kardia-records.py -M once all shards are done.
+#
+# Partitioning: a record belongs to shard sha1(<atc file path relative to the ATC directory>)
+# mod N, stable across hosts, runs and mount points (Python's hash() is salted per process).
+#
+# Per shard outputs (next to the full run outputs, suffixed with .shard-<i>of<N>):
+#  - output.process-kardia.shard-<i>of<N>.csv              partial CSV (same columns)
+#  - output.process-kardia.shard-<i>of<N>.log              log
+#  - output.hrv-cache.shard-<i>of<N>.sqlite                HRV features cache (one writer per file)
+#  - output.process-kardia.shard-<i>of<N>.manifest.json    {shard, nbShards, records, csv,
+#                                                           started, completed}
+# Work files stay in <atc dir>/work/: they are named by record, shards never write the same
+# ones.
+#
+# Merge: all the N manifests must be completed, their records disjoint; the partial CSV rows
+# are written to the final CSV in record order (sorted record names, rows of a record in the
+# order of its shard's CSV), i.e. the same order as a run without shards.
+
+def parseShard(text): # "i/N" -> (i, N)
+  try:
+    index, nbShards = [int(v) for v in text.split('/')]
+  except ValueError:
+    raise ValueError("invalid shard (%s), expected i/N" % (text))
+  if nbShards < 1 or not 0 <= index < nbShards:
+    raise ValueError("invalid shard (%s), expected 0 <= i < N" % (text))
+  return index, nbShards
+
+def shardOf(key, nbShards):
+  digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+  return int(digest[:16], 16) % nbShards
+
+def shardFilename(filename, shard): # output.csv -> output.shard-1of4.csv
+  if shard is None:
+    return filename
+  root, extension = os.path.splitext(filename)
+  return "%s.shard-%dof%d%s" % (root, shard[0], shard[1], extension)
+
+def manifestFilename(csvFilename, shard):
+  return os.path.splitext(shardFilename(csvFilename, shard))[0] + '.manifest.json'
+
+def selectShard(recordNamesDict, atcFilesDirectory, shard): # {recordName: (atcFilename, atcFilepath)} of the shard
+  if shard is None:
+    return recordNamesDict
+  index, nbShards = shard
+  return {recordName: files for recordName, files in recordNamesDict.items()
+          if shardOf(os.path.relpath(files[1], atcFilesDirectory), nbShards) == index}
+
+# Manifest
+# --------------------------------------------------------------------------------------------
+class Manifest:
+  def __init__(self, filename, shard, recordNames, csvFilename):
+    self.filename = filename
+    self.content = {'shard': shard[0], 'nbShards': shard[1], 'records': sorted(recordNames),
+                    'csv': os.path.basename(csvFilename), 'started': time.time(), 'completed': None}
+
+  def write(self):
+    tmpFilename = self.filename + '.tmp'
+    with open(tmpFilename, mode='w') as f:
+      json.dump(self.content, f, indent=1)
+    os.replace(tmpFilename, self.filename)
+
+  def complete(self):
+    self.content['completed'] = time.time()
+    self.write()
+
+# mergeShards
+# Combine the partial CSV files of the shards of csvFilename into csvFilename.
+# return True on success
+# --------------------------------------------------------------------------------------------
+def mergeShards(csvFilename):
+  pattern = glob.escape(os.path.splitext(csvFilename)[0]) + '.shard-*of*.manifest.json'
+  manifests = []
+  for filename in sorted(glob.glob(pattern)):
+    with open(filename, mode='r') as f:
+      manifests.append(json.load(f))
+  if not manifests:
+    print("ERROR: mergeShards: no shard manifest found (%s)." % (pattern))
+    return False
+
+  nbShards = manifests[0]['nbShards']
+  if any(m['nbShards'] != nbShards for m in manifests):
+    print("ERROR: mergeShards: manifests of different shard counts (%s), remove the stale ones." % (', '.join(sorted(set([str(m['nbShards']) for m in manifests])))))
+    return False
+  manifests = {m['shard']: m for m in manifests}
+  missing = [str(i) for i in range(nbShards) if i not in manifests]
+  incomplete = [str(i) for i, m in sorted(manifests.items()) if m['completed'] is None]
+  if missing or incomplete:
+    print("ERROR: mergeShards: shards not done - missing: [%s] - not completed: [%s]" % (', '.join(missing), ', '.join(incomplete)))
+    return False
+
+  recordShards = {}
+  for i, m in manifests.items():
+    for recordName in m['records']:
+      if recordName in recordShards:
+        print("ERROR: mergeShards: record (%s) in shards %d and %d." % (recordName, recordShards[recordName], i))
+        return False
+      recordShards[recordName] = i
+
+  headers = None
+  rows = [] # (recordId, shard, row number, row)
+  for i in range(nbShards):
+    partialFilename = os.path.join(os.path.dirname(csvFilename), manifests[i]['csv'])
+    with open(partialFilename, mode='r', newline='') as f:
+      reader = csv.reader(f, delimiter=';', quotechar='"')
+      shardHeaders = next(reader)
+      if headers is not None and shardHeaders != headers:
+        print("ERROR: mergeShards: columns of shard %d differ (%s)." % (i, partialFilename))
+        return False
+      headers = shardHeaders
+      for n, row in enumerate(reader):
+        rows.append((row[0], i, n, row))
+    print("Info: mergeShards: shard %d/%d: %d record(s) (%s)" % (i, nbShards, len(manifests[i]['records']), partialFilename))
+
+  rows.sort(key=lambda r: r[:3])
+  with open(csvFilename, mode='w', newline='') as f:
+    writer = csv.writer(f, delimiter=';', quotechar='"', quoting=csv.QUOTE_ALL)
+    writer.writerow(headers)
+    for row in rows:
+      writer.writerow(row[3])
+
+  print("Info: mergeShards: %d row(s) of %d record(s) written to '%s'." % (len(rows), len(recordShards), csvFilename))
+  return True
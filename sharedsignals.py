@@ -0,0 +1,189 @@
+#!/usr/local/bin/python3
+
+import os
+import weakref
+import json
+import glob
+import hashlib
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy
+
+# Shared signals
+# --------------------------------------------------------------------------------------------
+# The int16 leads decoded from an ATC file are written once into a POSIX shared memory
+# segment. QRS detection and rendering workers (threads or other processes, e.g.
+# record-viewer.py -shm) attach to it by name and get numpy views on it (no copy, no file).
+#
+# Segment layout:
+#  - uint64: length of the JSON header
+#  - JSON header: {'recordId': id, 'leads': [...], 'nbSamples': n, 'frequency': f, 'amplitudeResolution': r}
+#  - padding to 64 bytes
+#  - int16 samples, shape (nbLeads, nbSamples), one contiguous row per lead
+#
+# Lifetime: the process which creates a segment owns it and unlinks it when the record is
+# completed (SharedSignal is a context manager). numpy views on a buffer do not export it:
+# close() would unmap the views still alive (crash on the next access). The views are all
+# derived from one SegmentView (their base), tracked with a weak reference: the segment is
+# unlinked at once, but unmapped only when its SegmentView is gone (else on a later
+# release()). If the owner dies, Python's resource tracker unlinks it; segments left by a
+# killed owner are removed by cleanupStaleSharedSignals().
+#
+# Segment name: kardia-<owner pid>-<hash of the record path>, the same record id can be in
+# several directories (and POSIX names are limited to 31 characters on macOS).
+
+gSegmentPrefix = 'kardia'
+gHeaderAlignment = 64
+gDeferredCloses = [] # [(SharedMemory, weak reference to its SegmentView), ...]
+
+# openSegment: attach without registering the segment in this process' resource tracker,
+# otherwise the segment would be unlinked when any attached worker exits.
+def openSegment(name):
+  try:
+    return shared_memory.SharedMemory(name=name, track=False)
+  except TypeError: # python < 3.13
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+# SegmentView: base of all the numpy views on the samples of a segment, alive while one is
+# --------------------------------------------------------------------------------------------
+class SegmentView:
+  def __init__(self, shm, shape, offset):
+    address = numpy.frombuffer(shm.buf, dtype=numpy.int16, count=shape[0] * shape[1], offset=offset).__array_interface__['data']
+    self.__array_interface__ = {'shape': shape, 'typestr': '<i2', 'data': address, 'version': 3}
+
+# SharedSignal
+# --------------------------------------------------------------------------------------------
+class SharedSignal:
+  def __init__(self, shm, owner):
+    self.shm = shm
+    self.owner = owner # True if this process created (and must unlink) the segment
+
+    headerLength = int(numpy.frombuffer(shm.buf, dtype=numpy.uint64, count=1)[0])
+    self.header = json.loads(bytes(shm.buf[8:8 + headerLength]).decode('utf-8'))
+    self.frequency = self.header['frequency']
+    self.amplitudeResolution = self.header['amplitudeResolution']
+
+    offset = SharedSignal.dataOffset(headerLength)
+    shape = (len(self.header['leads']), self.header['nbSamples'])
+    segmentView = SegmentView(shm, shape, offset)
+    self.samples = numpy.asarray(segmentView)
+    self.segmentView = weakref.ref(segmentView)
+
+  def __enter__(self): return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.release()
+    return False
+
+  def dataOffset(headerLength):
+    return (8 + headerLength + gHeaderAlignment - 1) // gHeaderAlignment * gHeaderAlignment
+
+  def segmentName(recordPath):
+    digest = hashlib.sha1(os.path.realpath(recordPath).encode('utf-8')).hexdigest()[:16]
+    return "%s-%d-%s" % (gSegmentPrefix, os.getpid(), digest)
+
+  def create(recordId, recordPath, leads, frequency, amplitudeResolution): # leads: {'leadI': [int16, ...], ...}
+    names = list(leads.keys())
+    nbSamples = min([len(leads[lead]) for lead in names]) if names else 0
+    header = json.dumps({'recordId': recordId, 'leads': names, 'nbSamples': nbSamples,
+                         'frequency': float(frequency), 'amplitudeResolution': amplitudeResolution}).encode('utf-8')
+
+    offset = SharedSignal.dataOffset(len(header))
+    size = offset + len(names) * nbSamples * 2
+    shm = shared_memory.SharedMemory(name=SharedSignal.segmentName(recordPath), create=True, size=max(size, 1))
+
+    numpy.frombuffer(shm.buf, dtype=numpy.uint64, count=1)[:] = len(header)
+    shm.buf[8:8 + len(header)] = header
+
+    sharedSignal = SharedSignal(shm, True)
+    for i in range(len(names)):
+      sharedSignal.samples[i, :] = numpy.asarray(leads[names[i]][:nbSamples], dtype=numpy.int16)
+
+    return sharedSignal
+
+  def attach(name): return SharedSignal(openSegment(name), False)
+
+  def name(self): return self.shm.name
+
+  def leadNames(self): return self.header['leads']
+
+  def digital(self, lead): # int16 view on the segment
+    return self.samples[self.header['leads'].index(lead)]
+
+  def gain(self): # digital units per mV
+    # from: https://developers.kardia.com/#ecg-samples-object
+    return float(1e6) / float(self.amplitudeResolution)
+
+  def physical(self, lead): # mV (new array)
+    return self.digital(lead) / self.gain()
+
+  def times(self): # sec
+    return numpy.arange(self.header['nbSamples']) / self.frequency
+
+  def release(self):
+    # unlinked first: a view still alive elsewhere (e.g. a RecordSignal) must not leak the segment
+    if self.owner:
+      try:
+        self.shm.unlink()
+      except FileNotFoundError:
+        pass
+      self.owner = False
+    if self.samples is not None:
+      self.samples = None
+      gDeferredCloses.append((self.shm, self.segmentView))
+    closeUnviewedSegments()
+
+# closeUnviewedSegments: unmap the released segments without numpy views left
+# --------------------------------------------------------------------------------------------
+def closeUnviewedSegments():
+  for shm, segmentView in list(gDeferredCloses):
+    if segmentView() is not None:
+      continue # views still alive
+    gDeferredCloses.remove((shm, segmentView))
+    try:
+      shm.close()
+    except BufferError:
+      pass
+
+# cleanupStaleSharedSignals
+# Unlink segments whose owner process does not exist anymore (e.g. killed with SIGKILL).
+# --------------------------------------------------------------------------------------------
+def cleanupStaleSharedSignals():
+  removed = 0
+  for path in glob.glob('/dev/shm/%s-*' % (gSegmentPrefix)):
+    try:
+      pid = int(os.path.basename(path).split('-')[1])
+    except (IndexError, ValueError):
+      continue
+
+    try:
+      os.kill(pid, 0)
+      continue # owner still alive
+    except ProcessLookupError:
+      pass
+    except PermissionError:
+      continue
+
+    try:
+      os.remove(path)
+      removed += 1
+    except OSError:
+      pass
+
+  if removed:
+    print("Info: removed %d stale shared signal segment(s)." % (removed))
+  return removed
+
+# leadsFromAtcDict
+# return {'leadI': numpy int16 array, ...} from an atc2json dict (see atc2edf.convertAtc2Dict)
+# --------------------------------------------------------------------------------------------
+gAtcLeads = ['leadI', 'leadII', 'leadIII', 'aVR', 'aVL', 'aVF']
+
+def leadsFromAtcDict(atcDict):
+  leads = {}
+  for lead in gAtcLeads:
+    if lead in atcDict['samples'] and atcDict['samples'][lead]:
+      leads[lead] = numpy.asarray(atcDict['samples'][lead], dtype=numpy.int16)
+  return leads
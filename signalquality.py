@@ -0,0 +1,216 @@
+#!/usr/local/bin/python3
+
+import os
+import json
+import time
+import argparse
+
+import numpy
+
+from recordbundle import RecordBundle, parseHeader
+
+# Signal quality
+# --------------------------------------------------------------------------------------------
+# Signal quality index (SQI) of a record, computed right after the ATC decode (process-kardia
+# 'quality' stage), so that unusable strips (finger lifted, flat line, noise) skip the QRS
+# detection, get_hrv, hrvanalysis and the render. All leads at once (numpy, shape (leads, n)):
+#
+#  - flat:        fraction of 0.5 sec windows with a peak to peak < 0.02 mV
+#  - saturation:  fraction of samples at the lead's min or max value (clipping plateaus)
+#  - hfNoise:     power above 40 Hz / power above 1 Hz (white noise at 300 Hz: ~0.74)
+#  - kurtosis:    of the 1 - 40 Hz band: QRS peaks make it high, gaussian noise is 3
+#  - periodicity: autocorrelation peak (signal low passed at 15 Hz) at a lag of 0.3 - 2 sec
+#                 (30 - 200 bpm), i.e. the mean correlation of the signal with itself one beat
+#                 later (template correlation without a QRS detection)
+#
+# Each metric is scored in [0, 1]: 1 - flat - saturation, 1 - hfNoise, (kurtosis - 3) / 5 and
+# (periodicity - 0.1) / 0.4 (the periodicity is ~0.6 on clean strips, lowered by the RR
+# variability). The SQI of a lead is its lowest score, the SQI of the record is the one of
+# leadI (the lead of the HRV outputs). Written to <work>/<recordId>.sqi.json (kept in the
+# bundle):
+#
+#   {"sqi": 0.83, "threshold": 0.0, "usable": true, "lead": "leadI", "leads": {"leadI": {...}}}
+#
+# The threshold is opt-in (default 0: no record skipped): a noisy strip with clear beats scores
+# ~0.45 (synthetic 'noisy' strip, -b) and still gives an HRV, while flat, saturated and noise
+# only strips score ~0. A threshold of 0.2 - 0.3 skips the latter only.
+
+gSqiExtension = '.sqi.json'
+gDefaultThreshold = 0.0
+gFlatWindow = 0.5 # sec
+gFlatMv = 0.02
+gHfCutoff = 40.0 # Hz
+gPeriodicityCutoff = 15.0 # Hz
+gLowCutoff = 1.0 # Hz
+gMinLag, gMaxLag = 0.3, 2.0 # sec
+
+# leadsQuality
+# digital: int16, shape (nbLeads, nbSamples); gain: digital units per mV
+# return {metric: numpy array (one value per lead)}
+# --------------------------------------------------------------------------------------------
+def leadsQuality(digital, frequency, gain):
+  x = numpy.asarray(digital, dtype=numpy.float32)
+  nbLeads, n = x.shape
+  quality = {}
+
+  w = max(1, int(gFlatWindow * frequency))
+  nbWindows = n // w
+  if nbWindows:
+    windows = x[:, :nbWindows * w].reshape(nbLeads, nbWindows, w)
+    quality['flat'] = numpy.mean(windows.max(axis=2) - windows.min(axis=2) < gFlatMv * gain, axis=1)
+  else:
+    quality['flat'] = numpy.ones(nbLeads)
+  high, low = x.max(axis=1, keepdims=True), x.min(axis=1, keepdims=True)
+  quality['saturation'] = numpy.mean((x == high) | (x == low), axis=1) * (high[:, 0] > low[:, 0])
+
+  # spectrum (circular: the wrap around of a lag of <= 2 sec is negligible on a strip)
+  x -= x.mean(axis=1, keepdims=True)
+  spectrum = numpy.fft.rfft(x, axis=1)
+  power = spectrum.real ** 2 + spectrum.imag ** 2
+  frequencies = numpy.arange(power.shape[1]) * frequency / n
+  power[:, frequencies < gLowCutoff] = 0.0 # baseline wander
+  total = power.sum(axis=1)
+  quality['hfNoise'] = numpy.divide(power[:, frequencies >= gHfCutoff].sum(axis=1), total, out=numpy.ones(nbLeads), where=total > 0)
+
+  # autocorrelation of the low passed signal (QRS widened: robust to the RR variability),
+  # sampled at 2 x gPeriodicityCutoff
+  nbBins = min(power.shape[1], int(gPeriodicityCutoff * n / frequency) + 1)
+  size = 2 * (nbBins - 1)
+  lagStep = n / max(size, 1) / frequency # sec
+  lags = numpy.arange(int(numpy.ceil(gMinLag / lagStep)), int(gMaxLag / lagStep) + 1)
+  lags = lags[lags < size // 2]
+  if len(lags):
+    autocorrelation = numpy.fft.irfft(power[:, :nbBins], size, axis=1)
+    zeroLag = autocorrelation[:, 0]
+    periodicity = numpy.divide(autocorrelation[:, lags].max(axis=1), zeroLag, out=numpy.zeros(nbLeads), where=zeroLag > 0)
+  else:
+    periodicity = numpy.zeros(nbLeads)
+  quality['periodicity'] = numpy.clip(periodicity, 0.0, 1.0)
+
+  # kurtosis of the 1 - 40 Hz band (QRS peaks: high, gaussian noise: 3)
+  spectrum[:, (frequencies < gLowCutoff) | (frequencies >= gHfCutoff)] = 0.0
+  band = numpy.fft.irfft(spectrum, n, axis=1)
+  band *= band
+  variance = numpy.mean(band, axis=1)
+  quality['kurtosis'] = numpy.divide(numpy.mean(band * band, axis=1), variance ** 2, out=numpy.zeros(nbLeads), where=variance > 0)
+
+  scores = numpy.stack([1.0 - quality['flat'] - quality['saturation'], 1.0 - quality['hfNoise'],
+                        (quality['kurtosis'] - 3.0) / 5.0, (quality['periodicity'] - 0.1) / 0.4])
+  quality['sqi'] = numpy.clip(scores, 0.0, 1.0).min(axis=0)
+  return quality
+
+# recordQuality
+# leads: {'leadI': int16 array, ...} (or an int16 array (nbLeads, n) with leadNames)
+# ------------------------------------------------------------------------------------------
+def recordQuality(leads, frequency, gain, threshold=gDefaultThreshold, leadNames=None):
+  if leadNames is None:
+    leadNames = list(leads.keys())
+    nbSamples = min([len(leads[lead]) for lead in leadNames]) if leadNames else 0
+    digital = numpy.stack([numpy.asarray(leads[lead][:nbSamples]) for lead in leadNames]) if leadNames else numpy.zeros((0, 0), dtype=numpy.int16)
+  else:
+    digital = leads
+  quality = leadsQuality(digital, frequency, gain) if len(leadNames) and digital.shape[1] else None
+
+  perLead = {}
+  for i, lead in enumerate(leadNames):
+    perLead[lead] = {name: round(float(values[i]), 4) for name, values in quality.items()} if quality is not None else {'sqi': 0.0}
+  lead = 'leadI' if 'leadI' in perLead else (leadNames[0] if leadNames else None)
+  sqi = perLead[lead]['sqi'] if lead is not None else 0.0
+  return {'sqi': sqi, 'threshold': threshold, 'usable': sqi >= threshold, 'lead': lead, 'leads': perLead}
+
+# work files
+# --------------------------------------------------------------------------------------------
+def readWorkSignals(workingRname): # (int16 (nbLeads, n) view, leads, frequency, gain) of the WFDB record (format 16)
+  with open(workingRname + '.hea', mode='r') as f:
+    header = parseHeader(f.read())
+  nbLeads = len(header['leads'])
+  if any(f != '16' for f in header['formats']):
+    raise ValueError("signal format %s not supported" % (','.join(header['formats'])))
+  data = numpy.fromfile(workingRname + '.dat', dtype='<i2')
+  data = data[:len(data) // nbLeads * nbLeads].reshape(-1, nbLeads).T
+  return data, header['leads'], header['frequency'], header['gains'][0]
+
+def writeQuality(workingRname, quality):
+  filename = workingRname + gSqiExtension
+  with open(filename + '.tmp', mode='w') as f:
+    json.dump(quality, f, indent=1)
+  os.replace(filename + '.tmp', filename)
+
+def readQuality(workingRname, bundle=None): # return the quality dict or None (not computed)
+  if bundle is not None and bundle.has(gSqiExtension[1:]):
+    return json.loads(bundle.readText(gSqiExtension[1:]))
+  filename = workingRname + gSqiExtension
+  if not os.path.isfile(filename):
+    return None
+  with open(filename, mode='r') as f:
+    return json.load(f)
+
+# benchmark
+# --------------------------------------------------------------------------------------------
+def syntheticLeads(kind, seconds=30, frequency=300, gain=2000.0, seed=1): # int16 (2, n)
+  rnd = numpy.random.default_rng(seed)
+  n = int(seconds * frequency)
+  t = numpy.arange(n) / frequency
+  if kind == 'flat':
+    mv = numpy.zeros(n) + rnd.normal(0, 0.002, n)
+  elif kind == 'noise':
+    mv = rnd.normal(0, 0.3, n)
+  else:
+    mv = numpy.zeros(n)
+    beat = 0.5
+    while beat < seconds - 1:
+      for center, width, amplitude in [(-0.16, 0.025, 0.15), (0.0, 0.01, 1.0), (0.25, 0.04, 0.3)]: # P, QRS, T
+        mv += amplitude * numpy.exp(-0.5 * ((t - beat - center) / width) ** 2)
+      beat += 0.8 + rnd.normal(0, 0.03)
+    mv += 0.15 * numpy.sin(2 * numpy.pi * 0.25 * t) + rnd.normal(0, 0.02 if kind == 'clean' else 0.25, n)
+    if kind == 'saturated':
+      mv = numpy.clip(mv * 4, -0.6, 0.6)
+  digital = numpy.clip(numpy.stack([mv, 0.7 * mv]) * gain, -32768, 32767).astype(numpy.int16)
+  return digital
+
+def benchmark(threshold=gDefaultThreshold, repeat=200, frequency=300):
+  kinds = ['clean', 'noisy', 'saturated', 'noise', 'flat']
+  print("SQI of 30 sec synthetic strips (%d Hz, 2 leads):" % (frequency))
+  for kind in kinds:
+    quality = recordQuality(syntheticLeads(kind, frequency=frequency), frequency, 2000.0, threshold, ['leadI', 'leadII'])
+    q = quality['leads']['leadI']
+    print(" - %-9s sqi %.2f (%s) - flat %.2f saturation %.3f hfNoise %.3f kurtosis %5.1f periodicity %.2f" %
+          (kind, q['sqi'], 'usable' if quality['usable'] else 'skipped', q['flat'], q['saturation'], q['hfNoise'], q['kurtosis'], q['periodicity']))
+
+  for nbLeads in [1, 2, 6]:
+    digital = numpy.tile(syntheticLeads('clean', frequency=frequency), (3, 1))[:nbLeads]
+    start = time.perf_counter()
+    for i in range(repeat):
+      recordQuality(digital, frequency, 2000.0, leadNames=['lead%d' % (j) for j in range(nbLeads)])
+    elapsed = (time.perf_counter() - start) / repeat
+    print("Stage cost: %d lead(s): %.3f msec per record - %.3f msec per 30 sec lead" % (nbLeads, 1000 * elapsed, 1000 * elapsed / nbLeads))
+  return 0
+
+def main():
+  ap = argparse.ArgumentParser()
+  ap.add_argument("-r", "--record", action="append", default=[], help="print the SQI of this record (work name, e.g. data/work/b6: .hea + .dat, or its bundle)")
+  ap.add_argument("-t", "--threshold", type=float, default=gDefaultThreshold, help="SQI threshold (default: %.2f: all usable)" % (gDefaultThreshold))
+  ap.add_argument("-b", "--benchmark", action="store_true", help="SQI of synthetic strips and stage cost")
+  args = vars(ap.parse_args())
+
+  if args['benchmark'] or not args['record']:
+    return benchmark(args['threshold'])
+  for workingRname in args['record']:
+    bundle = RecordBundle.open(workingRname)
+    if bundle is not None:
+      with bundle:
+        digital, leads, frequency = bundle.digitalSignals().T, bundle.leadNames(), bundle.frequency()
+        gain = bundle.index['gains'][0]
+        quality = recordQuality(numpy.array(digital), frequency, gain, args['threshold'], leads)
+    else:
+      digital, leads, frequency, gain = readWorkSignals(workingRname)
+      quality = recordQuality(digital, frequency, gain, args['threshold'], leads)
+    print("%s: sqi %.2f (%s)" % (workingRname, quality['sqi'], 'usable' if quality['usable'] else 'below threshold'))
+    for lead, q in quality['leads'].items():
+      print("  %s: %s" % (lead, ' '.join(["%s %s" % (name, value) for name, value in q.items()])))
+  return 0
+
+if __name__ == "__main__":
+  ret = main()
+  if not ret: print("done.")
+  exit(ret)
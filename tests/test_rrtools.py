@@ -0,0 +1,65 @@
+import os
+import shutil
+import warnings
+
+import numpy
+import pytest
+
+pytest.importorskip('scipy')
+import rrtools
+
+gFixtures = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+
+def naiveFluctuations(rr, boxSizes): # F(n) with a polyfit per box (all the boxes of a size at once)
+  x = numpy.asarray(rr, dtype=numpy.float64)
+  y = numpy.cumsum(x - numpy.mean(x))
+  f = []
+  for size in boxSizes:
+    nbBoxes = len(y) // size
+    if nbBoxes < 4:
+      f.append(numpy.nan)
+      continue
+    t = numpy.arange(size)
+    boxes = y[:nbBoxes * size].reshape(nbBoxes, size).T
+    slope, intercept = numpy.polyfit(t, boxes, 1)
+    squares = numpy.sum((boxes - (numpy.outer(t, slope) + intercept)) ** 2)
+    f.append(numpy.sqrt(squares / (nbBoxes * size)))
+  return numpy.array(f)
+
+@pytest.mark.parametrize('series', ['strip', 'drift', 'walk'])
+def test_dfaFluctuations_matches_polyfit(series):
+  rnd = numpy.random.default_rng(1)
+  if series == 'strip':
+    rr = rrtools.syntheticRR(300)
+  elif series == 'drift': # 100k beats, +-150 msec diurnal drift
+    rr = 800 + 150 * numpy.sin(numpy.arange(100000) / 20000.0) + rnd.normal(0, 20, 100000)
+  else: # 100k beats random walk
+    rr = 800 + numpy.cumsum(rnd.normal(0, 5, 100000))
+  boxSizes = numpy.arange(4, 65)
+  numpy.testing.assert_allclose(rrtools.dfaFluctuations(rr, boxSizes), naiveFluctuations(rr, boxSizes), rtol=1e-9)
+
+def test_nonlinear_short_series_is_nan_without_warnings():
+  with warnings.catch_warnings():
+    warnings.simplefilter('error')
+    for rr in [[], [800.0], [800.0, 810.0, 790.0]]:
+      features = rrtools.nonlinear(rr)
+      assert all(numpy.isnan(value) for value in features.values())
+
+# fixtures/filtnn.rr.txt (time, interval in sec): 80 intervals of 0.8 sec +-2 % with intervals
+# out of the hard limits and out of the tolerance next to both ends and inside the windows of
+# borderline intervals (5, 36, 77): they are kept or excluded depending on how filtnn handles the
+# windows at the ends of the series and the intervals it already excluded.
+# filtnn.expected.txt: the output of PhysioNet's filtnn, written by
+#   ./rrtools.py -f tests/fixtures/filtnn.rr.txt -e tests/fixtures/filtnn.expected.txt
+gFiltnnExpected = os.path.join(gFixtures, 'filtnn.expected.txt')
+
+@pytest.mark.skipif(not os.path.isfile(gFiltnnExpected), reason="filtnn.expected.txt not generated (needs filtnn, see above)")
+def test_filtNN_matches_filtnn_fixture():
+  rr = numpy.loadtxt(os.path.join(gFixtures, 'filtnn.rr.txt'), ndmin=2)
+  expected = numpy.loadtxt(gFiltnnExpected, ndmin=1)
+  kept = rrtools.filtNN(rr[:, 1], 0.2, 20, 0.4, 2.0)
+  numpy.testing.assert_array_equal(rr[kept, 0], expected)
+
+@pytest.mark.skipif(shutil.which('filtnn') is None, reason="filtnn not found in PATH")
+def test_filtNN_matches_filtnn_binary():
+  assert rrtools.compareFiltnn(os.path.join(gFixtures, 'filtnn.rr.txt'), 0.2, 20, 0.4, 2.0) == 0
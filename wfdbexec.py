@@ -0,0 +1,300 @@
+#!/usr/local/bin/python3
+
+import os
+import time
+import signal
+import asyncio
+import functools
+import contextlib
+
+from qrsdetectors import RecordSignal, gLeads
+from failures import retry
+
+# WFDB executor
+# --------------------------------------------------------------------------------------------
+# Runs the external WFDB tools of a record (edf2mit, wfdbdesc, rdsamp, gqrs, ann2rr, get_hrv,
+# ...) with asyncio instead of calculate.sh:
+#  - no shell: argv lists, stdout written to the output file, stderr (and stdout when there
+#    is no output file) written to the log once the command ends (no interleaving),
+#  - independent commands run concurrently, under one limit for all records (maxConcurrent,
+#    or the limits of a ResourceScheduler, see scheduler.py),
+#  - every command has a timeout (gTimeouts, by tool): the process is killed,
+#  - SIGINT kills all running commands, then calls the previous SIGINT handler. With
+#    drainOnInterrupt, a first SIGINT only sets draining (the caller stops starting new work
+#    and lets the running one end), a second one kills.
+#
+# Per-record graph (a command whose dependency failed is not run):
+#
+#  [edf2mit] --+--> wfdbdesc --+
+#              +--> rdsamp ----+--> signal loaded --+--> detect(detector, leadI) --+--> ann2rr
+#                                                   |                             +--> get_hrv -L
+#                                                   |                             +--> get_hrv
+#                                                   +--> detect(detector, leadII) --> ...
+#
+# edf2mit only runs when the MIT record is not already in work/ (atc2edf.py -m), a (detector,
+# lead) is skipped when its outputs exist. Detectors without an external command
+# (QRSDetector.detectCommand() is None) run detect() in a thread: on timeout the thread is
+# abandoned, the process it runs is killed by detect() (same timeout).
+
+def stageLog(logFile, stage): # lines of a recordlog.RecordLog tagged with the stage
+  return logFile.forStage(stage) if stage is not None and hasattr(logFile, 'forStage') else logFile
+
+# seconds, by tool or by QRS detector name (ecgpu: ecgpuwave)
+gTimeouts = {'edf2mit': 60, 'wfdbdesc': 30, 'rdsamp': 60, 'gqrs': 120, 'ecgpu': 300,
+             'ann2rr': 30, 'get_hrv': 60, 'wrann': 30,
+             'convert': 120, 'render': 120} # stages of process-kardia-records.py
+gDefaultTimeout = 120
+gDefaultMaxConcurrent = os.cpu_count() or 1
+
+# WfdbExecutor
+# --------------------------------------------------------------------------------------------
+class WfdbExecutor:
+  def __init__(self, maxConcurrent=None, timeouts={}, logFile=None, scheduler=None, drainOnInterrupt=False):
+    self.maxConcurrent = maxConcurrent or gDefaultMaxConcurrent
+    self.timeouts = dict(gTimeouts)
+    self.timeouts.update(timeouts)
+    self.logFile = logFile
+    self.scheduler = scheduler
+    self.semaphore = None # created in the event loop (see run())
+    self.processes = set()
+    self.interrupted = False
+    self.drainOnInterrupt = drainOnInterrupt
+    self.draining = False
+    self.stats = {'ok': 0, 'failed': 0, 'timeout': 0, 'seconds': 0.0}
+
+  def log(self, text, logFile=None, stage=None):
+    print(text, file=stageLog(logFile if logFile is not None else self.logFile, stage), flush=True)
+
+  def timeout(self, name): return self.timeouts.get(name, gDefaultTimeout)
+
+  # run
+  # Run a coroutine (e.g. processRecord()) on a new event loop, return its result.
+  # ------------------------------------------------------------------------------------------
+  def run(self, coroutine):
+    return asyncio.run(self.guarded(coroutine))
+
+  async def guarded(self, coroutine):
+    self.semaphore = asyncio.Semaphore(self.maxConcurrent)
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    previousHandler = signal.getsignal(signal.SIGINT)
+    loop.add_signal_handler(signal.SIGINT, self.interrupt, task)
+    if self.scheduler is not None:
+      await self.scheduler.start()
+    try:
+      return await coroutine
+    except asyncio.CancelledError:
+      if not self.interrupted: raise
+    finally:
+      if self.scheduler is not None:
+        await self.scheduler.stop()
+      loop.remove_signal_handler(signal.SIGINT)
+      signal.signal(signal.SIGINT, previousHandler)
+
+    # interrupted: all commands are killed, let the caller's handler decide
+    if callable(previousHandler):
+      previousHandler(signal.SIGINT, None)
+    raise KeyboardInterrupt
+
+  @contextlib.asynccontextmanager
+  async def slot(self, name): # yield the StageUsage of the scheduler (or None)
+    if self.scheduler is not None:
+      async with self.scheduler.stage(name) as usage:
+        yield usage
+    else:
+      async with self.semaphore:
+        yield None
+
+  def interrupt(self, task):
+    if self.drainOnInterrupt and not self.draining:
+      self.draining = True
+      print("WARNING: SIGINT received, finishing the work in progress (CTRL+C again to stop at once).")
+      return
+    print("WARNING: SIGINT received, killing %d WFDB command(s)." % (len(self.processes)))
+    self.interrupted = True
+    task.cancel()
+
+  # runCommand
+  # return 'ok', 'failed' or 'timeout'
+  # ------------------------------------------------------------------------------------------
+  async def runCommand(self, name, argv, cwd, stdoutFilename=None, cmdsFilename=None, logFile=None):
+    async with self.slot(name) as usage:
+      start = time.time()
+      stdout = open(stdoutFilename, mode='wb') if stdoutFilename is not None else None
+      def onRetry(attempt, delay, e):
+        self.log("%s: %s, retry %d in %.1f sec" % (' '.join(argv), str(e), attempt, delay), logFile, name)
+      try:
+        # transient errors (e.g. EAGAIN: fork under load) are retried
+        process = await retry(lambda: asyncio.create_subprocess_exec(*argv, cwd=cwd,
+                                                                     stdout=stdout if stdout is not None else asyncio.subprocess.PIPE,
+                                                                     stderr=asyncio.subprocess.PIPE,
+                                                                     start_new_session=True), onRetry=onRetry)
+      except OSError as e:
+        if stdout is not None: stdout.close()
+        self.log("%s: %s" % (' '.join(argv), str(e)), logFile, name)
+        return self.ended(name, 'failed', start, stdoutFilename)
+
+      self.processes.add(process)
+      if usage is not None: usage.watch(process.pid)
+      try:
+        output, errors = await asyncio.wait_for(process.communicate(), self.timeout(name))
+        status = 'ok' if process.returncode == 0 else 'failed'
+      except asyncio.TimeoutError:
+        await self.kill(process)
+        output, errors = None, None
+        status = 'timeout'
+      except asyncio.CancelledError:
+        await self.kill(process)
+        raise
+      finally:
+        self.processes.discard(process)
+        if stdout is not None: stdout.close()
+
+      line = ' '.join(argv) + (" > %s" % (os.path.basename(stdoutFilename)) if stdoutFilename is not None else "")
+      text = line + "\n"
+      if output: text += output.decode('utf-8', 'replace')
+      if errors: text += errors.decode('utf-8', 'replace')
+      if status != 'ok':
+        text += "%s: %s (return code: %s, %.1f sec)\n" % (name, status, str(process.returncode), time.time() - start)
+      self.log(text.rstrip('\n'), logFile, name)
+
+      if status == 'ok' and cmdsFilename is not None:
+        with open(cmdsFilename, mode='a') as f:
+          print(line, file=f)
+      return self.ended(name, status, start, stdoutFilename)
+
+  async def runFunction(self, name, function, *args, logFile=None): # function(*args) -> True on success, in a thread
+    async with self.slot(name) as usage:
+      start = time.time()
+      try:
+        thread = self.scheduler.runInThread(usage, function, *args) if usage is not None else asyncio.to_thread(function, *args)
+        ok = await asyncio.wait_for(thread, self.timeout(name))
+        status = 'ok' if ok else 'failed'
+      except asyncio.TimeoutError:
+        status = 'timeout'
+      except Exception as e:
+        self.log("%s: exception: %s" % (name, str(e)), logFile, name)
+        status = 'failed'
+      return self.ended(name, status, start)
+
+  async def kill(self, process): # the whole process group (e.g. children of a wrapper script)
+    try:
+      os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+      pass
+    await process.wait()
+
+  def ended(self, name, status, start, outputFilename=None):
+    # no partial output: a failed command is run again next time
+    if status != 'ok' and outputFilename is not None and os.path.isfile(outputFilename):
+      os.remove(outputFilename)
+    self.stats[status] += 1
+    self.stats['seconds'] += time.time() - start
+    return status
+
+  # convertRecord
+  # MIT record (edf2mit if needed), description and samples in work/ (writeSamples False: the
+  # signal is in shared memory, the rdsamp text dump is not needed).
+  # return the WFDB signal names, or None on error
+  # ------------------------------------------------------------------------------------------
+  async def convertRecord(self, workDir, recordId, edfFilename, logFile=None, writeSamples=True):
+    def workFilename(extension): return os.path.join(workDir, recordId + extension)
+    heaFilename = workFilename('.hea')
+    descFilename = workFilename('.output.desc.txt')
+    samplesFilename = workFilename('.output.samples.txt')
+    cmdsFilename = workFilename('.output.cmds.txt')
+
+    hasMit = os.path.isfile(heaFilename) and os.path.isfile(workFilename('.dat'))
+    if hasMit and os.path.isfile(descFilename) and (os.path.isfile(samplesFilename) or not writeSamples):
+      self.log("INFO: Record '%s' already calculated, do nothing." % (recordId), logFile)
+    else:
+      os.makedirs(workDir, exist_ok=True)
+      with open(cmdsFilename, mode='w') as f:
+        print(" -- (%s) -- Commands exectuted to calculate the HRV.\n -- " % (time.ctime()), file=f)
+
+      if not hasMit:
+        if not os.path.isfile(edfFilename):
+          self.log("Error: edf file (%s) does not exist." % (edfFilename), logFile)
+          return None
+        if await self.runCommand('edf2mit', ['edf2mit', '-i', os.path.abspath(edfFilename), '-r', recordId], workDir, None, cmdsFilename, logFile) != 'ok':
+          return None
+
+      commands = [self.runCommand('wfdbdesc', ['wfdbdesc', recordId], workDir, descFilename, cmdsFilename, logFile)]
+      if writeSamples:
+        commands.append(self.runCommand('rdsamp', ['rdsamp', '-r', recordId, '-P', '-v'], workDir, samplesFilename, cmdsFilename, logFile))
+      statuses = await asyncio.gather(*commands)
+      if any(status != 'ok' for status in statuses):
+        return None
+
+    signals = RecordSignal.readHeaderSignals(heaFilename)
+    if 'leadI' not in signals:
+      self.log("ERROR: no 'leadI' in signals, cannot continue.", logFile)
+      return None
+    return signals
+
+  # detectLead
+  # return the result dict of one (detector, lead)
+  # ------------------------------------------------------------------------------------------
+  async def detectLead(self, detector, workDir, recordId, lead, recordSignal, logFile=None):
+    result = {'detector': detector.name, 'lead': lead, 'annotator': detector.annotator(lead),
+              'rrKubios': detector.rrKubiosFilename(workDir, recordId, lead),
+              'getHrv': detector.getHrvFilename(workDir, recordId, lead),
+              'error': None, 'failureClass': None, 'timeout': False} # failureClass: 'detect' or 'hrv' (see failures.py)
+
+    if detector.isDetected(workDir, recordId, lead):
+      self.log("Info: %s %s already detected, do nothing." % (recordId, result['annotator']), logFile)
+      return result
+
+    cmdsFilename = os.path.join(workDir, recordId + '.output.cmds.txt')
+    argv = detector.detectCommand(workDir, recordId, lead, recordSignal)
+    if argv is not None:
+      status = await self.runCommand(argv[0], argv, workDir, None, cmdsFilename, logFile)
+    else:
+      # detectors run in threads, concurrently: one log per (detector, lead)
+      logFile = stageLog(logFile if logFile is not None else self.logFile, "%s %s" % (detector.name, lead))
+      detect = functools.partial(detector.detect, timeout=self.timeout(detector.name))
+      status = await self.runFunction(detector.name, detect, workDir, recordId, lead, recordSignal, logFile, logFile=logFile)
+    if status != 'ok':
+      result['error'] = "%s %s" % (detector.name, status)
+      result['failureClass'], result['timeout'] = 'detect', status == 'timeout'
+      return result
+
+    commands = detector.postCommands(workDir, recordId, lead)
+    statuses = await asyncio.gather(*[self.runCommand(name, cmd, workDir, output, cmdsFilename, logFile) for name, cmd, output in commands])
+    for (name, cmd, output), status in zip(commands, statuses):
+      if status != 'ok':
+        result['error'] = "%s %s" % (name, status)
+        result['failureClass'], result['timeout'] = 'hrv', status == 'timeout'
+        break
+    return result
+
+  # processRecord
+  # loadSignal(): return the RecordSignal once converted (from shared memory or work files)
+  # sharedSignal: loadSignal() reads shared memory (no samples dump written)
+  # return {detectorName: {lead: result, ...}, ...} or None if the record cannot be converted
+  # ------------------------------------------------------------------------------------------
+  async def processRecord(self, workDir, recordId, edfFilename, detectors, loadSignal, logFile=None, sharedSignal=False):
+    signals = await self.convertRecord(workDir, recordId, edfFilename, logFile, not sharedSignal)
+    if signals is None:
+      return None
+
+    # the signal is loaded (in a thread: loadtxt of the samples dump) only if a detector still
+    # has to run
+    leads = [lead for lead in gLeads.keys() if lead in signals]
+    recordSignal = None
+    if not all(detector.isDetected(workDir, recordId, lead) for detector in detectors for lead in leads):
+      recordSignal = await asyncio.to_thread(loadSignal)
+      leads = [lead for lead in leads if lead in recordSignal.leads]
+    jobs = [(detector, lead) for detector in detectors for lead in leads]
+    results = await asyncio.gather(*[self.detectLead(detector, workDir, recordId, lead, recordSignal, logFile) for detector, lead in jobs])
+
+    resultsByDetector = {detector.name: {} for detector in detectors}
+    for result in results:
+      resultsByDetector[result['detector']][result['lead']] = result
+      if result['error'] is not None:
+        print("ERROR: %s - %s %s: %s" % (recordId, result['detector'], result['lead'], result['error']))
+    return resultsByDetector
+
+  def printStats(self):
+    s = self.stats
+    print("Info: WFDB commands: %d ok - %d failed - %d timeout - %.1f sec (sum)" % (s['ok'], s['failed'], s['timeout'], s['seconds']))
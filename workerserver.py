@@ -0,0 +1,364 @@
+#!/usr/local/bin/python3
+
+import sys
+import os
+import io
+import json
+import time
+import signal
+import socket
+import socketserver
+import argparse
+import threading
+import subprocess
+import contextlib
+import importlib.util
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+CURR_DIR = os.path.dirname(os.path.realpath(__file__))
+
+gDefaultSocket = CURR_DIR + '/' + 'output.workers.sock'
+gDefaultWorkers = multiprocessing.cpu_count()
+
+# Worker server
+# --------------------------------------------------------------------------------------------
+# A pool of pre-warmed worker processes (numpy, pyedflib, matplotlib, hrvanalysis, atc2edf,
+# record-viewer already imported) behind a Unix socket. Instead of launching a new python
+# interpreter per record and per step, Processor (process-kardia-records.py -W) sends jobs:
+#
+#  request  (one JSON line): {"job": "convert"|"analyse"|"render"|"ping", "args": {...}, "timeout": sec}
+#  response (one JSON line): {"ok": true|false, "result": ..., "output": "...", "error": "...",
+#                             "seconds": ..., "pid": ...}
+#
+# Control requests: "restart" (graceful: new pool is warmed, in-flight jobs end on the old
+# one) and "shutdown". SIGHUP restarts, SIGTERM / SIGINT stop the server.
+#
+# Timeouts: convert takes the stage timeout ("timeout" arg: the atc2json process group is
+# killed). A job with a "timeout" (e.g. render) is timed by the server from its start on a
+# worker (not while it waits for a free one): on expiry its worker is killed and the pool
+# replaced. The response then has "timeout": true. A response with "transient": true (a worker
+# died, or no response) is worth retrying. The client socket has its own timeout (backstop).
+
+# Worker side
+# --------------------------------------------------------------------------------------------
+gModules = {}
+gStartedJobs = None # queue of (jobId, pid): the server knows the worker of a running job
+
+# scripts with a '-' in their name cannot be imported with 'import'
+def loadScript(filename, moduleName):
+  spec = importlib.util.spec_from_file_location(moduleName, os.path.join(CURR_DIR, filename))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def initWorker(startedJobs):
+  global gStartedJobs
+  gStartedJobs = startedJobs
+  signal.signal(signal.SIGINT, signal.SIG_IGN) # the server handles it
+  os.chdir(CURR_DIR)
+
+  import matplotlib
+  matplotlib.use('Agg')
+
+  import atc2edf
+  gModules['atc2edf'] = atc2edf
+  gModules['viewer'] = loadScript('record-viewer.py', 'recordviewer')
+  gModules['processor'] = loadScript('process-kardia-records.py', 'processkardiarecords')
+
+def jobPing():
+  return {'pid': os.getpid()}
+
+def jobConvert(atcFilepath, recordName, writeEdf=True, writeMit=False, forceOverwriteEDF=False, timeout=None): # same as atc2edf.py [-m] [-n]
+  atc2edf = gModules['atc2edf']
+  edfFilename = CURR_DIR + '/' + recordName + '.edf'
+  mitRecordName = atc2edf.recordWorkName(recordName)
+  result = {'edf': None, 'mit': None}
+
+  if writeEdf and os.path.isfile(edfFilename) and not forceOverwriteEDF:
+    print("INFO: EDF file (%s) already exists, do nothing." % (edfFilename))
+    writeEdf = False
+  if writeMit and os.path.isfile(mitRecordName + '.hea') and os.path.isfile(mitRecordName + '.dat'):
+    print("INFO: WFDB record (%s) already exists, do nothing." % (mitRecordName))
+    writeMit = False
+  if not writeEdf and not writeMit:
+    return result
+
+  atcDict = atc2edf.convertAtc2Dict(os.path.join(CURR_DIR, atcFilepath), timeout)
+  if writeEdf:
+    atc2edf.convertAtcDict2Edf(edfFilename, atcDict)
+    result['edf'] = edfFilename
+  if writeMit:
+    if not atc2edf.convertAtcDict2Wfdb(mitRecordName, atcDict):
+      raise RuntimeError("unable to write WFDB record (%s)" % (mitRecordName))
+    result['mit'] = mitRecordName
+  return result
+
+def jobAnalyse(recordName, qrsAlgo, cleanRR=True):
+  hrv = gModules['processor'].HRVAnalysis(None, cleanRR).calculateHrv(qrsAlgo, recordName)
+  if hrv is None:
+    raise RuntimeError("HRV analysis failed (%s, %s)" % (recordName, qrsAlgo))
+
+  features = {}
+  for domain in hrv.keys():
+    features[domain] = {k: float(v) for k, v in hrv[domain].items()}
+  return features
+
+def jobRender(recordName, qrsDetector, sharedMemoryName=None):
+  outputFilename = gModules['viewer'].plotLeadIWithRR(recordName, qrsDetector, True, sharedMemoryName)
+  return {'png': outputFilename}
+
+gJobs = {'ping': jobPing, 'convert': jobConvert, 'analyse': jobAnalyse, 'render': jobRender}
+
+def runJob(job, args, jobId): # runs in a worker process
+  gStartedJobs.put((jobId, os.getpid()))
+  start = time.time()
+  output = io.StringIO()
+  response = {'ok': True, 'result': None, 'error': None, 'pid': os.getpid()}
+  with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+    try:
+      response['result'] = gJobs[job](**args)
+    except subprocess.TimeoutExpired as e:
+      response['ok'] = False
+      response['timeout'] = True
+      response['error'] = "timeout (%s sec)" % (e.timeout)
+    except Exception as e:
+      response['ok'] = False
+      response['error'] = "%s: %s" % (type(e).__name__, str(e))
+  response['output'] = output.getvalue()
+  response['seconds'] = time.time() - start
+  return response
+
+# Server side
+# --------------------------------------------------------------------------------------------
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, socketPath, nbWorkers):
+    self.socketPath = socketPath
+    self.nbWorkers = nbWorkers
+    self.poolLock = threading.Lock()
+    self.restartLock = threading.Lock() # one restart at a time
+    self.jobsLock = threading.Lock()
+    self.nextJobId = 0
+    self.jobPids = {} # {jobId: pid of its worker, None until started}
+    self.startedJobs = multiprocessing.SimpleQueue()
+    threading.Thread(target=self.collectStartedJobs, daemon=True).start()
+    self.pool = self.newPool()
+
+    if os.path.exists(socketPath):
+      os.remove(socketPath)
+    socketserver.UnixStreamServer.__init__(self, socketPath, WorkerRequestHandler)
+
+  def newPool(self):
+    pool = futures.ProcessPoolExecutor(max_workers=self.nbWorkers, initializer=initWorker, initargs=(self.startedJobs,))
+    # warm all workers now, not on the first records
+    for f in [pool.submit(jobPing) for i in range(self.nbWorkers)]: f.result()
+    return pool
+
+  def collectStartedJobs(self):
+    while True:
+      jobId, pid = self.startedJobs.get()
+      with self.jobsLock:
+        if jobId in self.jobPids: # else already done
+          self.jobPids[jobId] = pid
+
+  def submit(self, job, args): # return (pool, future, jobId); BrokenProcessPool: its 'pool' is the broken one
+    with self.jobsLock:
+      jobId = self.nextJobId
+      self.nextJobId += 1
+      self.jobPids[jobId] = None
+    with self.poolLock:
+      pool = self.pool
+      try:
+        return pool, pool.submit(runJob, job, args, jobId), jobId
+      except BrokenProcessPool as e:
+        self.jobPid(jobId, done=True)
+        e.pool = pool
+        raise
+
+  def jobPid(self, jobId, done=False): # pid of the worker running the job (None: not started)
+    with self.jobsLock:
+      return self.jobPids.pop(jobId, None) if done else self.jobPids.get(jobId)
+
+  # result: of the job, or a timeout response (the worker is then killed: its pool is replaced)
+  def result(self, pool, future, jobId, timeout=None):
+    started = None
+    try:
+      while True:
+        try:
+          return future.result(timeout=1.0 if timeout is not None else None)
+        except futures.TimeoutError:
+          if started is None and self.jobPid(jobId) is not None:
+            started = time.time()
+          if started is not None and time.time() - started > timeout:
+            break
+    finally:
+      pid = self.jobPid(jobId, done=True)
+
+    print("Info: WorkerServer: job %d: timeout (%s sec), killing its worker (%d)..." % (jobId, timeout, pid))
+    try:
+      os.kill(pid, signal.SIGKILL) # the other jobs of the pool then fail as transient
+    except ProcessLookupError:
+      pass
+    threading.Thread(target=self.restart, args=(pool,), daemon=True).start()
+    return {'ok': False, 'timeout': True, 'error': "timeout (%s sec), worker killed" % (timeout), 'pid': pid}
+
+  # brokenPool: restart only if it is still the current pool (the handlers of all the jobs of a
+  # broken pool call restart(), the first one replaces it)
+  def restart(self, brokenPool=None):
+    with self.restartLock:
+      with self.poolLock:
+        if brokenPool is not None and brokenPool is not self.pool:
+          return # already replaced
+
+      print("Info: WorkerServer: restarting workers...")
+      newPool = self.newPool()
+      with self.poolLock:
+        oldPool = self.pool
+        self.pool = newPool
+    oldPool.shutdown(wait=True) # in-flight jobs end on the old workers
+    print("Info: WorkerServer: workers restarted.")
+
+  def stop(self):
+    # shutdown() must not be called from the serve_forever() thread
+    threading.Thread(target=self.shutdown, daemon=True).start()
+
+  def server_close(self):
+    socketserver.UnixStreamServer.server_close(self)
+    with self.poolLock:
+      self.pool.shutdown(wait=True)
+    if os.path.exists(self.socketPath):
+      os.remove(self.socketPath)
+
+class WorkerRequestHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    line = self.rfile.readline()
+    if not line:
+      return
+
+    try:
+      request = json.loads(line.decode('utf-8'))
+      job = request['job']
+      args = request.get('args', {})
+      timeout = request.get('timeout')
+    except (ValueError, KeyError) as e:
+      self.reply({'ok': False, 'error': "bad request: %s" % (str(e))})
+      return
+
+    if job == 'restart':
+      self.server.restart()
+      self.reply({'ok': True})
+    elif job == 'shutdown':
+      self.reply({'ok': True})
+      self.server.stop()
+    elif job not in gJobs:
+      self.reply({'ok': False, 'error': "unknown job (%s)" % (job)})
+    else:
+      pool = None
+      try:
+        pool, future, jobId = self.server.submit(job, args)
+        self.reply(self.server.result(pool, future, jobId, timeout))
+      except BrokenProcessPool as e: # a worker died (e.g. killed, segfault)
+        self.reply({'ok': False, 'error': "worker died: %s" % (str(e)), 'transient': True})
+        self.server.restart(getattr(e, 'pool', pool))
+
+  def reply(self, response):
+    self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+# WorkerClient
+# --------------------------------------------------------------------------------------------
+class WorkerClient:
+  def __init__(self, socketPath=gDefaultSocket, timeout=None):
+    self.socketPath = socketPath
+    self.timeout = timeout
+
+  # jobTimeout: of the job on its worker (killed on expiry, see above)
+  # socketTimeout: of this request (default: the client's), socket.timeout raised
+  def request(self, job, socketTimeout=None, jobTimeout=None, **args): # return the response dict
+    request = {'job': job, 'args': args}
+    if jobTimeout is not None:
+      request['timeout'] = jobTimeout
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+      s.settimeout(socketTimeout if socketTimeout is not None else self.timeout)
+      s.connect(self.socketPath)
+      s.sendall((json.dumps(request) + '\n').encode('utf-8'))
+      with s.makefile('rb') as f:
+        line = f.readline()
+
+    if not line:
+      return {'ok': False, 'error': "no response from worker server (%s)" % (self.socketPath), 'transient': True}
+    return json.loads(line.decode('utf-8'))
+
+  def isAlive(self):
+    try:
+      return self.request('ping')['ok']
+    except OSError:
+      return False
+
+# Benchmark
+# Per-record overhead only (no conversion work): a fresh interpreter importing the same
+# modules as atc2edf.py / record-viewer.py vs a round trip to a pre-warmed worker.
+# --------------------------------------------------------------------------------------------
+def benchmark(socketPath, nbRecords):
+  imports = "import numpy, pyedflib, matplotlib; matplotlib.use('Agg'); import matplotlib.pyplot, hrvanalysis"
+
+  start = time.time()
+  for i in range(nbRecords):
+    subprocess.check_call([sys.executable, '-c', imports])
+  before = (time.time() - start) / nbRecords
+
+  client = WorkerClient(socketPath)
+  start = time.time()
+  for i in range(nbRecords):
+    response = client.request('ping')
+    if not response['ok']:
+      print("ERROR: benchmark: ping failed (%s)" % (response['error']))
+      return 1
+  after = (time.time() - start) / nbRecords
+
+  print("Per-record overhead (%d records):" % (nbRecords))
+  print(" - new interpreter + imports : %8.2f ms" % (before * 1000))
+  print(" - worker server round trip  : %8.2f ms" % (after * 1000))
+  print(" - speedup                   : %8.1fx" % (before / after if after else float('inf')))
+  return 0
+
+def main():
+
+  ap = argparse.ArgumentParser()
+  ap.add_argument("-s", "--socket", default=gDefaultSocket, help="Unix socket path (default: %s)" % (gDefaultSocket))
+  ap.add_argument("-n", "--nb-workers", type=int, default=gDefaultWorkers, help="number of worker processes")
+  ap.add_argument("-r", "--restart", action="store_true", help="gracefully restart the workers of a running server")
+  ap.add_argument("-k", "--shutdown", action="store_true", help="stop a running server")
+  ap.add_argument("-b", "--benchmark", type=int, metavar="N", help="measure the per-record overhead on N records against a running server")
+  args = vars(ap.parse_args())
+
+  socketPath = args['socket']
+
+  if args['restart'] or args['shutdown']:
+    response = WorkerClient(socketPath).request('restart' if args['restart'] else 'shutdown')
+    return 0 if response['ok'] else 1
+
+  if args['benchmark']:
+    return benchmark(socketPath, args['benchmark'])
+
+  print("Info: starting %d workers..." % (args['nb_workers']))
+  server = WorkerServer(socketPath, args['nb_workers'])
+
+  signal.signal(signal.SIGHUP, lambda s, f: threading.Thread(target=server.restart, daemon=True).start())
+  signal.signal(signal.SIGTERM, lambda s, f: server.stop())
+  signal.signal(signal.SIGINT, lambda s, f: server.stop())
+
+  print("Info: worker server listening on '%s'" % (socketPath))
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+
+  return 0
+
+if __name__ == "__main__":
+  ret = main()
+  if not ret: print("done.")
+  exit(ret)